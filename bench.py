@@ -0,0 +1,847 @@
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import md2tex
+
+# Benchmarks for md2tex.
+# Usage:
+#   python bench.py [escape] [repeat]   escape_latex micro-benchmark
+#   python bench.py startup [runs]      CLI cold start with engine discovery; exits 1 over STARTUP_BUDGET_MS
+#   python bench.py parallel [jobs]     parallel vs serial md_to_latex; exits 1 unless byte-identical
+#   python bench.py sections [size]     --section through the section index vs the whole file;
+#                                       exits 1 unless sections match Document.section
+#   python bench.py converter [threads] per-call latency of one Converter shared by threads;
+#                                       exits 1 unless results match md_to_latex
+#   python bench.py checks [name ...]   regression checks (see CHECKS); exits 1 on any failure
+#   python bench.py corpus KIND SIZE OUT  write a synthetic Markdown document (e.g. tables 200M)
+#   python bench.py suite [options]     throughput / peak memory over the synthetic corpus,
+#                                       with --save / --baseline JSON regression gates
+#   python bench.py fuzz [options]      adversarial inputs; exits 1 unless conversion time grows
+#                                       linearly and stays within the per-line budget
+
+# Budget for `python -m md2tex <tiny file>` on top of a bare interpreter start, with a
+# stub pdflatex on PATH: engine discovery and the engine version are served from the
+# per-user cache, the PDF from the compile cache, and bytecode is cached
+STARTUP_BUDGET_MS = 50
+
+
+def legacy_escape_latex(text):
+    # Previous implementation (one str.replace pass per character), kept as the
+    # reference for output equality and speedup numbers.
+    if not text:
+        return ''
+    text = md2tex._strip_emojis(str(text))
+    text = text.replace('\\', ' BACKSLASHTEMP ')
+    for ch in '&%$#_{}':
+        text = text.replace(ch, '\\' + ch)
+    text = text.replace('~', '\\textasciitilde{}')
+    text = text.replace('^', '\\textasciicircum{}')
+    text = text.replace(' BACKSLASHTEMP ', '\\textbackslash{}')
+    for char, replacement in md2tex.UNICODE_MAP.items():
+        text = text.replace(char, replacement)
+    return text
+
+
+ESCAPE_INPUTS = {
+    'fragment': 'Regular text with ',
+    'prose': 'The converter keeps plain paragraphs readable and fast to typeset. ' * 40,
+    'text-heavy': 'Results: 50% of runs use x_1 & y_2 in {braces} ~ approx. ' * 40,
+    'symbol-heavy': 'α → β ≤ ∑ ∫ © € ™ ² ⁻ \U0001F600 ' * 40,
+}
+
+
+def bench_escape(repeat: int = 5):
+    rows = []
+    for name, text in ESCAPE_INPUTS.items():
+        assert md2tex.escape_latex(text) == legacy_escape_latex(text), name
+        number = max(1, 200000 // max(len(text), 1))
+        old = min(timeit.repeat(lambda: legacy_escape_latex(text), number=number, repeat=repeat))
+        new = min(timeit.repeat(lambda: md2tex.escape_latex(text), number=number, repeat=repeat))
+        rows.append((name, len(text), old / number * 1e6, new / number * 1e6))
+    return rows
+
+
+def _best_wall_time(cmd, runs: int, env=None) -> float:
+    best = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, capture_output=True, check=True, env=env)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_startup(runs: int = 15):
+    # Best-of-N wall time of a tiny conversion through the CLI, minus interpreter
+    # startup. The run resolves an engine (a stub pdflatex first on PATH), so cached
+    # engine discovery is part of what is timed.
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = here + os.pathsep + env.get('PYTHONPATH', '')
+    with tempfile.TemporaryDirectory() as tmp:
+        bin_dir = os.path.join(tmp, 'bin')
+        os.makedirs(bin_dir)
+        engine = os.path.join(bin_dir, 'pdflatex')
+        with open(engine, 'w') as f:
+            f.write(FAKE_ENGINE)
+        os.chmod(engine, 0o755)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+        for name in ('MD2TEX_CACHE_DIR', 'MD2TEX_CONFIG_DIR', 'MD2TEX_BUILD_DIR'):
+            env[name] = os.path.join(tmp, name.lower())
+        doc = os.path.join(tmp, 'tiny.md')
+        with open(doc, 'w', encoding='utf-8') as f:
+            f.write('# Title\n\nSome *text* with $x^2$.\n')
+        cmd = [sys.executable, '-m', 'md2tex', doc]
+        subprocess.run(cmd, capture_output=True, check=True, env=env)  # warm bytecode, engine and PDF caches
+        output = subprocess.run(cmd, capture_output=True, check=True, env=env, text=True).stdout
+        if f'using: {engine}' not in output:
+            raise RuntimeError(f'startup run did not resolve the stub engine:\n{output}')
+        bare = _best_wall_time([sys.executable, '-c', 'pass'], runs, env)
+        total = _best_wall_time(cmd, runs, env)
+    return bare * 1000, total * 1000
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def check_parallel(jobs: int = 4, copies: int = 300):
+    # Parallel rendering must match serial output byte for byte: once with the
+    # default run size on a large document, once with one-line runs on README.md
+    # so every blank line and heading becomes a cut.
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'README.md'), encoding='utf-8') as f:
+        text = f.read()
+    big = '\n'.join([text] * copies)
+    serial, serial_s = _timed(lambda: md2tex.md_to_latex(big))
+    parallel, parallel_s = _timed(lambda: md2tex.md_to_latex(big, jobs=jobs))
+    body = md2tex._render_parallel(text.split('\n'), jobs, run_lines=1)
+    split_everywhere = ''.join(md2tex._iter_document(body))
+    identical = parallel == serial and split_everywhere == md2tex.md_to_latex(text)
+    return identical, big.count('\n') + 1, serial_s, parallel_s
+
+
+# Request-sized documents for the shared Converter check
+CONVERTER_DOC_BYTES = 8 * 1024
+CONVERTER_REQUESTS = 400
+
+
+def _percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def check_converter(threads: int = 4, requests: int = CONVERTER_REQUESTS):
+    # One Converter shared by a thread pool, as in a web service: every result must
+    # match md_to_latex. Returns (identical, [(threads, p50 ms, p99 ms), ...]).
+    from concurrent.futures import ThreadPoolExecutor
+
+    kinds = list(CORPUS_KINDS)
+    texts = [''.join(iter_corpus(kinds[i % len(kinds)], CONVERTER_DOC_BYTES, seed=i % 16))
+             for i in range(requests)]
+    expected = [md2tex.md_to_latex(text) for text in texts]
+    converter = md2tex.Converter()
+
+    def timed_convert(text):
+        start = time.perf_counter()
+        latex = converter.convert(text)
+        return latex, (time.perf_counter() - start) * 1000
+
+    identical = True
+    rows = []
+    for workers in (1, threads):
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(timed_convert, texts))
+        identical = identical and [latex for latex, _ in results] == expected
+        times = [ms for _, ms in results]
+        rows.append((workers, _percentile(times, 0.5), _percentile(times, 0.99)))
+    return identical and converter.convert_many(texts, threads) == expected, rows
+
+
+def check_sections(size: int = 32 * 1024 * 1024):
+    # --section through the SectionIndex: every section of README.md must convert to
+    # what Document.section renders, and one section of a large corpus file is timed
+    # against the whole file. The corpus's own '# Part n' headings are demoted so they
+    # nest inside the 16 timed sections. Returns (identical, timings in seconds,
+    # bytes of the timed section).
+    here = os.path.dirname(os.path.abspath(__file__))
+    readme = os.path.join(here, 'README.md')
+    with open(readme, encoding='utf-8') as f:
+        doc = md2tex.parse_markdown(f.read(), base_dir=here)
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'section.tex')
+        identical = True
+        for title in dict.fromkeys(title for _, title in doc.headings()):
+            md2tex.convert_file(readme, out, section=title)
+            with open(out, encoding='utf-8') as f:
+                identical = identical and f.read() == doc.section(title).render()
+
+        kinds = list(CORPUS_KINDS)
+        part_size = max(1, size // 16)
+        big = os.path.join(tmp, 'big.md')
+        with open(big, 'w', encoding='utf-8') as f:
+            for i in range(16):
+                f.write(f'# Timed section {i}\n\n')
+                for line in iter_corpus(kinds[i % len(kinds)], part_size, seed=i):
+                    f.write('#' + line if line.startswith('# ') else line)
+                f.write('\n')
+        index_file = md2tex.SectionIndex.cache_file(big)
+        index, timings['index build'] = _timed(lambda: md2tex.SectionIndex.load(big))
+        _, timings['index load'] = _timed(lambda: md2tex.SectionIndex.load(big))
+        start, end = index.section_range('Timed section 7')
+        _, timings['whole file'] = _timed(lambda: md2tex.convert_file(big, out))
+        _, timings['one section'] = _timed(lambda: md2tex.convert_file(big, out, section='Timed section 7'))
+        os.remove(index_file)
+    return identical, timings, end - start
+
+
+# Deterministic synthetic corpus. Each generator returns the lines of one section;
+# a corpus repeats sections from a seeded RNG until it reaches the requested size.
+
+WORDS = ('the converter keeps plain paragraphs readable and fast to typeset with sensible defaults '
+         'for tables lists code math headings links results values range report section data').split()
+SYMBOLS = ''.join(md2tex.UNICODE_MAP)
+EMOJIS = '\U0001F600\U0001F680\u2705\u2B50\U0001F1E9\U0001F1EA'
+
+
+def _words(rng, n: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def _prose_section(rng):
+    lines = [f'## {_words(rng, 3).capitalize()}', '']
+    for _ in range(rng.randint(2, 5)):
+        for _ in range(rng.randint(1, 4)):
+            words = _words(rng, rng.randint(8, 20)).split()
+            i = rng.randrange(len(words))
+            words[i] = rng.choice((f'**{words[i]}**', f'`{words[i]}`', f'[{words[i]}](https://example.com/{i})',
+                                   f'{words[i]}_{i}', f'{i}%'))
+            lines.append(' '.join(words).capitalize() + '.')
+        lines.append('')
+    return lines
+
+
+def _inline_math_section(rng):
+    lines = []
+    for _ in range(rng.randint(4, 10)):
+        parts = [_words(rng, 2).capitalize()]
+        for _ in range(rng.randint(3, 8)):
+            i, j = rng.randint(1, 9), rng.randint(2, 4)
+            parts.append(rng.choice((f'$x_{{{i}}}^{j}$', f'$\\alpha_{i} + \\beta$', f'$\\frac{{{i}}}{{{j}}}$',
+                                     f'$$ {i} $$', f'$\\sum_{{k={i}}}^n k^{j}$')))
+            parts.append(_words(rng, rng.randint(1, 4)))
+        lines.append(' '.join(parts))
+    lines.append('')
+    if rng.random() < 0.3:
+        lines += ['$$', f'E = mc^{rng.randint(2, 4)} + \\int_0^1 f(x)\\,dx', '$$', '']
+    return lines
+
+
+def _table_section(rng):
+    cols = rng.randint(2, 6)
+    lines = ['| ' + ' | '.join(f'{_words(rng, 1)} {c}' for c in range(cols)) + ' |',
+             '|' + '---|' * cols]
+    for r in range(rng.randint(10, 60)):
+        cells = []
+        for c in range(cols):
+            cells.append(rng.choice((_words(rng, rng.randint(1, 6)), f'{r * c}.{c}%', f'$x_{c}$', f'`v{r}`',
+                                     f'**{_words(rng, 1)}**', f'{_words(rng, 1)} & {_words(rng, 1)}')))
+        lines.append('| ' + ' | '.join(cells) + ' |')
+    lines.append('')
+    return lines
+
+
+def _nested_list_section(rng):
+    lines = []
+    depth = 0
+    for _ in range(rng.randint(10, 40)):
+        depth = max(0, min(5, depth + rng.choice((-1, 0, 1))))
+        marker = rng.choice(('-', '*', '1.'))
+        lines.append('  ' * depth + f'{marker} {_words(rng, rng.randint(2, 10))}')
+    lines.append('')
+    return lines
+
+
+def _unicode_section(rng):
+    lines = []
+    for _ in range(rng.randint(4, 10)):
+        parts = []
+        for _ in range(rng.randint(4, 10)):
+            parts.append(''.join(rng.choice(SYMBOLS) for _ in range(rng.randint(1, 4))))
+            parts.append(rng.choice((_words(rng, rng.randint(1, 3)), rng.choice(EMOJIS))))
+        lines.append(' '.join(parts))
+    lines.append('')
+    return lines
+
+
+def _code_section(rng):
+    lines = [rng.choice(('```python', '```', '~~~'))]
+    for i in range(rng.randint(5, 40)):
+        indent = '    ' * rng.randint(0, 3)
+        code = rng.choice((f'value_{i} = compute({i}, "{_words(rng, 2)}")  # {rng.choice(SYMBOLS)}',
+                           f'if x[{i}] > 0 and {{"k": {i}}}["k"] & 1: return x ^ {i}',
+                           'print("' + _words(rng, 20) + '")', ''))
+        lines.append(indent + code)
+    lines += [lines[0][:3], '']
+    return lines
+
+
+CORPUS_KINDS = {
+    'prose': _prose_section,
+    'inline-math': _inline_math_section,
+    'tables': _table_section,
+    'nested-lists': _nested_list_section,
+    'unicode': _unicode_section,
+    'code-fences': _code_section,
+}
+
+
+# Distinct sections generated per corpus; bigger documents reuse them in seeded
+# random order, so hundreds of MB are written at disk speed
+CORPUS_POOL_SECTIONS = 256
+
+
+def iter_corpus(kind: str, size: int, seed: int = 0):
+    # Lines (with '\n') of a deterministic document of about size UTF-8 bytes
+    rng = random.Random(f'{kind}:{seed}')
+    section = CORPUS_KINDS[kind]
+    pool = []
+    written = 0
+    n = 0
+    while written < size:
+        n += 1
+        if len(pool) < CORPUS_POOL_SECTIONS:
+            lines = [line + '\n' for line in section(rng)]
+            pool.append((lines, sum(len(line.encode('utf-8')) for line in lines)))
+            lines, nbytes = pool[-1]
+        else:
+            lines, nbytes = rng.choice(pool)
+        header = f'# Part {n}\n\n'
+        yield header
+        yield from lines
+        written += len(header) + nbytes
+
+
+def write_corpus(path: str, kind: str, size: int, seed: int = 0):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(iter_corpus(kind, size, seed))
+
+
+def _parse_size(text: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _format_size(size: int) -> str:
+    for unit, factor in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+        if size >= factor and size % factor == 0:
+            return f'{size // factor}{unit}'
+    return str(size)
+
+
+def _best_time(func, repeat: int, setup=None) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _convert_file_stream(src_path: str):
+    with open(src_path, encoding='utf-8') as src, open(os.devnull, 'w', encoding='utf-8') as out:
+        md2tex.convert_stream(src, out)
+
+
+# Text fed to the function micro-benchmarks, per corpus kind
+MICRO_SAMPLE_BYTES = 256 * 1024
+
+
+def _micro_inputs(kind: str, seed: int):
+    lines = [line.rstrip('\n') for line in iter_corpus(kind, MICRO_SAMPLE_BYTES, seed)]
+    cells = [cell for line in lines if line.startswith('|') and '---' not in line
+             for cell in md2tex._table_cells(line)]
+    return lines, cells
+
+
+def _clear_inline_memos():
+    md2tex._INLINE_MEMO.clear()
+    md2tex._CELL_MEMO.clear()
+
+
+def run_suite(kinds, sizes, repeat: int = 3, seed: int = 0) -> dict:
+    # {benchmark name: {'mb_per_s': ..., ['peak_mb': ...]}}. process_inline and
+    # process_table_cell start from empty inline memos (repetition within the sample
+    # still hits); the /warm variants time a second pass over the same sample.
+    results = {}
+    for kind in kinds:
+        lines, cells = _micro_inputs(kind, seed)
+        mb = sum(len(line.encode('utf-8')) for line in lines) / 1e6
+        results[f'escape_latex/{kind}'] = {
+            'mb_per_s': mb / _best_time(lambda: [md2tex.escape_latex(line) for line in lines], repeat)}
+        results[f'process_inline/{kind}'] = {
+            'mb_per_s': mb / _best_time(lambda: [md2tex.process_inline(line) for line in lines], repeat,
+                                        _clear_inline_memos)}
+        if cells:
+            cell_mb = sum(len(cell.encode('utf-8')) for cell in cells) / 1e6
+            results[f'process_table_cell/{kind}'] = {
+                'mb_per_s': cell_mb / _best_time(lambda: [md2tex.process_table_cell(c) for c in cells], repeat,
+                                                 _clear_inline_memos)}
+            results[f'process_table_cell/{kind}/warm'] = {
+                'mb_per_s': cell_mb / _best_time(lambda: [md2tex.process_table_cell(c) for c in cells], repeat)}
+    _clear_inline_memos()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in kinds:
+            for size in sizes:
+                path = os.path.join(tmp, f'{kind}-{size}.md')
+                write_corpus(path, kind, size, seed)
+                mb = os.path.getsize(path) / 1e6
+                # Large inputs take long enough that one run is a stable measurement
+                runs = repeat if size <= 16 * 1024 * 1024 else 1
+                seconds = _best_time(lambda: _convert_file_stream(path), runs, _clear_inline_memos)
+                tracemalloc.start()
+                _convert_file_stream(path)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results[f'md_to_latex/{kind}/{_format_size(size)}'] = {
+                    'mb_per_s': mb / seconds, 'peak_mb': peak / 1e6}
+                os.remove(path)
+    return results
+
+
+def compare_results(baseline: dict, results: dict, threshold: float):
+    # Rows of (name, metric, baseline, current, change, regressed). Throughput may
+    # drop and peak memory grow by at most `threshold` (a fraction); memory also
+    # gets 1 MB of slack so tiny inputs do not trip on allocator noise.
+    rows = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if 'mb_per_s' in base:
+            change = current['mb_per_s'] / base['mb_per_s'] - 1
+            rows.append((name, 'MB/s', base['mb_per_s'], current['mb_per_s'], change, change < -threshold))
+        if 'peak_mb' in base and 'peak_mb' in current:
+            change = current['peak_mb'] / base['peak_mb'] - 1 if base['peak_mb'] else 0.0
+            regressed = current['peak_mb'] > base['peak_mb'] * (1 + threshold) + 1.0
+            rows.append((name, 'peak MB', base['peak_mb'], current['peak_mb'], change, regressed))
+    return rows
+
+
+def suite_main(args) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='bench.py suite')
+    parser.add_argument('--kinds', default=','.join(CORPUS_KINDS),
+                        help=f'comma-separated corpus kinds (default: all of {", ".join(CORPUS_KINDS)})')
+    parser.add_argument('--sizes', default='64K,1M', help='comma-separated document sizes, e.g. 64K,1M,200M')
+    parser.add_argument('--repeat', type=int, default=3, help='best-of-N timing (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE', help='write the results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against a saved baseline; exit 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed throughput drop / peak memory growth as a fraction (default: 0.10)')
+    opts = parser.parse_args(args)
+
+    kinds = [k for k in opts.kinds.split(',') if k]
+    unknown = [k for k in kinds if k not in CORPUS_KINDS]
+    if unknown:
+        parser.error(f'unknown corpus kind(s): {", ".join(unknown)}')
+    sizes = [_parse_size(s) for s in opts.sizes.split(',') if s]
+    results = run_suite(kinds, sizes, opts.repeat, opts.seed)
+
+    print(f'{"benchmark":<34}{"MB/s":>10}{"peak MB":>10}')
+    for name, values in results.items():
+        peak = f'{values["peak_mb"]:.2f}' if 'peak_mb' in values else ''
+        print(f'{name:<34}{values["mb_per_s"]:>10.2f}{peak:>10}')
+
+    if opts.save:
+        meta = {'python': sys.version.split()[0], 'platform': sys.platform, 'seed': opts.seed,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(opts.save, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {opts.save}')
+
+    if not opts.baseline:
+        return 0
+    with open(opts.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    rows = compare_results(baseline, results, opts.threshold)
+    print(f'\n{"benchmark":<34}{"metric":>9}{"baseline":>11}{"current":>11}{"change":>9}')
+    for name, metric, base, current, change, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{name:<34}{metric:>9}{base:>11.2f}{current:>11.2f}{change:>+9.1%}{flag}')
+    regressions = sum(row[-1] for row in rows)
+    print(f'{regressions} regression(s) beyond {opts.threshold:.0%} across {len(rows)} comparisons')
+    return 1 if regressions else 0
+
+
+# Adversarial inputs. Inline cases are one long line of a repeated unit (unclosed
+# math, bold, brackets and links, which a backtracking scan would make quadratic);
+# block cases are many lines (deep and sawtooth lists, wide tables, unclosed fences).
+# Every generator returns the lines of a document of about `size` bytes.
+
+def _one_line(unit: str):
+    return lambda rng, size: [unit * max(1, size // len(unit))]
+
+
+def _deep_list(rng, size):
+    lines, total, depth = [], 0, 0
+    while total < size:
+        depth = depth + 1 if depth < FUZZ_LIST_DEPTH else 0
+        line = '  ' * depth + ('- ' if depth % 2 else '1. ') + 'item'
+        lines.append(line)
+        total += len(line) + 1
+    return lines
+
+
+def _wide_table(rng, size):
+    cols = 500
+    lines = ['| h ' * cols + '|', '|---' * cols + '|']
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append('| **a** `b` $c$ ' * cols + '|')
+    return lines
+
+
+def _unclosed_fence(rng, size):
+    return ['```'] + ['code line with $ and ** and [' for _ in range(max(1, size // 31))]
+
+
+def _random_syntax(rng, size):
+    alphabet = ['$', '$$', '**', '*', '`', '[', ']', '(', ')', '](', '|', '#', '-', '  ', 'a', ' ', '\\', '_', 'α']
+    lines, total = [], 0
+    while total < size:
+        line = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 400)))
+        lines.append(line)
+        total += len(line) + 1
+    return lines
+
+
+FUZZ_CASES = {
+    'unclosed-dollar': _one_line('$a '),
+    'unclosed-bold': _one_line('**a '),
+    'open-brackets': _one_line('['),
+    'open-links': _one_line('[a]('),
+    'nested-links': _one_line('[[a]('),
+    'empty-links': _one_line('[a]()'),
+    'code-brackets': _one_line('`['),
+    'specials': _one_line('\\{}_^#&%~$'),
+    'symbols': _one_line('α→∑€\U0001F600'),
+    'pipes': _one_line('|'),
+    'deep-lists': _deep_list,
+    'wide-table': _wide_table,
+    'unclosed-fence': _unclosed_fence,
+    'random-syntax': _random_syntax,
+}
+# Deepest list the deep-lists case builds (sawtooth up to this level and back to 0)
+FUZZ_LIST_DEPTH = 64
+# Time for one input line of up to FUZZ_LINE_BYTES (the largest fuzz size is kept at that)
+FUZZ_LINE_BUDGET_MS = 100
+FUZZ_LINE_BYTES = 64 * 1024
+# Allowed time growth when the input grows 4x (linear is 4, quadratic 16)
+FUZZ_MAX_GROWTH = 8.0
+
+
+def run_fuzz(size: int = FUZZ_LINE_BYTES // 4, repeat: int = 3, seed: int = 0):
+    # Rows of (case, ms at size, ms at 4 * size, growth, slowest ms per line, ok)
+    rows = []
+    for name, generate in FUZZ_CASES.items():
+        times, per_line = [], 0.0
+        for n in (size, 4 * size):
+            text = '\n'.join(generate(random.Random(seed), n))
+            seconds = _best_time(lambda: md2tex.md_to_latex(text), repeat, _clear_inline_memos)
+            times.append(seconds)
+            per_line = seconds / (text.count('\n') + 1)
+        growth = times[1] / max(times[0], 1e-6)
+        ok = growth <= FUZZ_MAX_GROWTH and per_line * 1000 <= FUZZ_LINE_BUDGET_MS
+        rows.append((name, times[0] * 1000, times[1] * 1000, growth, per_line * 1000, ok))
+    return rows
+
+
+def check_limits(seconds: float = 0.2):
+    # A conversion over its time limit must stop promptly: returns the time it took to fail
+    text = '\n'.join(['word **bold** `code` [link](url) $x$'] * 2_000_000)
+    start = time.perf_counter()
+    try:
+        md2tex.md_to_latex(text, limits=md2tex.ConversionLimits(max_seconds=seconds))
+    except md2tex.ConversionLimitError:
+        return time.perf_counter() - start
+    return None
+
+
+def fuzz_main(args) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='bench.py fuzz')
+    parser.add_argument('--size', default=_format_size(FUZZ_LINE_BYTES // 4),
+                        help='smaller input size; each case also runs at 4x (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='best-of-N timing (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args(args)
+
+    rows = run_fuzz(_parse_size(opts.size), opts.repeat, opts.seed)
+    print(f'{"case":<18}{"ms":>10}{"ms @4x":>10}{"growth":>9}{"ms/line":>10}')
+    failed = 0
+    for name, small_ms, large_ms, growth, line_ms, ok in rows:
+        failed += not ok
+        print(f'{name:<18}{small_ms:>10.2f}{large_ms:>10.2f}{growth:>8.1f}x{line_ms:>10.3f}{"" if ok else "  FAIL"}')
+    stopped = check_limits()
+    limit_ok = stopped is not None and stopped < 0.2 + FUZZ_LINE_BUDGET_MS / 1000
+    failed += not limit_ok
+    print(f'time limit 0.2 s: ' + (f'stopped after {stopped:.2f} s' if stopped is not None else 'did not stop')
+          + ('' if limit_ok else '  FAIL'))
+    print(f'{failed} failure(s); growth limit {FUZZ_MAX_GROWTH:g}x per 4x input, '
+          f'{FUZZ_LINE_BUDGET_MS} ms per line of up to {_format_size(FUZZ_LINE_BYTES)}')
+    return 1 if failed else 0
+
+
+# Regression checks for behaviour that broke once. Each returns a list of failures.
+
+def check_server_files() -> list:
+    # A conversion server must not read or write files outside its root: CSV
+    # directives in snippets and "input" paths are refused without a root, and
+    # confined to it with one
+    import asyncio
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'docs'))
+        with open(os.path.join(tmp, 'docs', 'table.csv'), 'w', encoding='utf-8') as f:
+            f.write('a,b\n1,2\n')
+        with open(os.path.join(tmp, 'docs', 'guide.md'), 'w', encoding='utf-8') as f:
+            f.write('# Guide\n\n<!-- md2tex:csv table.csv -->\n')
+        cases = (
+            (None, {'markdown': 'hi\n<!-- md2tex:csv /etc/passwd -->\n'}, False),
+            (None, {'markdown': '<!-- md2tex:csv docs/table.csv -->'}, False),
+            (None, {'input': '/etc/hostname'}, False),
+            (None, {'input': 'docs/guide.md'}, False),
+            (tmp, {'markdown': '<!-- md2tex:csv /etc/passwd -->'}, False),
+            (tmp, {'markdown': '<!-- md2tex:csv docs/../../etc/passwd -->'}, False),
+            (tmp, {'input': '/etc/hostname'}, False),
+            (tmp, {'input': '../' + os.path.basename(tmp) + '/docs/guide.md'}, False),
+            (tmp, {'markdown': '<!-- md2tex:csv docs/table.csv -->'}, True),
+            (tmp, {'input': 'docs/guide.md'}, True),
+        )
+        for root, request, allowed in cases:
+            server = md2tex.ConversionServer(work_dir=tmp, root=root)
+            try:
+                reply = asyncio.run(server.handle(dict(request, op='convert')))
+            finally:
+                server.close()
+            if reply['ok'] != allowed:
+                failures.append(f'root={root!r} {request}: {"refused" if allowed else "allowed"}')
+            elif allowed and 'latex' in reply and '1 & 2' not in reply['latex']:
+                failures.append(f'root={root!r} {request}: CSV table missing')
+        if os.path.exists('/etc/hostname.tex'):
+            failures.append('/etc/hostname.tex was written')
+    return failures
+
+FAKE_ENGINE = """#!/bin/sh
+[ "$1" = --version ] && { echo 'fakeTeX 1'; exit 0; }
+for a; do f=$a; case "$a" in -output-directory=*) out=${a#-output-directory=};; esac; done
+grep -q FAIL "$f" && { echo '! LaTeX Error: boom'; exit 1; }
+echo '\\relax' > "$out/${f%.tex}.aux"
+cat "$f" > "$out/${f%.tex}.pdf"
+"""
+
+
+@contextlib.contextmanager
+def _fake_engine(script: str = FAKE_ENGINE):
+    # (temporary directory, path of a shell-script engine in it), with md2tex's cache
+    # and build directories moved into it for the duration
+    saved = {name: os.environ.get(name) for name in ('MD2TEX_CACHE_DIR', 'MD2TEX_BUILD_DIR')}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['MD2TEX_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        os.environ['MD2TEX_BUILD_DIR'] = os.path.join(tmp, 'build')
+        try:
+            engine = os.path.join(tmp, 'fakelatex')
+            with open(engine, 'w') as f:
+                f.write(script)
+            os.chmod(engine, 0o755)
+            yield tmp, engine
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def check_compile_cache() -> list:
+    # A failing compile must not store anything in the PDF cache, even with the
+    # PDF of an earlier build still in the build directory and next to the .tex
+    if os.name != 'posix':
+        return []
+    failures = []
+    with _fake_engine() as (tmp, engine):
+        tex_file = os.path.join(tmp, 'doc.tex')
+
+        def compile_text(text):
+            with open(tex_file, 'w') as f:
+                f.write(text)
+            return md2tex.compile_pdf_cached(tex_file, 'fakelatex', engine)
+
+        def stored():
+            return sorted(name for _, _, names in os.walk(md2tex._cache_dir('pdf')) for name in names)
+
+        pdf_file, _, status = compile_text('good\n')
+        if not pdf_file or status != 'compiled' or len(stored()) != 1:
+            failures.append(f'good compile: pdf={pdf_file!r} status={status} stored={stored()}')
+        before = stored()
+        pdf_file, output, status = compile_text('FAIL\n')
+        if pdf_file is not None:
+            failures.append(f'failing compile returned {pdf_file!r}')
+        if stored() != before:
+            failures.append(f'failing compile populated the cache: {stored()}')
+        pdf_file, _, status = compile_text('FAIL\n')
+        if pdf_file is not None or status != 'compiled':
+            failures.append(f'failing compile restored from the cache: {pdf_file!r} {status}')
+    return failures
+
+
+def check_converter_pickle() -> list:
+    # Documents parsed and rendered by a Converter with a unicode_map still pickle,
+    # and render the same after the round trip
+    import pickle
+
+    failures = []
+    converter = md2tex.Converter(unicode_map={'\u00e9': "\\'e"})
+    text = '# Caf\u00e9\n\nA *caf\u00e9* here.\n\nA *caf\u00e9* here.\n\n| a | b |\n|---|---|\n| \u00e9 | 2 |\n' * 4
+    document = converter.parse(text)
+    expected = converter.render(document)
+    for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+        try:
+            restored = pickle.loads(pickle.dumps(document, protocol))
+        except Exception as e:
+            failures.append(f'protocol {protocol}: {type(e).__name__}: {e}')
+            continue
+        if converter.render(restored) != expected:
+            failures.append(f'protocol {protocol}: render differs after the round trip')
+    return failures
+
+
+def check_engine_sandbox() -> list:
+    # Every engine run has shell escape off and kpathsea's paranoid file access on,
+    # and HTTP serving stays on loopback hosts unless made public
+    failures = []
+    if os.name == 'posix':
+        script = FAKE_ENGINE.replace('for a;', 'echo "$openin_any $openout_any $*" > "$0.seen"\nfor a;', 1)
+        with _fake_engine(script) as (tmp, engine):
+            tex_file = os.path.join(tmp, 'doc.tex')
+            with open(tex_file, 'w') as f:
+                f.write('good\n')
+            md2tex.compile_pdf(tex_file, engine)
+            with open(engine + '.seen') as f:
+                seen = f.read().split()
+            if seen[:2] != ['p', 'p'] or '-no-shell-escape' not in seen:
+                failures.append(f'engine run without restrictions: {" ".join(seen)}')
+    for address, public, allowed in (('8808', False, True), ('[::1]:8808', False, True),
+                                     ('localhost:8808', False, True), ('0.0.0.0:8808', False, False),
+                                     ('192.0.2.1:8808', False, False), ('0.0.0.0:8808', True, True)):
+        try:
+            md2tex._parse_serve_address(address, public)
+            ok = True
+        except PermissionError:
+            ok = False
+        if ok != allowed:
+            failures.append(f'serve address {address!r} (public={public}): {"allowed" if ok else "refused"}')
+    return failures
+
+
+CHECKS = {
+    'server-files': check_server_files,
+    'compile-cache': check_compile_cache,
+    'converter-pickle': check_converter_pickle,
+    'engine-sandbox': check_engine_sandbox,
+}
+
+
+def checks_main(args) -> int:
+    names = args or list(CHECKS)
+    failed = 0
+    for name in names:
+        if name not in CHECKS:
+            print(f'unknown check {name!r}; expected one of {", ".join(CHECKS)}')
+            return 2
+        failures = CHECKS[name]()
+        failed += bool(failures)
+        print(f'{"✗" if failures else "✓"} {name}')
+        for failure in failures:
+            print(f'  {failure}')
+    return 1 if failed else 0
+
+
+def main(argv):
+    args = argv[1:]
+    command = args.pop(0) if args and not args[0].isdigit() else 'escape'
+    if command == 'startup':
+        runs = int(args[0]) if args else 15
+        bare_ms, total_ms = bench_startup(runs)
+        overhead = total_ms - bare_ms
+        print(f'interpreter {bare_ms:.1f} ms, md2tex CLI {total_ms:.1f} ms, '
+              f'overhead {overhead:.1f} ms (budget {STARTUP_BUDGET_MS} ms)')
+        return 1 if overhead > STARTUP_BUDGET_MS else 0
+    if command == 'suite':
+        return suite_main(args)
+    if command == 'fuzz':
+        return fuzz_main(args)
+    if command == 'corpus':
+        if len(args) != 3 or args[0] not in CORPUS_KINDS:
+            print(f'usage: python bench.py corpus {{{",".join(CORPUS_KINDS)}}} SIZE OUT')
+            return 2
+        write_corpus(args[2], args[0], _parse_size(args[1]))
+        return 0
+    if command == 'converter':
+        threads = int(args[0]) if args else 4
+        identical, rows = check_converter(max(2, threads))
+        for workers, p50, p99 in rows:
+            print(f'{workers} thread(s): p50 {p50:.2f} ms, p99 {p99:.2f} ms per '
+                  f'{_format_size(CONVERTER_DOC_BYTES)} document')
+        print(f'output {"identical" if identical else "DIFFERS"}')
+        return 0 if identical else 1
+    if command == 'checks':
+        return checks_main(args)
+    if command == 'sections':
+        size = _parse_size(args[0]) if args else 32 * 1024 * 1024
+        identical, timings, section_bytes = check_sections(size)
+        # The timed section holds one sixteenth of the corpus, not just a heading
+        sized = section_bytes >= size // 16
+        print(f'{_format_size(size)} document, 16 sections: '
+              + ', '.join(f'{name} {seconds:.2f} s' for name, seconds in timings.items()))
+        print(f'timed section {section_bytes / 1024 ** 2:.1f} MiB'
+              + ('' if sized else f', expected at least {_format_size(size // 16)}'))
+        print(f'README.md sections {"identical" if identical else "DIFFER"} to Document.section')
+        return 0 if identical and sized else 1
+    if command == 'parallel':
+        jobs = int(args[0]) if args else os.cpu_count() or 1
+        identical, lines, serial_s, parallel_s = check_parallel(max(2, jobs))
+        print(f'{lines} lines: serial {serial_s:.2f} s, {max(2, jobs)} jobs {parallel_s:.2f} s '
+              f'({serial_s / parallel_s:.1f}x), output {"identical" if identical else "DIFFERS"}')
+        return 0 if identical else 1
+
+    repeat = int(args[0]) if args else 5
+    print(f'{"escape_latex input":<20}{"chars":>8}{"legacy us":>12}{"current us":>12}{"speedup":>10}')
+    for name, size, old_us, new_us in bench_escape(repeat):
+        print(f'{name:<20}{size:>8}{old_us:>12.2f}{new_us:>12.2f}{old_us / new_us:>9.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
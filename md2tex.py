@@ -1,155 +1,465 @@
 import re
 import sys
 import os
+import _thread
 
 # Remove emoji/sticker characters by Unicode ranges (flags, emoticons, pictographs, dingbats, etc.)
-EMOJI_RE = re.compile('[\U0001F1E6-\U0001F1FF'  # Flags
-                      '\U0001F300-\U0001F5FF'   # Misc Symbols & Pictographs
-                      '\U0001F600-\U0001F64F'   # Emoticons
-                      '\U0001F680-\U0001F6FF'   # Transport & Map
-                      '\U0001F700-\U0001F77F'   # Alchemical Symbols
-                      '\U0001F780-\U0001F7FF'   # Geometric Shapes Extended
-                      '\U0001F800-\U0001F8FF'   # Supplemental Arrows-C
-                      '\U0001F900-\U0001F9FF'   # Supplemental Symbols & Pictographs
-                      '\U0001FA00-\U0001FA6F'   # Symbols & Pictographs (part)
-                      '\U0001FA70-\U0001FAFF'   # Symbols & Pictographs Extended-A
-                      '\U00002600-\U000026FF'   # Misc Symbols
-                      '\U00002700-\U000027BF'   # Dingbats
-                      '\U0001F3FB-\U0001F3FF'   # Skin tone modifiers
-                      '\U0000200D'              # Zero Width Joiner
-                      '\U0000FE0F]')            # Variation Selector-16
+EMOJI_RANGES = (
+    (0x1F1E6, 0x1F1FF),  # Flags
+    (0x1F300, 0x1F5FF),  # Misc Symbols & Pictographs
+    (0x1F600, 0x1F64F),  # Emoticons
+    (0x1F680, 0x1F6FF),  # Transport & Map
+    (0x1F700, 0x1F77F),  # Alchemical Symbols
+    (0x1F780, 0x1F7FF),  # Geometric Shapes Extended
+    (0x1F800, 0x1F8FF),  # Supplemental Arrows-C
+    (0x1F900, 0x1F9FF),  # Supplemental Symbols & Pictographs
+    (0x1FA00, 0x1FA6F),  # Symbols & Pictographs (part)
+    (0x1FA70, 0x1FAFF),  # Symbols & Pictographs Extended-A
+    (0x02600, 0x026FF),  # Misc Symbols
+    (0x02700, 0x027BF),  # Dingbats
+    (0x1F3FB, 0x1F3FF),  # Skin tone modifiers
+    (0x0200D, 0x0200D),  # Zero Width Joiner
+    (0x0FE0F, 0x0FE0F),  # Variation Selector-16
+)
+EMOJI_RE = re.compile('[' + ''.join(f'{chr(lo)}-{chr(hi)}' for lo, hi in EMOJI_RANGES) + ']')
 
 def _strip_emojis(text: str) -> str:
     return EMOJI_RE.sub('', text)
 
+# LaTeX special characters in regular text
+LATEX_SPECIALS = {
+    '\\': '\\textbackslash{}',
+    '&': '\\&', '%': '\\%', '$': '\\$', '#': '\\#', '_': '\\_',
+    '{': '\\{', '}': '\\}',
+    '~': '\\textasciitilde{}', '^': '\\textasciicircum{}',
+}
+
+# Unicode symbols without a reliable pdfLaTeX glyph, mapped to LaTeX markup
+UNICODE_MAP = {
+    '—': '---', '–': '--',
+    'α': r'$\alpha$', 'β': r'$\beta$', 'γ': r'$\gamma$', 
+    'δ': r'$\delta$', 'ε': r'$\varepsilon$', 'ζ': r'$\zeta$',
+    'η': r'$\eta$', 'θ': r'$\theta$', 'λ': r'$\lambda$',
+    'μ': r'$\mu$', 'π': r'$\pi$', 'σ': r'$\sigma$',
+    'τ': r'$\tau$', 'φ': r'$\varphi$', 'ω': r'$\omega$',
+    'Γ': r'$\Gamma$', 'Δ': r'$\Delta$', 'Θ': r'$\Theta$',
+    'Λ': r'$\Lambda$', 'Ξ': r'$\Xi$', 'Π': r'$\Pi$',
+    'Σ': r'$\Sigma$', 'Φ': r'$\Phi$', 'Ψ': r'$\Psi$',
+    'Ω': r'$\Omega$', 'ν': r'$\nu$',
+    '±': r'$\pm$', '∓': r'$\mp$', '×': r'$\times$', 
+    '÷': r'$\div$', '√': r'$\sqrt{}$', '∞': r'$\infty$', 
+    '≈': r'$\approx$', '≠': r'$\neq$', '≤': r'$\leq$', 
+    '≥': r'$\geq$', '≡': r'$\equiv$', '∝': r'$\propto$',
+    '∫': r'$\int$', '∑': r'$\sum$', '∏': r'$\prod$',
+    '∂': r'$\partial$', '∇': r'$\nabla$', '∮': r'$\oint$',
+    '∛': r'$\sqrt[3]{}$', '∜': r'$\sqrt[4]{}$', '∆': r'$\Delta$',
+    '→': r'$\rightarrow$', '←': r'$\leftarrow$',
+    '↑': r'$\uparrow$', '↓': r'$\downarrow$',
+    '↔': r'$\leftrightarrow$', '⇒': r'$\Rightarrow$',
+    '⇐': r'$\Leftarrow$', '⇔': r'$\Leftrightarrow$',
+    '∩': r'$\cap$', '∪': r'$\cup$',
+    '⊂': r'$\subset$', '⊃': r'$\supset$',
+    '⊆': r'$\subseteq$', '⊇': r'$\supseteq$',
+    '∈': r'$\in$', '∉': r'$\notin$',
+    '°': r'$^\circ$', '∙': r'$\cdot$', '⋅': r'$\cdot$',
+    '©': r'\textcopyright{}', '®': r'\textregistered{}',
+    '™': r'\texttrademark{}',
+    '€': r'\texteuro{}', '£': r'\pounds{}', 
+    '¥': r'\textyen{}', '¢': r'\textcent{}',
+    '§': r'\S{}', '¶': r'\P{}',
+    '†': r'\dag{}', '‡': r'\ddag{}',
+    '•': r'\textbullet{}', '‰': r'\textperthousand{}',
+    '′': r'$\prime$', '″': r'$\prime\prime$', 
+    '‴': r'$\prime\prime\prime$',
+    '⁰': r'$^0$', '¹': r'$^1$', '²': r'$^2$', '³': r'$^3$',
+    '⁴': r'$^4$', '⁵': r'$^5$', '⁶': r'$^6$', '⁷': r'$^7$',
+    '⁸': r'$^8$', '⁹': r'$^9$', '⁻': r'$^-$',
+}
+
+def _build_translation(unicode_map) -> dict:
+    # One str.translate table: drop emojis, escape specials, map Unicode symbols.
+    # Every replacement is plain ASCII, so a single scan is equivalent to
+    # stripping, escaping and mapping in separate passes.
+    table = {cp: None for lo, hi in EMOJI_RANGES for cp in range(lo, hi + 1)}
+    table.update({ord(ch): rep for ch, rep in LATEX_SPECIALS.items()})
+    table.update({ord(ch): rep for ch, rep in unicode_map.items()})
+    return table
+
+_LATEX_TRANSLATION = _build_translation(UNICODE_MAP)
+# Pure-ASCII text (the common case) only needs the specials; a C-level regex scan
+# beats walking the translation table character by character
+_ASCII_SPECIAL_RE = re.compile(r'[\\&%$#_{}~^]')
+
+def _escape_special(match) -> str:
+    return LATEX_SPECIALS[match.group()]
+
 def escape_latex(text):
     if not text:
         return ''
     text = str(text)
-    # Remove all emoji/sticker characters early
-    text = _strip_emojis(text)
-    
-    text = text.replace('\\', ' BACKSLASHTEMP ')
-    text = text.replace('&', '\\&')
-    text = text.replace('%', '\\%')
-    text = text.replace('$', '\\$')
-    text = text.replace('#', '\\#')
-    text = text.replace('_', '\\_')
-    text = text.replace('{', '\\{')
-    text = text.replace('}', '\\}')
-    text = text.replace('~', '\\textasciitilde{}')
-    text = text.replace('^', '\\textasciicircum{}')
-    text = text.replace(' BACKSLASHTEMP ', '\\textbackslash{}')
-    
-    unicode_map = {
-        '—': '---', '–': '--',
-        'α': r'$\alpha$', 'β': r'$\beta$', 'γ': r'$\gamma$', 
-        'δ': r'$\delta$', 'ε': r'$\varepsilon$', 'ζ': r'$\zeta$',
-        'η': r'$\eta$', 'θ': r'$\theta$', 'λ': r'$\lambda$',
-        'μ': r'$\mu$', 'π': r'$\pi$', 'σ': r'$\sigma$',
-        'τ': r'$\tau$', 'φ': r'$\varphi$', 'ω': r'$\omega$',
-        'Γ': r'$\Gamma$', 'Δ': r'$\Delta$', 'Θ': r'$\Theta$',
-        'Λ': r'$\Lambda$', 'Ξ': r'$\Xi$', 'Π': r'$\Pi$',
-        'Σ': r'$\Sigma$', 'Φ': r'$\Phi$', 'Ψ': r'$\Psi$',
-        'Ω': r'$\Omega$', 'ν': r'$\nu$',
-        '±': r'$\pm$', '∓': r'$\mp$', '×': r'$\times$', 
-        '÷': r'$\div$', '√': r'$\sqrt{}$', '∞': r'$\infty$', 
-        '≈': r'$\approx$', '≠': r'$\neq$', '≤': r'$\leq$', 
-        '≥': r'$\geq$', '≡': r'$\equiv$', '∝': r'$\propto$',
-        '∫': r'$\int$', '∑': r'$\sum$', '∏': r'$\prod$',
-        '∂': r'$\partial$', '∇': r'$\nabla$', '∮': r'$\oint$',
-        '∛': r'$\sqrt[3]{}$', '∜': r'$\sqrt[4]{}$', '∆': r'$\Delta$',
-        '→': r'$\rightarrow$', '←': r'$\leftarrow$',
-        '↑': r'$\uparrow$', '↓': r'$\downarrow$',
-        '↔': r'$\leftrightarrow$', '⇒': r'$\Rightarrow$',
-        '⇐': r'$\Leftarrow$', '⇔': r'$\Leftrightarrow$',
-        '∩': r'$\cap$', '∪': r'$\cup$',
-        '⊂': r'$\subset$', '⊃': r'$\supset$',
-        '⊆': r'$\subseteq$', '⊇': r'$\supseteq$',
-        '∈': r'$\in$', '∉': r'$\notin$',
-        '°': r'$^\circ$', '∙': r'$\cdot$', '⋅': r'$\cdot$',
-        '©': r'\textcopyright{}', '®': r'\textregistered{}',
-        '™': r'\texttrademark{}',
-        '€': r'\texteuro{}', '£': r'\pounds{}', 
-        '¥': r'\textyen{}', '¢': r'\textcent{}',
-        '§': r'\S{}', '¶': r'\P{}',
-        '†': r'\dag{}', '‡': r'\ddag{}',
-        '•': r'\textbullet{}', '‰': r'\textperthousand{}',
-        '′': r'$\prime$', '″': r'$\prime\prime$', 
-        '‴': r'$\prime\prime\prime$',
-        '⁰': r'$^0$', '¹': r'$^1$', '²': r'$^2$', '³': r'$^3$',
-        '⁴': r'$^4$', '⁵': r'$^5$', '⁶': r'$^6$', '⁷': r'$^7$',
-        '⁸': r'$^8$', '⁹': r'$^9$', '⁻': r'$^-$',
-    }
-    
-    for char, replacement in unicode_map.items():
-        text = text.replace(char, replacement)
-    
-    return text
+    if text.isascii():
+        return _ASCII_SPECIAL_RE.sub(_escape_special, text)
+    return text.translate(_LATEX_TRANSLATION)
 
-def process_inline(text):
-    if not text:
-        return ''
-    # Protect double-dollar text to render literally (e.g., $$block$$)
-    dd_tokens = []
-    def _protect_dd(m):
-        dd_tokens.append(m.group(1))
-        return f"DDTOKEN{len(dd_tokens)-1}"
-    text = re.sub(r"\$\$([^$]+)\$\$", _protect_dd, text)
+def _make_escape(unicode_map: dict):
+    # escape_latex with unicode_map in place of UNICODE_MAP
+    translation = _build_translation(unicode_map)
 
-    parts = []
-    current = 0
-    
-    while current < len(text):
-        dollar_match = re.search(r'\$([^\$]+)\$', text[current:])
-        
-        if dollar_match:
-            before_match = text[current:current + dollar_match.start()]
-            before_match = _process_formats(before_match)
-            parts.append(before_match)
-            parts.append('$' + dollar_match.group(1) + '$')
-            current = current + dollar_match.end()
-        else:
-            remaining = text[current:]
-            remaining = _process_formats(remaining)
-            parts.append(remaining)
-            break
-    
-    out = ''.join(parts)
-    # Restore protected $$...$$ as literal text with escaped dollars
-    for i, val in enumerate(dd_tokens):
-        out = out.replace(f"DDTOKEN{i}", f"\\$\\${escape_latex(val)}\\$\\$")
-    return out
-
-def _process_formats(text):
-    result = []
+    def escape(text):
+        if not text:
+            return ''
+        text = str(text)
+        if text.isascii():
+            return _ASCII_SPECIAL_RE.sub(_escape_special, text)
+        return text.translate(translation)
+    return escape
+
+# Characters escaped inside inline code (\texttt keeps '~' and Unicode as-is)
+CODE_SPECIALS = {
+    '\\': '\\textbackslash{}', '{': '\\{', '}': '\\}',
+    '_': '\\_', '^': '\\textasciicircum{}',
+    '#': '\\#', '&': '\\&', '%': '\\%', '$': '\\$',
+}
+_CODE_TRANSLATION = {cp: None for lo, hi in EMOJI_RANGES for cp in range(lo, hi + 1)}
+_CODE_TRANSLATION.update({ord(ch): rep for ch, rep in CODE_SPECIALS.items()})
+_ASCII_CODE_SPECIAL_RE = re.compile(r'[\\{}_^#&%$]')
+
+def _escape_code_special(match) -> str:
+    return CODE_SPECIALS[match.group()]
+
+def _escape_code(code: str) -> str:
+    if code.isascii():
+        return _ASCII_CODE_SPECIAL_RE.sub(_escape_code_special, code)
+    return code.translate(_CODE_TRANSLATION)
+
+# Inline syntax other than links in one alternation so a line is tokenized in a single
+# left-to-right scan: $$literal$$ | $math$ | `code` | **bold**. Links ([text](url))
+# are found with str.find (see _find_link), which stays linear on unmatched brackets.
+INLINE_RE = re.compile(
+    r'\$\$([^$]+)\$\$'
+    r'|\$([^$]+)\$'
+    r'|`([^`]+)`'
+    r'|\*\*([^*]+)\*\*'
+)
+
+class Node:
+    # Base for document nodes. Nodes are compared and printed via to_data(), the
+    # JSON-friendly form used by Document.to_json().
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_data() == other.to_data()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_data()!r})'
+
+# Inline nodes: latex() renders the node, escaping text with escape (escape_latex
+# unless a Converter has its own Unicode map); plain text serializes as a bare
+# string, everything else as [tag, ...]
+
+class Text(Node):
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def latex(self, escape=escape_latex) -> str:
+        return escape(self.text)
+
+    def to_data(self):
+        return self.text
+
+class LiteralMath(Node):
+    # $$...$$ inside running text stays literal
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def latex(self, escape=escape_latex) -> str:
+        return '\\$\\$' + escape(self.text) + '\\$\\$'
+
+    def to_data(self):
+        return ['$$', self.text]
+
+class Math(Node):
+    __slots__ = ('tex',)
+
+    def __init__(self, tex: str):
+        self.tex = tex
+
+    def latex(self, escape=escape_latex) -> str:
+        return '$' + self.tex + '$'
+
+    def to_data(self):
+        return ['$', self.tex]
+
+class Code(Node):
+    __slots__ = ('code',)
+
+    def __init__(self, code: str):
+        self.code = code
+
+    def latex(self, escape=escape_latex) -> str:
+        return '\\texttt{' + _escape_code(self.code) + '}'
+
+    def to_data(self):
+        return ['`', self.code]
+
+class Bold(Node):
+    # Bold text may contain math, code or links
+    __slots__ = ('children',)
+
+    def __init__(self, children: list):
+        self.children = children
+
+    def latex(self, escape=escape_latex) -> str:
+        return '\\textbf{' + render_inline(self.children, escape) + '}'
+
+    def to_data(self):
+        return ['**', [child.to_data() for child in self.children]]
+
+class Link(Node):
+    __slots__ = ('text', 'url')
+
+    def __init__(self, text: str, url: str):
+        self.text = text
+        self.url = url
+
+    def latex(self, escape=escape_latex) -> str:
+        return '\\href{' + self.url + '}{' + escape(self.text) + '}'
+
+    def to_data(self):
+        return ['a', self.text, self.url]
+
+def _inline_match_node(match) -> Node:
+    kind = match.lastindex
+    if kind == 1:
+        return LiteralMath(match.group(1))
+    if kind == 2:
+        return Math(match.group(2))
+    if kind == 3:
+        return Code(match.group(3))
+    return Bold(parse_inline(match.group(4)))
+
+def _find_link(text: str, pos: int):
+    # (start, end, label, url) of the first [label](url) at or after pos, or None.
+    # A '[' can only pair with the first ']' after it, so when that ']' is not
+    # followed by a valid (url), no '[' before it can start a link either; and
+    # without any ']' or ')' left, no later link is possible. Each character is
+    # looked at a bounded number of times.
+    find = text.find
+    while True:
+        start = find('[', pos)
+        if start < 0:
+            return None
+        close = find(']', start + 1)
+        if close < 0:
+            return None
+        if close > start + 1 and text.startswith('(', close + 1):
+            end = find(')', close + 2)
+            if end < 0:
+                return None
+            if end > close + 2:
+                return start, end + 1, text[start + 1:close], text[close + 2:end]
+        pos = close + 1
+
+def parse_inline(text: str, nodes: list = None) -> list:
+    # Inline nodes for one line of Markdown text (appended to nodes when given)
+    if nodes is None:
+        nodes = []
+    if '](' in text:
+        return _parse_inline_links(text, nodes)
     pos = 0
-    
-    for match in re.finditer(r'`([^`]+)`|\*\*([^\*]+)\*\*|\[([^\]]+)\]\(([^\)]+)\)', text):
-        result.append(escape_latex(text[pos:match.start()]))
-        
-        if match.group(1):  # code
-            code = _strip_emojis(match.group(1))
-            code = code.replace('\\', 'BACKSLASHTEMP')
-            code = code.replace('{', '\\{')
-            code = code.replace('}', '\\}')
-            code = code.replace('BACKSLASHTEMP', '\\textbackslash{}')
-            code = code.replace('_', '\\_')
-            code = code.replace('^', '\\textasciicircum{}')
-            code = code.replace('#', '\\#')
-            code = code.replace('&', '\\&')
-            code = code.replace('%', '\\%')
-            code = code.replace('$', '\\$')
-            result.append('\\texttt{' + code + '}')
-        elif match.group(2):  # bold
-            result.append('\\textbf{' + escape_latex(match.group(2)) + '}')
-        elif match.group(3):  # link
-            result.append('\\href{' + match.group(4) + '}{' + escape_latex(match.group(3)) + '}')
-        
+    for match in INLINE_RE.finditer(text):
+        start = match.start()
+        if start > pos:
+            nodes.append(Text(text[pos:start]))
+        nodes.append(_inline_match_node(match))
         pos = match.end()
-    
-    result.append(escape_latex(text[pos:]))
-    return ''.join(result)
+    if pos < len(text):
+        nodes.append(Text(text[pos:]))
+    return nodes
+
+def _parse_inline_links(text: str, nodes: list) -> list:
+    # parse_inline for text that may hold links: the earlier of the next INLINE_RE
+    # match and the next link wins, as if links were one more alternative. Both
+    # lookaheads are only redone once the scan has moved past their start.
+    pos = 0
+    match = INLINE_RE.search(text)
+    link = _find_link(text, 0)
+    while match is not None or link is not None:
+        if link is not None and (match is None or link[0] < match.start()):
+            start, end = link[0], link[1]
+            node = Link(link[2], link[3])
+        else:
+            start, end = match.span()
+            node = _inline_match_node(match)
+        if start > pos:
+            nodes.append(Text(text[pos:start]))
+        nodes.append(node)
+        pos = end
+        if match is not None and match.start() < pos:
+            match = INLINE_RE.search(text, pos)
+        if link is not None and link[0] < pos:
+            link = _find_link(text, pos)
+    if pos < len(text):
+        nodes.append(Text(text[pos:]))
+    return nodes
+
+def render_inline(nodes, escape=escape_latex) -> str:
+    if type(nodes) is InlineNodes:
+        # Shared through an InlineMemo: rendered once, then reused
+        cached = nodes.latex
+        if cached is not None and cached[0] is escape:
+            return cached[1]
+        latex = ''.join([node.latex(escape) for node in nodes])
+        nodes.latex = (escape, latex)
+        return latex
+    if len(nodes) == 1:
+        return nodes[0].latex(escape)
+    return ''.join([node.latex(escape) for node in nodes])
+
+class InlineNodes(list):
+    # Inline node list held by an InlineMemo, with its LaTeX once rendered: latex is
+    # None on creation, then (escape function, LaTeX), replaced in one assignment so
+    # that concurrent renders never see a mismatched pair. Shared between every block
+    # with the same text, so never modified. The rendered LaTeX is not pickled (its
+    # escape function may be a Converter's closure); it is rebuilt on first render.
+    __slots__ = ('latex',)
+
+    def __getstate__(self):
+        return None, {'latex': None}
+
+# Size bound of each inline memo, the longest text worth memoizing, the estimated
+# fixed cost of an entry, and how many first-seen texts are remembered for admission
+INLINE_MEMO_BYTES = 8 * 1024 * 1024
+INLINE_MEMO_MAX_CHARS = 200
+INLINE_MEMO_ENTRY_BYTES = 320
+INLINE_MEMO_SEEN = 1 << 15
+
+class InlineMemo:
+    # Bounded LRU memo of inline Markdown text -> parsed InlineNodes (whose LaTeX is
+    # kept after the first render_inline). Parsing and rendering depend on nothing but
+    # the text (and the escape function, which the cached LaTeX records), so one memo
+    # serves every document in the process: batch workers, the server and repeated
+    # conversions. Texts longer than max_chars bypass the memo,
+    # and a text is only stored once it has been seen before, so documents of unique
+    # lines pay a set lookup per line rather than an entry each. Entry sizes are
+    # estimates. Safe to use from several threads (the counters are exact when the
+    # memo is used from one).
+
+    def __init__(self, max_bytes: int = INLINE_MEMO_BYTES, max_chars: int = INLINE_MEMO_MAX_CHARS):
+        from collections import OrderedDict
+
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._seen = set()
+        self._lock = _thread.allocate_lock()
+
+    def nodes(self, text: str) -> list:
+        # Inline nodes for text, shared with earlier calls for the same text
+        if len(text) > self.max_chars or self.max_bytes <= 0:
+            return parse_inline(text)
+        entries = self._entries
+        if text not in entries:
+            self.misses += 1
+            seen = self._seen
+            key = hash(text)
+            if key not in seen:
+                # First sighting: remember the text's hash, but do not store it yet
+                if len(seen) >= INLINE_MEMO_SEEN:
+                    seen.clear()
+                seen.add(key)
+                return parse_inline(text)
+        with self._lock:
+            nodes = entries.get(text)
+            if nodes is not None:
+                entries.move_to_end(text)
+                self.hits += 1
+                return nodes
+            nodes = InlineNodes()
+            nodes.latex = None
+            parse_inline(text, nodes)
+            entries[text] = nodes
+            # Key, nodes and rendered LaTeX, roughly
+            self.bytes += 3 * len(text) + INLINE_MEMO_ENTRY_BYTES
+            if self.bytes > self.max_bytes:
+                self._evict()
+        return nodes
+
+    def render(self, text: str) -> str:
+        return render_inline(self.nodes(text)) if text else ''
+
+    def _evict(self):
+        entries = self._entries
+        while self.bytes > self.max_bytes and entries:
+            text, _ = entries.popitem(last=False)
+            self.bytes -= 3 * len(text) + INLINE_MEMO_ENTRY_BYTES
+            self.evictions += 1
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._seen.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+            }
+
+# Process-wide memos for running text (paragraphs, list items, headings) and table cells
+_INLINE_MEMO = InlineMemo()
+_CELL_MEMO = InlineMemo()
+
+def set_inline_memo_size(max_bytes: int):
+    # Capacity of each inline memo in bytes; 0 turns memoization off
+    _INLINE_MEMO.resize(max_bytes)
+    _CELL_MEMO.resize(max_bytes)
+
+def inline_memo_stats() -> dict:
+    # {'inline': stats, 'cells': stats}, each as InlineMemo.stats()
+    return {'inline': _INLINE_MEMO.stats(), 'cells': _CELL_MEMO.stats()}
+
+def _inline_from_data(data) -> list:
+    nodes = []
+    for item in data:
+        if isinstance(item, str):
+            nodes.append(Text(item))
+            continue
+        tag = item[0]
+        if tag == '$$':
+            nodes.append(LiteralMath(item[1]))
+        elif tag == '$':
+            nodes.append(Math(item[1]))
+        elif tag == '`':
+            nodes.append(Code(item[1]))
+        elif tag == '**':
+            nodes.append(Bold(_inline_from_data(item[1])))
+        elif tag == 'a':
+            nodes.append(Link(item[1], item[2]))
+        else:
+            raise ValueError(f'unknown inline node: {tag!r}')
+    return nodes
+
+def process_inline(text):
+    return _INLINE_MEMO.render(text)
 
 def _clean_heading_text(text: str) -> str:
     # Remove leading emojis/symbols then a leading numeric prefix like '1.' or '2) '
@@ -161,509 +471,3859 @@ def _clean_heading_text(text: str) -> str:
     return t
 
 def process_table_cell(cell):
-    if not cell:
-        return ''
-    
-    parts = []
-    current_pos = 0
-    
-    for match in re.finditer(r'\$([^\$]+)\$|`([^`]+)`|\*\*([^\*]+)\*\*', cell):
-        before = cell[current_pos:match.start()]
-        parts.append(escape_latex(before))
-        
-        if match.group(1):
-            parts.append('$' + match.group(1) + '$')
-        elif match.group(2):
-            code = _strip_emojis(match.group(2))
-            code = code.replace('\\', 'BACKSLASHTEMP')
-            code = code.replace('{', '\\{')
-            code = code.replace('}', '\\}')
-            code = code.replace('BACKSLASHTEMP', '\\textbackslash{}')
-            code = code.replace('_', '\\_')
-            code = code.replace('^', '\\textasciicircum{}')
-            code = code.replace('#', '\\#')
-            code = code.replace('&', '\\&')
-            code = code.replace('%', '\\%')
-            code = code.replace('$', '\\$')
-            parts.append('\\texttt{' + code + '}')
-        elif match.group(3):
-            parts.append('\\textbf{' + escape_latex(match.group(3)) + '}')
-        
-        current_pos = match.end()
-    
-    parts.append(escape_latex(cell[current_pos:]))
-    
-    return ''.join(parts)
-
-def md_to_latex(md_text, engine: str = 'pdflatex', system_name: str = None):
-    lines = md_text.split('\n')
-    result = []
-    in_code_block = False
-    ul_level = 0  # number of open itemize levels
-    ol_level = 0  # number of open enumerate levels
-    in_math_block = False
-    in_bracket_math = False
-    code_block_content = []
-    math_block_content = []
-    bracket_math_content = []
-    i = 0
-    
-    while i < len(lines):
-        line = lines[i]
-        
-        if line.strip().startswith('$$') and not in_code_block and not in_bracket_math:
-            if in_math_block:
-                result.append('\\[')
-                result.extend(math_block_content)
-                result.append('\\]')
-                math_block_content = []
-                in_math_block = False
-            else:
-                in_math_block = True
-            i += 1
-            continue
-        
-        if in_math_block:
-            math_block_content.append(line)
-            i += 1
-            continue
+    # Cells use the same inline syntax as running text
+    return _CELL_MEMO.render(cell)
+
+# Markdown patterns used by the block parser
+TABLE_SEP_RE = re.compile(r'^\|[\s\-:|]+\|')
+UL_ITEM_RE = re.compile(r'^(\s*)([-\*])\s+(.*)$')
+OL_ITEM_RE = re.compile(r'^(\s*)\d+\.\s+(.*)$')
+HRULE_LINES = ('---', '***', '___')
+HEADING_COMMANDS = (
+    ('#### ', 'paragraph'),
+    ('### ', 'subsubsection'),
+    ('## ', 'subsection'),
+    ('# ', 'section'),
+)
+
+# Font setup per engine family
+PDFTEX_FONT_SETUP = (
+    "\\usepackage[utf8]{inputenc}\n"
+    "\\usepackage[T1]{fontenc}\n"
+    "\\usepackage{lmodern}\n"
+)
+UNICODE_FONT_SETUP = (
+    "\\usepackage{fontspec}\n"
+    "\\newcommand{\\TrySetMono}[1]{\\IfFontExistsTF{#1}{\\setmonofont{#1}}{}}\n"
+    "\\TrySetMono{Consolas}\n"
+    "\\TrySetMono{DejaVu Sans Mono}\n"
+    "\\TrySetMono{Fira Code}\n"
+    "\\TrySetMono{Courier New}\n"
+)
+
+def _indent(text: str) -> str:
+    return ''.join('  ' + line for line in text.splitlines(True))
+
+# Engine-flexible preamble using iftex so the same .tex works with pdfLaTeX or Xe/LuaLaTeX
+ENGINE_PREAMBLE = (
+    "\\usepackage{iftex}\n"
+    "\\ifPDFTeX\n"
+    + _indent(PDFTEX_FONT_SETUP) +
+    "\\else\n"
+    + _indent(UNICODE_FONT_SETUP) +
+    "\\fi\n"
+)
+
+PREAMBLE_HEAD = (
+    "\\documentclass{article}\n"
+    "\\usepackage[margin=0.6in]{geometry}\n"
+    "\\usepackage{amsmath}\n"
+    "\\usepackage{amssymb}\n"
+    "\\usepackage{textcomp}\n"
+    "\\usepackage[official]{eurosym}\n"
+    "\\usepackage{hyperref}\n"
+    "\\usepackage{longtable}\n"
+    "\\usepackage{array}\n"
+    "\\usepackage{adjustbox}\n"
+    "\\usepackage{enumitem}\n"
+    "\\setlength{\\parindent}{0pt}\n"
+    "\\setlist[itemize]{leftmargin=2em}\n"
+    "\\setlist[enumerate]{leftmargin=2.5em}\n"
+    "% Number subsubsections as 1, 2, 3 (no parent prefixes like 0.0.1)\n"
+    "\\setcounter{secnumdepth}{3}\n"
+    "\\renewcommand\\thesubsubsection{\\arabic{subsubsection}}\n"
+)
+LATEX_PREAMBLE = PREAMBLE_HEAD + ENGINE_PREAMBLE + "\n"
+
+def latex_preamble(engine: str = None) -> str:
+    # The engine-flexible preamble by default; an engine name gives a preamble
+    # with only that engine's font setup
+    if engine is None:
+        return LATEX_PREAMBLE
+    if engine == 'pdflatex':
+        return PREAMBLE_HEAD + PDFTEX_FONT_SETUP + "\n"
+    if engine in ('xelatex', 'lualatex'):
+        return PREAMBLE_HEAD + UNICODE_FONT_SETUP + "\n"
+    raise ValueError(f'unknown LaTeX engine: {engine!r}')
+
+DOCUMENT_BEGIN = "\\begin{document}\n\n"
+DOCUMENT_END = "\n\n\\end{document}"
+
+def _iter_source_lines(stream):
+    # Lines without their '\n', exactly like str.split('\n') on the whole text
+    # (a trailing newline yields a final empty line)
+    last = '\n'
+    for last in stream:
+        yield last[:-1] if last.endswith('\n') else last
+    if last.endswith('\n'):
+        yield ''
+
+class ConversionLimitError(ValueError):
+    # A conversion exceeded one of its ConversionLimits
+    pass
+
+class ConversionLimits:
+    # Hard limits for converting untrusted Markdown. A conversion stops with
+    # ConversionLimitError as soon as it notices that the source is larger than
+    # max_bytes (UTF-8), that it has run for more than max_seconds (checked as
+    # source lines are read, and while waiting for -j workers) or that a list is
+    # nested more than max_list_depth levels deep. None means no limit. The time
+    # counts from started (a time.monotonic() value; see start()) when it is set.
+    # With csv_root, CSV directives may only read files inside that directory:
+    # a path with '..' or one that resolves elsewhere (through symlinks too) stops
+    # the conversion, and csv_root='' refuses every CSV directive.
+    __slots__ = ('max_bytes', 'max_seconds', 'max_list_depth', 'started', 'csv_root')
+
+    def __init__(self, max_bytes: int = None, max_seconds: float = None, max_list_depth: int = None,
+                 started: float = None, csv_root: str = None):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_list_depth = max_list_depth
+        self.started = started
+        self.csv_root = csv_root
+
+    def __repr__(self):
+        return (f'ConversionLimits(max_bytes={self.max_bytes!r}, max_seconds={self.max_seconds!r}, '
+                f'max_list_depth={self.max_list_depth!r}, started={self.started!r}, csv_root={self.csv_root!r})')
+
+    def start(self) -> 'ConversionLimits':
+        # The same limits with the clock started now, for one conversion
+        import time
+        return ConversionLimits(self.max_bytes, self.max_seconds, self.max_list_depth, time.monotonic(),
+                                self.csv_root)
+
+    def for_text(self, text: str) -> 'ConversionLimits':
+        # Started limits for converting text, whose size is checked here so that its
+        # lines need not be measured again. Characters never outnumber bytes: an
+        # oversized text fails before it is encoded.
+        self.check_size(len(text))
+        if self.max_bytes is not None and not text.isascii():
+            self.check_size(len(text.encode('utf-8', 'surrogatepass')))
+        return ConversionLimits(None, self.max_seconds, self.max_list_depth, csv_root=self.csv_root).start()
+
+    def deadline(self):
+        # time.monotonic() value the conversion must finish by, or None
+        if self.max_seconds is None:
+            return None
+        if self.started is None:
+            import time
+            return time.monotonic() + self.max_seconds
+        return self.started + self.max_seconds
+
+    def check_size(self, size: int):
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ConversionLimitError(f'input is larger than {self.max_bytes} bytes')
+
+    def check_csv(self, path: str):
+        # Refuse a CSV table path outside csv_root (see above)
+        root = self.csv_root
+        if root is None:
+            return
+        if not root or '..' in re.split(r'[\\/]', path) or not _inside_dir(path, root):
+            raise ConversionLimitError(f'CSV table not allowed: {path}')
+
+    def timed_out(self, line: int = None):
+        where = f' (at line {line})' if line else ''
+        return ConversionLimitError(f'conversion took longer than {self.max_seconds:g} s{where}')
 
-        # Support bracketed display math using lines with '[' ... ']'
-        if line.strip() == '[' and not in_code_block and not in_math_block:
-            in_bracket_math = True
-            i += 1
+# Default limits for conversions that do not pass their own (see set_conversion_limits)
+_CONVERSION_LIMITS = None
+
+def set_conversion_limits(max_bytes: int = None, max_seconds: float = None, max_list_depth: int = None):
+    # Process-wide ConversionLimits for md_to_latex, convert_stream, convert_file and
+    # iter_latex calls without limits=; all None removes them
+    global _CONVERSION_LIMITS
+    if max_bytes is None and max_seconds is None and max_list_depth is None:
+        _CONVERSION_LIMITS = None
+    else:
+        _CONVERSION_LIMITS = ConversionLimits(max_bytes, max_seconds, max_list_depth)
+
+# The max_seconds deadline is checked once every this many source lines
+LIMIT_CLOCK_LINES = 256
+
+def _limit_lines(lines, limits: ConversionLimits):
+    # Source lines, raising ConversionLimitError once they add up to more than
+    # limits.max_bytes or the limits.max_seconds deadline has passed
+    import time
+
+    max_bytes = limits.max_bytes
+    deadline = limits.deadline()
+    clock = time.monotonic
+    size = -1  # the first line has no newline before it
+    for number, line in enumerate(lines, 1):
+        if max_bytes is not None:
+            size += (len(line) if line.isascii() else len(line.encode('utf-8', 'surrogatepass'))) + 1
+            if size > max_bytes:
+                limits.check_size(size)
+        # Reading the clock costs more than most lines take to convert
+        if deadline is not None and not number % LIMIT_CLOCK_LINES and clock() > deadline:
+            raise limits.timed_out(number)
+        yield line
+
+def _inside_dir(path: str, root: str) -> bool:
+    # Whether path, with symlinks resolved, is root or somewhere below it
+    real_root = os.path.realpath(root)
+    real = os.path.realpath(path)
+    try:
+        return os.path.commonpath([real, real_root]) == real_root
+    except ValueError:
+        # Different drives on Windows
+        return False
+
+def _limit_blocks(blocks, limits: ConversionLimits):
+    # blocks, checked against limits.max_list_depth and limits.csv_root when set
+    if limits is None:
+        return blocks
+    if limits.csv_root is not None:
+        blocks = _check_csv_paths(blocks, limits)
+    if limits.max_list_depth is not None:
+        blocks = _check_list_depth(blocks, limits.max_list_depth)
+    return blocks
+
+def _check_csv_paths(blocks, limits: ConversionLimits):
+    for block in blocks:
+        if block[0] == 'csv':
+            limits.check_csv(block[1])
+        yield block
+
+def _check_list_depth(blocks, max_depth: int):
+    for block in blocks:
+        kind, data = block
+        # Only indented lines can nest deeper than one level
+        if kind == 'line' and data[:1].isspace():
+            match = UL_ITEM_RE.match(data) or OL_ITEM_RE.match(data)
+            if match and len(match.group(1)) // 2 + 1 > max_depth:
+                raise ConversionLimitError(f'list nested {len(match.group(1)) // 2 + 1} levels deep '
+                                           f'(limit {max_depth})')
+        yield block
+
+def _table_cells(line: str) -> list:
+    # Cells of a pipe table row; the outer pipes are optional and empty cells are kept
+    line = line.strip()
+    if line.startswith('|'):
+        line = line[1:]
+    if line.endswith('|'):
+        line = line[:-1]
+    return [cell.strip() for cell in line.split('|')]
+
+def _warn_ragged_table(headers, ragged: int):
+    import warnings
+    warnings.warn(f'table with header {" | ".join(headers)!r}: {ragged} row(s) did not have '
+                  f'{len(headers)} cells and were padded or truncated', stacklevel=3)
+
+# <!-- md2tex:csv path/to/data.csv --> on a line of its own pulls in a CSV file as a table
+CSV_DIRECTIVE_RE = re.compile(r'^\s*<!--\s*md2tex:csv\s+(.+?)\s*-->\s*$')
+
+def _iter_blocks(lines, base_dir: str = None):
+    # Group source lines into blocks, reading one line ahead at most:
+    #   ('math', lines)  ('code', lines)  ('table', (headers, rows))  ('csv', path)
+    #   ('rule', None)  ('line', text)
+    # Blocks still open at EOF are dropped. Relative CSV paths are resolved against base_dir.
+    lines = iter(lines)
+    pending = None
+    while True:
+        if pending is not None:
+            line, pending = pending, None
+        else:
+            line = next(lines, None)
+            if line is None:
+                return
+        stripped = line.strip()
+
+        if stripped.startswith('$$'):
+            body = []
+            for line in lines:
+                if line.strip().startswith('$$'):
+                    yield 'math', body
+                    break
+                body.append(line)
             continue
-        if in_bracket_math:
-            if line.strip() == ']':
-                result.append('\\[')
-                result.extend(bracket_math_content)
-                result.append('\\]')
-                bracket_math_content = []
-                in_bracket_math = False
-            else:
-                bracket_math_content.append(line)
-            i += 1
+
+        # Bracketed display math using lines with '[' ... ']'
+        if stripped == '[':
+            body = []
+            for line in lines:
+                stripped = line.strip()
+                if stripped == ']':
+                    yield 'math', body
+                    break
+                if stripped != '[':
+                    body.append(line)
             continue
-        
+
         if line.startswith('```') or line.startswith('~~~'):
-            if in_code_block:
-                result.append('\\begin{verbatim}')
-                for code_line in code_block_content:
-                    # Preserve code exactly as written (including Unicode)
-                    if len(code_line) > 80:
-                        for j in range(0, len(code_line), 75):
-                            result.append(code_line[j:j+75])
-                    else:
-                        result.append(code_line)
-                result.append('\\end{verbatim}')
-                code_block_content = []
-                in_code_block = False
-            else:
-                in_code_block = True
-            i += 1
-            continue
-        
-        if in_code_block:
-            code_block_content.append(line)
-            i += 1
-            continue
-        
-        # Helpers to close all open list environments
-        def _close_all_lists():
-            nonlocal ul_level, ol_level
-            while ul_level > 0:
-                result.append('\\end{itemize}')
-                ul_level -= 1
-            while ol_level > 0:
-                result.append('\\end{enumerate}')
-                ol_level -= 1
-
-        # Horizontal rules (---, ***, ___) -> full-width rule
-        if line.strip() in ('---', '***', '___'):
-            _close_all_lists()
-            result.append('\\noindent\\rule{\\linewidth}{0.4pt}')
-            i += 1
+            body = []
+            for line in lines:
+                if line.startswith('```') or line.startswith('~~~'):
+                    yield 'code', body
+                    break
+                body.append(line)
             continue
 
-        if '|' in line and i + 1 < len(lines) and re.match(r'^\|[\s\-:|]+\|', lines[i + 1]):
-            _close_all_lists()
-            
-            headers = [h.strip() for h in line.split('|') if h.strip()]
-            num_cols = len(headers)
-            
-            if num_cols == 1:
-                col_width = 0.85
-            elif num_cols == 2:
-                col_width = 0.42
-            elif num_cols == 3:
-                col_width = 0.28
-            elif num_cols == 4:
-                col_width = 0.20
-            else:
-                col_width = 0.85 / num_cols
-            
-            result.append('\\begin{adjustbox}{max width=\\textwidth}')
-            col_spec = '|' + f'p{{{col_width}\\textwidth}}|' * num_cols
-            result.append('\\begin{tabular}{' + col_spec + '}')
-            result.append('\\hline')
-            result.append(' & '.join(escape_latex(h) for h in headers) + ' \\\\')
-            result.append('\\hline')
-            i += 2
-            
-            while i < len(lines) and '|' in lines[i] and lines[i].strip():
-                cells = [c.strip() for c in lines[i].split('|') if c.strip() or lines[i].startswith('|')]
-                cells = [c for c in cells if c.strip()]
-                
-                if len(cells) != num_cols:
-                    break
-                
-                processed_cells = [process_table_cell(cell) for cell in cells]
-                result.append(' & '.join(processed_cells) + ' \\\\')
-                result.append('\\hline')
-                i += 1
-            
-            result.append('\\end{tabular}')
-            result.append('\\end{adjustbox}')
-            result.append('')
+        if stripped in HRULE_LINES:
+            yield 'rule', None
             continue
-        # Nested unordered list items (supports indentation in multiples of 2 spaces)
-        m_ul = re.match(r'^(\s*)([-\*])\s+(.*)$', line)
+
+        if stripped.startswith('<!--'):
+            m_csv = CSV_DIRECTIVE_RE.match(line)
+            if m_csv:
+                path = m_csv.group(1)
+                if base_dir and not os.path.isabs(path):
+                    path = os.path.join(base_dir, path)
+                yield 'csv', path
+                continue
+
+        if '|' in line:
+            pending = next(lines, None)
+            if pending is not None and TABLE_SEP_RE.match(pending):
+                headers = _table_cells(line)
+                num_cols = len(headers)
+                rows = []
+                ragged = 0
+                pending = None
+                for row in lines:
+                    if '|' not in row or not row.strip():
+                        pending = row
+                        break
+                    cells = _table_cells(row)
+                    if len(cells) != num_cols:
+                        ragged += 1
+                        cells = (cells + [''] * num_cols)[:num_cols]
+                    rows.append(cells)
+                if ragged:
+                    _warn_ragged_table(headers, ragged)
+                yield 'table', (headers, rows)
+                continue
+
+        yield 'line', line
+
+def _close_lists(ul_level: int, ol_level: int):
+    for _ in range(ul_level):
+        yield '\\end{itemize}'
+    for _ in range(ol_level):
+        yield '\\end{enumerate}'
+
+# Tables with at least this many body rows become a longtable that can break
+# across pages; smaller ones are a tabular scaled to the text width
+LONGTABLE_MIN_ROWS = 40
+# Share of \textwidth split between the columns, and the clamp on each column's
+# weight (its average cell length in characters)
+TABLE_WIDTH = 0.85
+COLUMN_WEIGHT_MIN = 4
+COLUMN_WEIGHT_MAX = 50
+
+def _column_widths(total_lengths, num_rows: int) -> list:
+    # Column widths (fractions of \textwidth) proportional to the average cell length
+    weights = [min(max(total / max(num_rows, 1), COLUMN_WEIGHT_MIN), COLUMN_WEIGHT_MAX) for total in total_lengths]
+    scale = TABLE_WIDTH / sum(weights)
+    return [round(weight * scale, 3) for weight in weights]
+
+def _table_widths(headers, rows) -> list:
+    # Single statistics pass over the raw cell text (header included)
+    totals = [len(h) for h in headers]
+    for cells in rows:
+        for i, cell in enumerate(cells):
+            totals[i] += len(cell)
+    return _column_widths(totals, len(rows) + 1)
+
+def _table_lines(headers, rows, widths, num_rows: int):
+    # LaTeX lines for a table. headers is a list of LaTeX cells; rows is an iterable
+    # of lists of LaTeX cells, consumed lazily so long tables stream.
+    col_spec = '|' + ''.join(f'p{{{width}\\textwidth}}|' for width in widths)
+    header = ' & '.join(headers) + ' \\\\'
+    if num_rows >= LONGTABLE_MIN_ROWS:
+        yield '\\begin{longtable}{' + col_spec + '}'
+        yield '\\hline'
+        yield header
+        yield '\\hline'
+        yield '\\endhead'
+        for cells in rows:
+            yield ' & '.join(cells) + ' \\\\'
+            yield '\\hline'
+        yield '\\end{longtable}'
+    else:
+        yield '\\begin{adjustbox}{max width=\\textwidth}'
+        yield '\\begin{tabular}{' + col_spec + '}'
+        yield '\\hline'
+        yield header
+        yield '\\hline'
+        for cells in rows:
+            yield ' & '.join(cells) + ' \\\\'
+            yield '\\hline'
+        yield '\\end{tabular}'
+        yield '\\end{adjustbox}'
+    yield ''
+
+def _iter_csv_rows(path: str, num_cols: int = None):
+    # Rows of a CSV file, read lazily; with num_cols, padded or truncated to that width
+    import csv
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for row in csv.reader(f):
+            if num_cols is not None and len(row) != num_cols:
+                row = (row + [''] * num_cols)[:num_cols]
+            yield row
+
+def _render_csv(path: str, escape=escape_latex):
+    # Stream a CSV file as a table: one pass for the column statistics, a second to
+    # render, so memory does not grow with the row count. The first row is the header.
+    if not os.path.isfile(path):
+        import warnings
+        warnings.warn(f'CSV table not found: {path}', stacklevel=2)
+        yield f'% md2tex: CSV table not found: {path}'
+        return
+    rows = _iter_csv_rows(path)
+    headers = next(rows, None)
+    if not headers:
+        # Close the reader now rather than at garbage collection, which would leave
+        # the file open (and locked on Windows) meanwhile
+        rows.close()
+        return
+    num_cols = len(headers)
+    totals = [len(h) for h in headers]
+    num_rows = ragged = 0
+    for row in rows:
+        num_rows += 1
+        if len(row) != num_cols:
+            ragged += 1
+        for i, cell in enumerate(row[:num_cols]):
+            totals[i] += len(cell)
+    if ragged:
+        _warn_ragged_table(headers, ragged)
+    body = _iter_csv_rows(path, num_cols)
+    try:
+        next(body)
+        escaped = ([escape(cell.strip()) for cell in row] for row in body)
+        yield from _table_lines([escape(h.strip()) for h in headers], escaped,
+                                _column_widths(totals, num_rows + 1), num_rows)
+    finally:
+        # Also when the caller stops reading the table early
+        body.close()
+
+# verbatim does not wrap, so longer code lines are cut into pieces of CODE_WRAP_WIDTH
+CODE_WRAP_LIMIT = 80
+CODE_WRAP_WIDTH = 75
+
+def _wrap_code_lines(lines):
+    # Code lines as written (including Unicode), long ones cut in a single pass
+    for line in lines:
+        if len(line) > CODE_WRAP_LIMIT:
+            yield from (line[j:j + CODE_WRAP_WIDTH] for j in range(0, len(line), CODE_WRAP_WIDTH))
+        else:
+            yield line
+
+# Code blocks of at least this many characters go to side files when enabled
+CODE_FILES_MIN_CHARS = 4096
+
+class CodeFiles:
+    # Side files for large code blocks. A block of min_chars or more is written once
+    # to directory/<content hash>.tex as a complete verbatim environment and
+    # referenced from the main .tex as prefix + name. Unchanged blocks keep their
+    # file, so neither the .tex nor the compile grows with the code size.
+    __slots__ = ('directory', 'prefix', 'min_chars')
+
+    def __init__(self, directory: str, prefix: str, min_chars: int = CODE_FILES_MIN_CHARS):
+        self.directory = directory
+        self.prefix = prefix  # path of directory as seen from the .tex
+        self.min_chars = min_chars
+
+    @classmethod
+    def for_document(cls, tex_dir: str, stem: str, min_chars: int = CODE_FILES_MIN_CHARS) -> 'CodeFiles':
+        # <stem>-code/ in the .tex directory (spaces replaced, since \input paths may not contain them)
+        name = stem.replace(' ', '_') + '-code'
+        return cls(os.path.join(tex_dir, name), name + '/', min_chars)
+
+    def store(self, lines) -> str:
+        import hashlib
+
+        text = '\\begin{verbatim}\n' + ''.join(line + '\n' for line in _wrap_code_lines(lines)) + '\\end{verbatim}\n'
+        data = text.encode('utf-8')
+        name = hashlib.sha256(data).hexdigest()[:20] + '.tex'
+        path = os.path.join(self.directory, name)
+        if not (os.path.exists(path) and os.path.getsize(path) == len(data)):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return self.prefix + name
+
+    def prune(self, *tex_files: str) -> int:
+        # Remove side files none of the .tex files references; returns how many
+        if not os.path.isdir(self.directory):
+            return 0
+        marker = '\\input{' + self.prefix
+        used = set()
+        for tex_file in tex_files:
+            with open(tex_file, encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith(marker):
+                        used.add(line[len(marker):].rstrip('\n').rstrip('}'))
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.tex') and name not in used:
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+        return removed
+
+def _externalize_code(blocks, code_files: CodeFiles):
+    # Replace large code blocks with ('input', path) blocks for their side files
+    min_chars = code_files.min_chars
+    for kind, data in blocks:
+        if kind == 'code' and sum(map(len, data)) + len(data) >= min_chars:
+            yield 'input', code_files.store(data)
+        else:
+            yield kind, data
+
+# Block nodes. Lists are flat items carrying their nesting depth; the renderer
+# opens and closes itemize/enumerate environments between items.
+
+class Heading(Node):
+    __slots__ = ('level', 'title', 'children')
+
+    def __init__(self, level: int, title: str, children: list):
+        self.level = level  # 1 (#) to 4 (####)
+        self.title = title  # cleaned source text, used to look up sections
+        self.children = children
+
+    def to_data(self):
+        return ['h', self.level, self.title, [child.to_data() for child in self.children]]
+
+class Paragraph(Node):
+    # One line of running text (each renders with a forced line break)
+    __slots__ = ('children',)
+
+    def __init__(self, children: list):
+        self.children = children
+
+    def to_data(self):
+        return ['p', [child.to_data() for child in self.children]]
+
+class BlankLine(Node):
+    __slots__ = ()
+
+    def to_data(self):
+        return ['blank']
+
+class ListItem(Node):
+    __slots__ = ('ordered', 'depth', 'children')
+
+    def __init__(self, ordered: bool, depth: int, children: list):
+        self.ordered = ordered
+        self.depth = depth  # 1 for top-level items
+        self.children = children
+
+    def to_data(self):
+        return ['li', int(self.ordered), self.depth, [child.to_data() for child in self.children]]
+
+class Table(Node):
+    # Header cells are plain text; body cells are inline node lists. widths are the
+    # column widths as fractions of \textwidth, from the source cell lengths.
+    __slots__ = ('headers', 'rows', 'widths')
+
+    def __init__(self, headers: list, rows: list, widths: list):
+        self.headers = headers
+        self.rows = rows
+        self.widths = widths
+
+    def to_data(self):
+        return ['table', self.headers, [[[n.to_data() for n in cell] for cell in cells] for cells in self.rows],
+                self.widths]
+
+class CsvTable(Node):
+    # Table read from a CSV file at render time
+    __slots__ = ('path',)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def to_data(self):
+        return ['csv', self.path]
+
+class CodeBlock(Node):
+    __slots__ = ('lines',)
+
+    def __init__(self, lines: list):
+        self.lines = lines
+
+    def to_data(self):
+        return ['code', self.lines]
+
+class MathBlock(Node):
+    __slots__ = ('lines',)
+
+    def __init__(self, lines: list):
+        self.lines = lines
+
+    def to_data(self):
+        return ['math', self.lines]
+
+class CodeInput(Node):
+    # Code block written to a side file (see CodeFiles), pulled in with \input
+    __slots__ = ('path',)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def to_data(self):
+        return ['input', self.path]
+
+class Rule(Node):
+    __slots__ = ()
+
+    def to_data(self):
+        return ['hr']
+
+HEADING_LEVELS = {len(prefix) - 1: command for prefix, command in HEADING_COMMANDS}
+
+def _block_node(block, inline=_INLINE_MEMO.nodes, cells=_CELL_MEMO.nodes) -> Node:
+    # Typed node for a (kind, data) block from _iter_blocks; inline and cells give the
+    # inline nodes of running text and of table cells (the process-wide memos by default)
+    kind, data = block
+    if kind == 'line':
+        if data.startswith('#'):
+            for prefix, _ in HEADING_COMMANDS:
+                if data.startswith(prefix):
+                    title = _clean_heading_text(data[len(prefix):])
+                    return Heading(len(prefix) - 1, title, inline(title))
+        m_ul = UL_ITEM_RE.match(data)
         if m_ul:
-            indent = m_ul.group(1)
-            content = m_ul.group(3)
-            level = len(indent) // 2
-            desired = level + 1
-            while ul_level < desired:
-                while ol_level > 0:
-                    result.append('\\end{enumerate}')
+            return ListItem(False, len(m_ul.group(1)) // 2 + 1, inline(m_ul.group(3)))
+        m_ol = OL_ITEM_RE.match(data)
+        if m_ol:
+            return ListItem(True, len(m_ol.group(1)) // 2 + 1, inline(m_ol.group(2)))
+        if data.strip() == '':
+            return BlankLine()
+        return Paragraph(inline(data))
+    if kind == 'table':
+        headers, rows = data
+        return Table(headers, [[cells(cell) for cell in row] for row in rows], _table_widths(headers, rows))
+    if kind == 'code':
+        return CodeBlock(data)
+    if kind == 'math':
+        return MathBlock(data)
+    if kind == 'csv':
+        return CsvTable(data)
+    if kind == 'input':
+        return CodeInput(data)
+    return Rule()
+
+def _block_from_data(data) -> Node:
+    tag = data[0]
+    if tag == 'p':
+        return Paragraph(_inline_from_data(data[1]))
+    if tag == 'blank':
+        return BlankLine()
+    if tag == 'li':
+        return ListItem(bool(data[1]), data[2], _inline_from_data(data[3]))
+    if tag == 'h':
+        return Heading(data[1], data[2], _inline_from_data(data[3]))
+    if tag == 'table':
+        return Table(data[1], [[_inline_from_data(cell) for cell in cells] for cells in data[2]], data[3])
+    if tag == 'csv':
+        return CsvTable(data[1])
+    if tag == 'code':
+        return CodeBlock(data[1])
+    if tag == 'math':
+        return MathBlock(data[1])
+    if tag == 'input':
+        return CodeInput(data[1])
+    if tag == 'hr':
+        return Rule()
+    raise ValueError(f'unknown block node: {tag!r}')
+
+def parse_blocks(lines, base_dir: str = None):
+    # Block nodes for an iterable of Markdown lines (without newlines), parsed lazily
+    return map(_block_node, _iter_blocks(lines, base_dir))
+
+def _render_nodes(nodes, lists=None, escape=escape_latex):
+    # LaTeX body lines for a block node stream; lists stay open across list items.
+    # With a [ul_level, ol_level] list the render starts from (and writes back)
+    # that list context and leaves lists open at the end, so consecutive chunks
+    # can be rendered separately. escape is passed on to render_inline.
+    ul_level, ol_level = lists or (0, 0)  # numbers of open itemize/enumerate levels
+    for node in nodes:
+        node_type = type(node)
+        if node_type is ListItem:
+            desired = node.depth
+            if not node.ordered:
+                # Nested unordered list items (supports indentation in multiples of 2 spaces)
+                if ul_level < desired:
+                    yield from _close_lists(0, ol_level)
+                    ol_level = 0
+                    while ul_level < desired:
+                        yield '\\begin{itemize}'
+                        ul_level += 1
+                while ul_level > desired:
+                    yield '\\end{itemize}'
+                    ul_level -= 1
+            else:
+                yield from _close_lists(ul_level, 0)
+                ul_level = 0
+                while ol_level < desired:
+                    yield '\\begin{enumerate}'
+                    ol_level += 1
+                while ol_level > desired:
+                    yield '\\end{enumerate}'
                     ol_level -= 1
-                result.append('\\begin{itemize}')
-                ul_level += 1
-            while ul_level > desired:
-                result.append('\\end{itemize}')
-                ul_level -= 1
-            result.append('\\item ' + process_inline(content))
-            i += 1
+            yield '\\item ' + render_inline(node.children, escape)
             continue
 
-        # Nested ordered list items
-        m_ol = re.match(r'^(\s*)\d+\.\s+(.*)$', line)
-        if m_ol:
-            indent = m_ol.group(1)
-            content = m_ol.group(2)
-            level = len(indent) // 2
-            desired = level + 1
-            while ul_level > 0:
-                result.append('\\end{itemize}')
-                ul_level -= 1
-            while ol_level < desired:
-                result.append('\\begin{enumerate}')
-                ol_level += 1
-            while ol_level > desired:
-                result.append('\\end{enumerate}')
-                ol_level -= 1
-            result.append('\\item ' + process_inline(content))
-            i += 1
+        if node_type is MathBlock:
+            yield '\\['
+            yield from node.lines
+            yield '\\]'
             continue
 
-        # Headings and paragraphs
-        if line.startswith('#### '):
-            _close_all_lists()
-            heading_text = _clean_heading_text(line[5:])
-            result.append('\\paragraph{' + process_inline(heading_text) + '}')
-        elif line.startswith('### '):
-            _close_all_lists()
-            heading_text = _clean_heading_text(line[4:])
-            result.append('\\subsubsection{' + process_inline(heading_text) + '}')
-        elif line.startswith('## '):
-            _close_all_lists()
-            heading_text = _clean_heading_text(line[3:])
-            result.append('\\subsection{' + process_inline(heading_text) + '}')
-        elif line.startswith('# '):
-            _close_all_lists()
-            heading_text = _clean_heading_text(line[2:])
-            result.append('\\section{' + process_inline(heading_text) + '}')
-        elif line.strip() == '':
-            _close_all_lists()
-            result.append('')
-        else:
-            _close_all_lists()
-            processed = process_inline(line)
+        if node_type is CodeBlock:
+            yield '\\begin{verbatim}'
+            yield from _wrap_code_lines(node.lines)
+            yield '\\end{verbatim}'
+            continue
+
+        if node_type is CodeInput:
+            yield '\\input{' + node.path + '}'
+            continue
+
+        # Everything else ends any open lists
+        yield from _close_lists(ul_level, ol_level)
+        ul_level = ol_level = 0
+
+        if node_type is Paragraph:
+            processed = render_inline(node.children, escape)
             # Force a LaTeX line break for every non-block plain-text line.
             # Use \newline for robustness across contexts instead of \\
             if not processed.rstrip().endswith('\\') and not processed.rstrip().endswith('\\newline'):
                 processed += ' \\newline'
-            result.append(processed)
-        
-        i += 1
-        
-    # Close any remaining lists at EOF
-        while ul_level > 0:
-            result.append('\\end{itemize}')
-            ul_level -= 1
-        while ol_level > 0:
-            result.append('\\end{enumerate}')
-            ol_level -= 1
-    
-    text = '\n'.join(result)
-    
-    # Engine-flexible preamble using iftex so the same .tex works with pdfLaTeX or Xe/LuaLaTeX
-    engine_preamble = (
-        "\\usepackage{iftex}\n"
-        "\\ifPDFTeX\n"
-        "  \\usepackage[utf8]{inputenc}\n"
-        "  \\usepackage[T1]{fontenc}\n"
-        "  \\usepackage{lmodern}\n"
-        "\\else\n"
-        "  \\usepackage{fontspec}\n"
-        "  \\newcommand{\\TrySetMono}[1]{\\IfFontExistsTF{#1}{\\setmonofont{#1}}{}}\n"
-        "  \\TrySetMono{Consolas}\n"
-        "  \\TrySetMono{DejaVu Sans Mono}\n"
-        "  \\TrySetMono{Fira Code}\n"
-        "  \\TrySetMono{Courier New}\n"
-        "\\fi\n"
-    )
+            yield processed
+        elif node_type is BlankLine:
+            yield ''
+        elif node_type is Heading:
+            yield '\\' + HEADING_LEVELS[node.level] + '{' + render_inline(node.children, escape) + '}'
+        elif node_type is Table:
+            rows = ([render_inline(cell, escape) for cell in cells] for cells in node.rows)
+            yield from _table_lines([escape(h) for h in node.headers], rows, node.widths, len(node.rows))
+        elif node_type is CsvTable:
+            yield from _render_csv(node.path, escape)
+        elif node_type is Rule:
+            # Horizontal rules (---, ***, ___) -> full-width rule
+            yield '\\noindent\\rule{\\linewidth}{0.4pt}'
 
-    latex_doc = f"""\\documentclass{{article}}
-\\usepackage[margin=0.6in]{{geometry}}
-\\usepackage{{amsmath}}
-\\usepackage{{amssymb}}
-\\usepackage{{textcomp}}
-\\usepackage[official]{{eurosym}}
-\\usepackage{{hyperref}}
-\\usepackage{{longtable}}
-\\usepackage{{array}}
-\\usepackage{{adjustbox}}
-\\usepackage{{enumitem}}
-\\setlength{{\\parindent}}{{0pt}}
-\\setlist[itemize]{{leftmargin=2em}}
-\\setlist[enumerate]{{leftmargin=2.5em}}
-% Number subsubsections as 1, 2, 3 (no parent prefixes like 0.0.1)
-\\setcounter{{secnumdepth}}{{3}}
-\\renewcommand\\thesubsubsection{{\\arabic{{subsubsection}}}}
-{engine_preamble}
-\\begin{{document}}
-
-{text}
-
-\\end{{document}}"""
-    
-    return latex_doc
+    if lists is not None:
+        lists[:] = [ul_level, ol_level]
+    else:
+        # Close any remaining lists at EOF
+        yield from _close_lists(ul_level, ol_level)
 
-if __name__ == '__main__':
-    # Resolve input markdown file with a default to README.md when no file is provided
-    def _resolve_input_file(argv) -> str:
-        # Default when no argument provided
-        if len(argv) <= 1:
-            return 'README.md'
-
-        raw = (argv[1] or '').strip()
-        # Treat common "no-op" or sentinel args as README.md
-        if raw in ('/', '\\', '.', './', '.\\'):
-            return 'README.md'
-        # If a directory is provided, use README.md inside it
-        if os.path.isdir(raw):
-            return os.path.join(raw, 'README.md')
-        return raw
-
-    input_file = _resolve_input_file(sys.argv)
-
-    if os.path.isdir(input_file):
-        # Safety: if somehow a directory slipped through, look for README.md inside
-        input_file = os.path.join(input_file, 'README.md')
+def _render_blocks(blocks, lists=None):
+    # Same as _render_nodes, for (kind, data) blocks from _iter_blocks
+    return _render_nodes(map(_block_node, blocks), lists)
 
-    if os.path.basename(input_file).lower() == 'readme.md' and not os.path.exists(input_file):
-        # Try case-insensitive match in current directory
-        for name in os.listdir('.'):
-            if name.lower() == 'readme.md':
-                input_file = name
-                break
+def _ends_chunk(kind: str, data) -> bool:
+    # Top-level split points: after a blank line or a heading. Both close every
+    # open list, and fenced blocks are always whole blocks, so the next chunk
+    # starts outside any code, math or list context.
+    if kind != 'line':
+        return False
+    return not data.strip() or any(data.startswith(prefix) for prefix, _ in HEADING_COMMANDS)
 
-    if os.path.exists(input_file):
-        with open(input_file, 'r', encoding='utf-8') as f:
-            md_content = f.read()
-        
-        # Detect if code blocks contain non-ASCII (to decide LaTeX engine)
-        def _has_non_ascii_in_code(md: str) -> bool:
-            in_code = False
-            for ln in md.splitlines():
-                if ln.startswith('```') or ln.startswith('~~~'):
-                    in_code = not in_code
-                    continue
-                if in_code and any(ord(ch) > 127 for ch in ln):
-                    return True
-            return False
+def _iter_chunks(blocks):
+    # Group a block stream into top-level chunks (lists of blocks)
+    chunk = []
+    for kind, data in blocks:
+        chunk.append((kind, data))
+        if _ends_chunk(kind, data):
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-        needs_unicode_engine = _has_non_ascii_in_code(md_content)
-        output_file = input_file.replace('.md', '.tex')
-        
-        import subprocess
-        import shutil
-        import platform
-        
-        # Determine LaTeX engine (prefer xelatex/lualatex when Unicode in code blocks)
-        engine_name = None
-        engine_path = None
-
-        candidates = []
-        if needs_unicode_engine:
-            candidates = ['xelatex', 'lualatex', 'pdflatex']
+def _cache_dir(*parts) -> str:
+    # Per-user cache directory (MD2TEX_CACHE_DIR overrides the platform default)
+    base = os.environ.get('MD2TEX_CACHE_DIR')
+    if not base:
+        if os.name == 'nt':
+            root = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
         else:
-            candidates = ['pdflatex', 'xelatex', 'lualatex']
+            root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        base = os.path.join(root, 'md2tex')
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
 
-        for eng in candidates:
-            p = shutil.which(eng)
-            if p:
-                engine_name = eng
-                engine_path = p
-                break
+_CODE_FINGERPRINT = None
 
-        # Fallback search in common locations if not found via PATH
-        if not engine_path:
-            system = platform.system()
-            common_paths_map = {
-                'Windows': {
-                    'pdflatex': [
-                        rf'C:\\Users\\{os.environ.get("USERNAME", "user")}\\AppData\\Local\\Programs\\MiKTeX\\miktex\\bin\\x64\\pdflatex.exe',
-                        r'C:\\Program Files\\MiKTeX\\miktex\\bin\\x64\\pdflatex.exe',
-                        r'C:\\texlive\\2024\\bin\\win32\\pdflatex.exe',
-                        r'C:\\texlive\\2024\\bin\\windows\\pdflatex.exe',
-                    ],
-                    'xelatex': [
-                        rf'C:\\Users\\{os.environ.get("USERNAME", "user")}\\AppData\\Local\\Programs\\MiKTeX\\miktex\\bin\\x64\\xelatex.exe',
-                        r'C:\\Program Files\\MiKTeX\\miktex\\bin\\x64\\xelatex.exe',
-                        r'C:\\texlive\\2024\\bin\\win32\\xelatex.exe',
-                        r'C:\\texlive\\2024\\bin\\windows\\xelatex.exe',
-                    ],
-                    'lualatex': [
-                        rf'C:\\Users\\{os.environ.get("USERNAME", "user")}\\AppData\\Local\\Programs\\MiKTeX\\miktex\\bin\\x64\\lualatex.exe',
-                        r'C:\\Program Files\\MiKTeX\\miktex\\bin\\x64\\lualatex.exe',
-                        r'C:\\texlive\\2024\\bin\\win32\\lualatex.exe',
-                        r'C:\\texlive\\2024\\bin\\windows\\lualatex.exe',
-                    ],
-                },
-                'Linux': {
-                    'pdflatex': [
-                        '/usr/bin/pdflatex', '/usr/local/bin/pdflatex',
-                        '/usr/local/texlive/2024/bin/x86_64-linux/pdflatex',
-                        '/opt/texlive/2024/bin/x86_64-linux/pdflatex',
-                    ],
-                    'xelatex': [
-                        '/usr/bin/xelatex', '/usr/local/bin/xelatex',
-                        '/usr/local/texlive/2024/bin/x86_64-linux/xelatex',
-                        '/opt/texlive/2024/bin/x86_64-linux/xelatex',
-                    ],
-                    'lualatex': [
-                        '/usr/bin/lualatex', '/usr/local/bin/lualatex',
-                        '/usr/local/texlive/2024/bin/x86_64-linux/lualatex',
-                        '/opt/texlive/2024/bin/x86_64-linux/lualatex',
-                    ],
-                },
-                'Darwin': {  # macOS
-                    'pdflatex': [
-                        '/Library/TeX/texbin/pdflatex',
-                        '/usr/local/texlive/2024/bin/universal-darwin/pdflatex',
-                        '/usr/local/texlive/2024/bin/arm64-darwin/pdflatex',
-                        '/usr/local/texlive/2023/bin/universal-darwin/pdflatex',
-                        '/usr/local/texlive/2023/bin/arm64-darwin/pdflatex',
-                        '/opt/local/bin/pdflatex',            # MacPorts
-                        '/opt/homebrew/bin/pdflatex',         # Homebrew (Apple Silicon)
-                        '/usr/local/bin/pdflatex',
-                    ],
-                    'xelatex': [
-                        '/Library/TeX/texbin/xelatex',
-                        '/usr/local/texlive/2024/bin/universal-darwin/xelatex',
-                        '/usr/local/texlive/2024/bin/arm64-darwin/xelatex',
-                        '/usr/local/texlive/2023/bin/universal-darwin/xelatex',
-                        '/usr/local/texlive/2023/bin/arm64-darwin/xelatex',
-                        '/opt/local/bin/xelatex',             # MacPorts
-                        '/opt/homebrew/bin/xelatex',          # Homebrew (Apple Silicon)
-                        '/usr/local/bin/xelatex',
-                    ],
-                    'lualatex': [
-                        '/Library/TeX/texbin/lualatex',
-                        '/usr/local/texlive/2024/bin/universal-darwin/lualatex',
-                        '/usr/local/texlive/2024/bin/arm64-darwin/lualatex',
-                        '/usr/local/texlive/2023/bin/universal-darwin/lualatex',
-                        '/usr/local/texlive/2023/bin/arm64-darwin/lualatex',
-                        '/opt/local/bin/lualatex',            # MacPorts
-                        '/opt/homebrew/bin/lualatex',         # Homebrew (Apple Silicon)
-                        '/usr/local/bin/lualatex',
-                    ],
-                },
-            }
-            for eng in candidates:
-                for path in common_paths_map.get(system, {}).get(eng, []):
-                    if os.path.exists(path):
-                        engine_name = eng
-                        engine_path = path
-                        break
-                if engine_path:
+def _code_fingerprint() -> str:
+    # Hash of this module's source: cached renders are invalidated whenever the converter changes
+    global _CODE_FINGERPRINT
+    if _CODE_FINGERPRINT is None:
+        import hashlib
+        with open(os.path.abspath(__file__), 'rb') as f:
+            _CODE_FINGERPRINT = hashlib.sha256(f.read()).hexdigest()
+    return _CODE_FINGERPRINT
+
+class BlockCache:
+    # Persistent cache of rendered LaTeX per top-level chunk, keyed by the chunk's
+    # content hash plus the list context it starts in. Stored in one SQLite file;
+    # the least recently used entries are evicted once the total size exceeds
+    # max_bytes. A path of ':memory:' keeps the cache in memory for the life of
+    # the instance instead. Use one instance per thread.
+
+    def __init__(self, path: str = None, max_bytes: int = 64 * 1024 * 1024):
+        self.path = path or os.path.join(_cache_dir(), 'blocks.sqlite3')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = None
+        self._touched = []
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            self._db = sqlite3.connect(self.path, timeout=30)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS blocks ('
+                'key TEXT PRIMARY KEY, latex TEXT, ul_level INTEGER, ol_level INTEGER, '
+                'size INTEGER, atime REAL)'
+            )
+        return self._db
+
+    @staticmethod
+    def key(source: str, lists) -> str:
+        import hashlib
+        digest = hashlib.sha256(f'{_code_fingerprint()}:{lists[0]}:{lists[1]}\n'.encode())
+        digest.update(source.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        # (latex lines, [ul_level, ol_level] after the chunk) or None
+        row = self._connect().execute(
+            'SELECT latex, ul_level, ol_level FROM blocks WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched.append(key)
+        return (row[0].split('\n') if row[0] is not None else []), [row[1], row[2]]
+
+    def put(self, key: str, out_lines, lists):
+        import time
+        latex = '\n'.join(out_lines) if out_lines else None
+        self._connect().execute(
+            'INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)',
+            (key, latex, lists[0], lists[1], len((latex or '').encode('utf-8', 'surrogatepass')), time.time()),
+        )
+
+    def flush(self):
+        # Record access times, evict down to max_bytes and commit
+        if self._db is None:
+            return
+        import time
+        db = self._db
+        if self._touched:
+            now = time.time()
+            db.executemany('UPDATE blocks SET atime = ? WHERE key = ?', [(now, k) for k in self._touched])
+            self._touched = []
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()[0]
+        if total > self.max_bytes:
+            for key, size in db.execute('SELECT key, size FROM blocks ORDER BY atime').fetchall():
+                if total <= self.max_bytes:
                     break
+                db.execute('DELETE FROM blocks WHERE key = ?', (key,))
+                total -= size
+                self.evictions += 1
+        db.commit()
 
-        # Generate LaTeX with engine-specific preamble
-        latex_output = md_to_latex(md_content, engine=engine_name or 'pdflatex', system_name=platform.system())
-        
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(latex_output)
-        
-        print(f'Converted {input_file} to {output_file}')
+    def stats(self) -> dict:
+        entries, size = 0, 0
+        if self._db is not None or os.path.exists(self.path):
+            entries, size = self._connect().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blocks'
+            ).fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size,
+        }
 
-        if engine_path:
-            print(f'Compiling PDF using: {engine_path}')
-            try:
-                result = subprocess.run(
-                    [engine_path, '-interaction=nonstopmode', output_file],
-                    capture_output=True,
-                    text=True,
-                    encoding='utf-8',
-                    errors='ignore',
-                    cwd=os.path.dirname(os.path.abspath(output_file)) or '.'
-                )
-                
-                pdf_file = output_file.replace('.tex', '.pdf')
-                if os.path.exists(pdf_file):
-                    print(f'✓ PDF created: {pdf_file}')
-                    # Cleanup only the auxiliary files for this document
-                    def _cleanup_aux_files(tex_path: str):
-                        base, _ = os.path.splitext(tex_path)
-                        dir_name = os.path.dirname(os.path.abspath(tex_path)) or '.'
-                        aux_exts = [
-                            '.aux', '.log', '.out', '.toc', '.synctex.gz',
-                            '.fls', '.fdb_latexmk', '.nav', '.snm', '.vrb',
-                            '.bbl', '.blg', '.lof', '.lot', '.lol',
-                            '.idx', '.ilg', '.ind', '.glg', '.glo', '.gls',
-                            '.ist', '.acn', '.acr', '.alg', '.bcf', '.run.xml',
-                            '.xdy', '.thm'
-                        ]
-                        # Remove aux files for the current jobname
-                        for ext in aux_exts:
-                            candidate = base + ext
-                            try:
-                                if os.path.exists(candidate):
-                                    os.remove(candidate)
-                            except Exception:
-                                # Silently ignore cleanup issues
-                                pass
-                        # Also remove stray texput.log if it exists in the same directory
-                        try:
-                            texput_log = os.path.join(dir_name, 'texput.log')
-                            if os.path.exists(texput_log):
-                                os.remove(texput_log)
-                        except Exception:
-                            pass
-                    _cleanup_aux_files(output_file)
-                else:
-                    print('✗ PDF compilation failed')
-                    if 'error' in result.stdout.lower() or 'error' in result.stderr.lower():
-                        print('Errors found in compilation output')
-            except Exception as e:
-                print(f'✗ Error running LaTeX engine: {e}')
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+# Cache units merge top-level chunks into roughly this much Markdown source
+CACHE_UNIT_MIN_CHARS = 2048
+CACHE_UNIT_MAX_CHARS = 32768
+
+def _chunk_source(chunk) -> str:
+    # Unambiguous text form of a chunk for hashing: one record per block, each
+    # marker carries its line count and source lines never contain '\n'
+    parts = []
+    for kind, data in chunk:
+        if kind == 'line':
+            parts.append('\0line')
+            parts.append(data)
+        elif kind == 'rule':
+            parts.append('\0rule')
+        elif kind == 'table':
+            headers, rows = data
+            parts.append(f'\0table{len(rows)}')
+            parts.append('|'.join(headers))
+            parts.extend('|'.join(cells) for cells in rows)
+        elif kind == 'csv' or kind == 'input':
+            parts.append('\0' + kind)
+            parts.append(data)
         else:
-            print('✗ No LaTeX engine found (pdflatex/xelatex/lualatex). Please install MiKTeX or TeX Live.')
-            print('  Download MiKTeX: https://miktex.org/download')
-    else:
-        # Friendly help when file not found; mention default behavior
-        print('✗ Input file not found. Provide a Markdown file or ensure README.md exists.')
-        print('Usage: python md2tex.py <markdown_file>')
-        print('Hint: Running with no argument (or with "/" or ".") defaults to README.md')
+            parts.append(f'\0{kind}{len(data)}')
+            parts.extend(data)
+    return '\n'.join(parts)
+
+def _iter_cache_units(blocks):
+    # Merge chunks into (blocks, source) cache units. Cut points are content-defined
+    # (a heading, or a chunk whose source hashes to 0 mod 8 once the unit is big
+    # enough), so an edit only changes the unit around it and later ones line up again.
+    import zlib
+
+    unit, texts, size = [], [], 0
+    for chunk in _iter_chunks(blocks):
+        text = _chunk_source(chunk)
+        unit.extend(chunk)
+        texts.append(text)
+        size += len(text)
+        kind, data = chunk[-1]
+        if size >= CACHE_UNIT_MAX_CHARS or (size >= CACHE_UNIT_MIN_CHARS and (
+                (kind == 'line' and data.startswith('#'))
+                or zlib.crc32(text.encode('utf-8', 'surrogatepass')) & 7 == 0)):
+            yield unit, '\n'.join(texts)
+            unit, texts, size = [], [], 0
+    if unit:
+        yield unit, '\n'.join(texts)
+
+def _render_cached(blocks, cache: BlockCache):
+    # Same output as _render_blocks, re-rendering only units missing from the cache
+    lists = [0, 0]
+    for unit, source in _iter_cache_units(blocks):
+        if any(kind == 'csv' for kind, _ in unit):
+            # CSV tables stream from their file; they are not worth holding in the cache
+            lists = list(lists)
+            yield from _render_blocks(unit, lists)
+            continue
+        key = cache.key(source, lists)
+        cached = cache.get(key)
+        if cached is not None:
+            out_lines, lists = cached
+        else:
+            out_lines = list(_render_blocks(unit, lists))
+            cache.put(key, out_lines, lists)
+        yield from out_lines
+    cache.flush()
+    yield from _close_lists(*lists)
+
+class Profiler:
+    # Wall time, call counts and bytes per stage ('read', 'parse',
+    # 'inline:<block type>', 'render:<block type>', 'write', 'engine', 'publish',
+    # 'other'), plus one record per LaTeX engine pass. Elapsed time always goes to
+    # the current stage, so nested stages (reading while parsing, say) are
+    # counted exclusively. Meant for one conversion at a time in one thread.
+    def __init__(self):
+        import time
+        self._clock = time.perf_counter
+        self.stages = {}  # stage -> [seconds, calls, bytes]
+        self.engine_passes = []
+        self._stage = 'other'
+        self._started = self._since = self._clock()
+
+    def switch(self, stage: str) -> str:
+        # Make stage current; returns the previous one so callers can switch back
+        now = self._clock()
+        entry = self.stages.get(self._stage)
+        if entry is None:
+            entry = self.stages[self._stage] = [0.0, 0, 0]
+        entry[0] += now - self._since
+        previous, self._stage, self._since = self._stage, stage, now
+        return previous
+
+    def relabel(self, stage: str):
+        # Rename the current stage; the time since the last switch goes to the new name
+        self._stage = stage
+
+    def count(self, stage: str, nbytes: int = 0, calls: int = 1):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0.0, 0, 0]
+        entry[1] += calls
+        entry[2] += nbytes
+
+    def engine_pass(self, engine: str, tex_file: str, seconds: float, returncode: int, use_format: bool = False):
+        passes = sum(1 for p in self.engine_passes if p['tex'] == tex_file)
+        self.engine_passes.append({'type': 'engine_pass', 'engine': engine, 'tex': tex_file, 'pass': passes + 1,
+                                   'seconds': seconds, 'returncode': returncode, 'format': use_format})
+
+    def records(self, **context) -> list:
+        # Flat dicts ready for JSON lines; context (e.g. input=path) is added to each
+        self.switch(self._stage)  # bring the current stage up to date
+        records = []
+        for name, (seconds, calls, nbytes) in sorted(self.stages.items()):
+            stage, _, block = name.partition(':')
+            records.append(dict(context, type='stage', stage=stage, block=block or None, seconds=seconds,
+                                calls=calls, bytes=nbytes))
+        records.extend(dict(context, **p) for p in self.engine_passes)
+        records.append(dict(context, type='total', seconds=self._clock() - self._started))
+        return records
+
+    def write_jsonl(self, f, **context):
+        import json
+        for record in self.records(**context):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+# The active profiler, if any. Anything with switch/relabel/count/engine_pass
+# works, so callers can forward the numbers elsewhere as they are recorded.
+_PROFILER = None
+
+def enable_profiling(profiler=None):
+    # Profile the conversions and compiles that follow; returns the profiler
+    global _PROFILER
+    _PROFILER = profiler if profiler is not None else Profiler()
+    return _PROFILER
+
+def disable_profiling():
+    # Stop profiling; returns the profiler that was active (or None)
+    global _PROFILER
+    profiler, _PROFILER = _PROFILER, None
+    return profiler
+
+def _profile_iter(iterable, stage: str, profiler, measure=None, calls: bool = True):
+    # Yield from iterable, attributing the time spent producing each item to stage.
+    # Each item counts as a call (unless calls is off) and measure(item) bytes, both
+    # booked to the stage the iterable was in when it produced the item.
+    it = iter(iterable)
+    current = stage
+    while True:
+        previous = profiler.switch(current)
+        try:
+            item = next(it)
+        except StopIteration:
+            profiler.switch(previous)
+            return
+        # The iterable may have moved on to a sub-stage; resume there next time
+        current = profiler.switch(previous)
+        profiler.count(current, measure(item) if measure is not None else 0, 1 if calls else 0)
+        yield item
+
+def _utf8_len(text: str) -> int:
+    return len(text.encode('utf-8'))
+
+def _source_bytes(block) -> int:
+    kind, data = block
+    if kind == 'line':
+        return len(data.encode('utf-8')) + 1
+    if kind == 'table':
+        headers, rows = data
+        return sum(len(' | '.join(cells).encode('utf-8')) + 5 for cells in [headers] + rows)
+    if kind == 'rule':
+        return 4
+    if kind == 'csv':
+        return os.path.getsize(data) if os.path.isfile(data) else 0
+    if kind == 'input':
+        return 0
+    return sum(len(line.encode('utf-8')) + 1 for line in data)
+
+def _profile_nodes(blocks, profiler):
+    # _block_node over blocks, timing node construction (mostly inline parsing) and
+    # then the rendering of the node, both per block type. Inline stages count
+    # source bytes, render stages output bytes.
+    for block in blocks:
+        profiler.switch('inline')
+        node = _block_node(block)
+        block_type = type(node).__name__
+        profiler.relabel('inline:' + block_type)
+        profiler.count('inline:' + block_type, _source_bytes(block))
+        profiler.switch('render:' + block_type)
+        profiler.count('render:' + block_type, 0)
+        yield node
+
+# All heading prefixes, to test a line in one startswith before HEADING_COMMANDS
+HEADING_PREFIXES = tuple(prefix for prefix, _ in HEADING_COMMANDS)
+
+class DocumentFacts:
+    # What a document needs and contains, gathered from the block stream during the
+    # conversion itself: needs_unicode_engine (non-ASCII in code blocks, which
+    # pdflatex cannot typeset verbatim), needs_hyperref (links), has_tables,
+    # has_math, has_code, max_list_depth and headings. Picklable, so parallel
+    # renders send them back from the workers.
+    __slots__ = ('needs_unicode_engine', 'needs_hyperref', 'has_tables', 'has_math', 'has_code',
+                 'max_list_depth', 'headings')
+
+    def __init__(self):
+        self.needs_unicode_engine = False
+        self.needs_hyperref = False
+        self.has_tables = False
+        self.has_math = False
+        self.has_code = False
+        self.max_list_depth = 0
+        self.headings = 0
+
+    def observe(self, blocks):
+        # Pass (kind, data) blocks through unchanged while recording facts. Line
+        # checks are str methods (C loops); regexes only run on likely list items.
+        for block in blocks:
+            kind, data = block
+            if kind == 'line':
+                first = data[:1]
+                if first == '#':
+                    if data.startswith(HEADING_PREFIXES):
+                        self.headings += 1
+                elif first == '-' or first == '*' or first.isspace() or first.isdigit():
+                    rest = data.lstrip()
+                    first = rest[:1]
+                    if (first == '-' or first == '*') and rest[1:2].isspace() \
+                            or first.isdigit() and OL_ITEM_RE.match(data):
+                        depth = (len(data) - len(rest)) // 2 + 1
+                        if depth > self.max_list_depth:
+                            self.max_list_depth = depth
+                if '](' in data:
+                    self.needs_hyperref = True
+                if not self.has_math and '$' in data:
+                    self.has_math = data.count('$') > 1
+            elif kind == 'code':
+                self.has_code = True
+                if not self.needs_unicode_engine:
+                    self.needs_unicode_engine = not all(map(str.isascii, data))
+            elif kind == 'table' or kind == 'csv':
+                self.has_tables = True
+            elif kind == 'math':
+                self.has_math = True
+            yield block
+
+    def merge(self, other: 'DocumentFacts'):
+        self.needs_unicode_engine |= other.needs_unicode_engine
+        self.needs_hyperref |= other.needs_hyperref
+        self.has_tables |= other.has_tables
+        self.has_math |= other.has_math
+        self.has_code |= other.has_code
+        self.max_list_depth = max(self.max_list_depth, other.max_list_depth)
+        self.headings += other.headings
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f'DocumentFacts({self.to_dict()})'
+
+# Parallel rendering hands each worker a run of about this many source lines;
+# documents shorter than two runs render in-process
+PARALLEL_RUN_LINES = 4096
+
+def _iter_source_runs(lines, run_lines: int):
+    # Cut source lines into runs of at least run_lines lines, each ending on a blank
+    # line or heading that looks top-level: outside fenced code and display math,
+    # tracked like _iter_blocks does. Tables are not tracked; _render_run checks
+    # every cut.
+    run = []
+    fence = None
+    for line in lines:
+        run.append(line)
+        stripped = line.strip()
+        if fence is not None:
+            if (fence == '$$' and stripped.startswith('$$')) or (fence == '[' and stripped == ']') \
+                    or (fence == '```' and (line.startswith('```') or line.startswith('~~~'))):
+                fence = None
+            continue
+        if stripped.startswith('$$'):
+            fence = '$$'
+        elif stripped == '[':
+            fence = '['
+        elif line.startswith('```') or line.startswith('~~~'):
+            fence = '```'
+        elif len(run) >= run_lines and (not stripped or (line.startswith('#') and '|' not in line)):
+            yield run
+            run = []
+    if run:
+        yield run
+
+def _render_run(lines, base_dir: str = None, code_files: CodeFiles = None, limits: ConversionLimits = None):
+    # Worker side of _render_parallel: (body text, line count, clean, facts) for a
+    # run rendered from a fresh state. clean means the run's last line was lexed at
+    # top level as a blank line or a heading (with no table lookahead pending), so
+    # the next run also starts from a fresh state.
+    import operator
+
+    source = iter(lines)
+    last = None
+
+    def blocks():
+        nonlocal last
+        for block in _iter_blocks(source, base_dir):
+            # length_hint on a list iterator = source lines not yet read by the lexer
+            last = block, operator.length_hint(source)
+            yield block
+
+    facts = DocumentFacts()
+    stream = facts.observe(_limit_blocks(blocks(), limits))
+    if code_files is not None:
+        stream = _externalize_code(stream, code_files)
+    out = list(_render_blocks(stream))
+    clean = last is not None and last[1] == 0 and _ends_chunk(*last[0]) and '|' not in last[0][1]
+    return '\n'.join(out), len(out), clean, facts
+
+def _render_parallel(lines, jobs: int, run_lines: int = PARALLEL_RUN_LINES, base_dir: str = None,
+                     code_files: CodeFiles = None, facts: DocumentFacts = None, limits: ConversionLimits = None):
+    # Same output as _render_blocks(_iter_blocks(lines)), in '\n'-joined pieces.
+    # Runs are lexed and rendered in a process pool and stitched back in order. A
+    # run whose cut turned out not to be top-level (the fence tracking cannot see
+    # table rows) is re-rendered in-process together with the next run. The facts
+    # of every run whose rendering is used are merged into facts.
+    import collections
+    import itertools
+    import time
+    from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+    runs = _iter_source_runs(lines, run_lines)
+    head = list(itertools.islice(runs, 2))
+    if len(head) < 2:
+        for run in head:
+            text, count, _, run_facts = _render_run(run, base_dir, code_files, limits)
+            if facts is not None:
+                facts.merge(run_facts)
+            if count:
+                yield text
+        return
+
+    carry = None  # source of runs whose rendering could not be used on its own
+    deadline = limits.deadline() if limits is not None else None
+
+    def resolve(run, future, is_last):
+        nonlocal carry
+        if carry is None:
+            if deadline is None:
+                text, count, clean, run_facts = future.result()
+            else:
+                try:
+                    text, count, clean, run_facts = future.result(max(0.0, deadline - time.monotonic()))
+                except FutureTimeout:
+                    raise limits.timed_out() from None
+        else:
+            future.cancel()
+            run = carry + run
+            text, count, clean, run_facts = _render_run(run, base_dir, code_files, limits)
+        if clean or is_last:
+            carry = None
+            if facts is not None:
+                facts.merge(run_facts)
+            return text if count else None
+        carry = run
+        return None
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque()
+        try:
+            for run in itertools.chain(head, runs):
+                pending.append((run, pool.submit(_render_run, run, base_dir, code_files, limits)))
+                # Bound the runs and results held in memory
+                if len(pending) >= 2 * jobs:
+                    text = resolve(*pending.popleft(), False)
+                    if text is not None:
+                        yield text
+            while pending:
+                run, future = pending.popleft()
+                text = resolve(run, future, not pending)
+                if text is not None:
+                    yield text
+        except BaseException:
+            # A limit was hit or the consumer stopped: do not render the queued runs
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+def _iter_document(body, preamble: str = LATEX_PREAMBLE, body_only: bool = False):
+    # Join body lines with '\n' and wrap them in the document skeleton, as text chunks
+    if not body_only:
+        yield preamble + DOCUMENT_BEGIN
+    first = next(body, None)
+    if first is not None:
+        yield first
+        for out in body:
+            yield '\n' + out
+    if not body_only:
+        yield DOCUMENT_END
+
+def iter_latex(lines, engine: str = 'pdflatex', system_name: str = None, cache: BlockCache = None,
+               jobs: int = 1, base_dir: str = None, code_files: CodeFiles = None, facts: DocumentFacts = None,
+               limits: ConversionLimits = None):
+    # Stream a complete LaTeX document as text chunks from an iterable of Markdown
+    # lines (without newlines). Only the block being rendered is held in memory.
+    # With a BlockCache, unchanged chunks are served from the cache; otherwise
+    # jobs > 1 renders large documents in that many worker processes. CSV tables
+    # referenced with relative paths are looked up in base_dir; with code_files,
+    # large code blocks go to side files. A DocumentFacts passed as facts is filled
+    # in as the blocks go by (complete once the output is exhausted). limits (by
+    # default those from set_conversion_limits) raise ConversionLimitError while
+    # the output is being produced.
+    limits = limits if limits is not None else _CONVERSION_LIMITS
+    if limits is not None:
+        if limits.started is None:
+            limits = limits.start()
+        lines = _limit_lines(lines, limits)
+    profiler = _PROFILER
+    if profiler is not None:
+        body = _profiled_body(lines, cache, jobs, base_dir, code_files, facts, profiler, limits)
+        return _iter_document(_profile_iter(body, 'render', profiler, measure=_utf8_len, calls=False))
+    if cache is None and jobs > 1:
+        body = _render_parallel(lines, jobs, base_dir=base_dir, code_files=code_files, facts=facts, limits=limits)
+    else:
+        blocks = _limit_blocks(_iter_blocks(lines, base_dir), limits)
+        if facts is not None:
+            blocks = facts.observe(blocks)
+        if code_files is not None:
+            blocks = _externalize_code(blocks, code_files)
+        body = _render_cached(blocks, cache) if cache is not None else _render_blocks(blocks)
+    return _iter_document(body)
+
+def _profiled_body(lines, cache, jobs, base_dir, code_files, facts, profiler, limits=None):
+    # Body lines as in iter_latex, with the lexer and (for serial renders) each block
+    # timed. Cached and parallel renders are only timed as a whole.
+    if cache is None and jobs > 1:
+        return _render_parallel(lines, jobs, base_dir=base_dir, code_files=code_files, facts=facts, limits=limits)
+    blocks = _limit_blocks(_profile_iter(_iter_blocks(lines, base_dir), 'parse', profiler), limits)
+    if facts is not None:
+        blocks = facts.observe(blocks)
+    if code_files is not None:
+        blocks = _externalize_code(blocks, code_files)
+    if cache is not None:
+        return _render_cached(blocks, cache)
+    return _render_nodes(_profile_nodes(blocks, profiler))
+
+def convert_stream(infile, outfile, engine: str = 'pdflatex', system_name: str = None, cache: BlockCache = None,
+                   jobs: int = 1, base_dir: str = None, code_files: CodeFiles = None, facts: DocumentFacts = None,
+                   limits: ConversionLimits = None):
+    # Read Markdown from a text file object and write LaTeX to another as blocks complete
+    profiler = _PROFILER
+    if profiler is not None:
+        infile = _profile_iter(infile, 'read', profiler, measure=_utf8_len)
+    _write_latex(_iter_source_lines(infile), outfile, profiler, engine=engine, system_name=system_name,
+                 cache=cache, jobs=jobs, base_dir=base_dir, code_files=code_files, facts=facts, limits=limits)
+
+def _write_latex(lines, outfile, profiler, **options):
+    if profiler is None:
+        outfile.writelines(iter_latex(lines, **options))
+        return
+    for text in iter_latex(lines, **options):
+        previous = profiler.switch('write')
+        outfile.write(text)
+        profiler.switch(previous)
+        profiler.count('write', _utf8_len(text))
+
+# Files are read in chunks of this size; all-ASCII chunks skip the UTF-8 decoder
+READ_CHUNK_BYTES = 1 << 20
+
+def _iter_file_lines(path: str, start: int = 0, end: int = None):
+    # Lines of a UTF-8 text file without their newlines, with the same newline
+    # translation and final-line behaviour as iterating open(path) through
+    # _iter_source_lines, but split with str.split on large chunks. With start and
+    # end (byte offsets of line starts, as in a SectionIndex), only the lines that
+    # start in that range, exactly as they are among the lines of the whole file.
+    import codecs
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    carry = ''
+    with open(path, 'rb') as f:
+        # The empty line after a range's last newline starts at end: part of the next range
+        partial = end is not None and end < os.fstat(f.fileno()).st_size
+        if start:
+            f.seek(start)
+        while True:
+            chunk = f.read(READ_CHUNK_BYTES if end is None else max(0, min(READ_CHUNK_BYTES, end - f.tell())))
+            text = chunk.decode('ascii') if chunk.isascii() and not decoder.getstate()[0] \
+                else decoder.decode(chunk, final=not chunk)
+            text = carry + text
+            # Hold back a trailing '\r' in case the next chunk starts with '\n'
+            hold = ''
+            if chunk and text.endswith('\r'):
+                text, hold = text[:-1], '\r'
+            if '\r' in text:
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+            if not chunk:
+                lines = text.split('\n')
+                if partial and not lines[-1]:
+                    lines.pop()
+                yield from lines
+                return
+            lines = text.split('\n')
+            carry = lines.pop() + hold
+            yield from lines
+
+def md_to_latex(md_text, engine: str = 'pdflatex', system_name: str = None, cache: BlockCache = None,
+                jobs: int = 1, base_dir: str = None, code_files: CodeFiles = None, facts: DocumentFacts = None,
+                limits: ConversionLimits = None):
+    limits = limits if limits is not None else _CONVERSION_LIMITS
+    if limits is not None:
+        limits = limits.for_text(md_text)
+    return ''.join(iter_latex(md_text.split('\n'), engine=engine, system_name=system_name, cache=cache, jobs=jobs,
+                              base_dir=base_dir, code_files=code_files, facts=facts, limits=limits))
+
+# Bumped whenever the node data layout changes
+DOCUMENT_FORMAT_VERSION = 2
+
+class SectionNotFound(KeyError):
+    # No heading with the requested title (Document.section, SectionIndex, --section)
+    pass
+
+class Document:
+    # A parsed Markdown document: a flat list of block nodes. Parse once, then
+    # render as many variants as needed (engine-specific preambles, body only,
+    # single sections). Serializes to JSON with to_json(); nodes also pickle.
+    __slots__ = ('blocks',)
+
+    def __init__(self, blocks=()):
+        self.blocks = list(blocks)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.blocks == other.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def headings(self) -> list:
+        # (level, title) for every heading, in document order
+        return [(node.level, node.title) for node in self.blocks if type(node) is Heading]
+
+    def section(self, title: str) -> 'Document':
+        # The first heading with this title plus everything up to the next heading
+        # of the same or a higher level
+        blocks = self.blocks
+        for start, node in enumerate(blocks):
+            if type(node) is Heading and node.title == title:
+                end = start + 1
+                while end < len(blocks) and not (type(blocks[end]) is Heading and blocks[end].level <= node.level):
+                    end += 1
+                return Document(blocks[start:end])
+        raise SectionNotFound(title)
+
+    def iter_latex(self, engine: str = None, body_only: bool = False):
+        # LaTeX text chunks; engine picks the preamble (see latex_preamble)
+        return _iter_document(_render_nodes(iter(self.blocks)), latex_preamble(engine), body_only)
+
+    def render(self, engine: str = None, body_only: bool = False) -> str:
+        return ''.join(self.iter_latex(engine, body_only))
+
+    def to_data(self) -> dict:
+        return {'version': DOCUMENT_FORMAT_VERSION, 'blocks': [node.to_data() for node in self.blocks]}
+
+    @classmethod
+    def from_data(cls, data: dict) -> 'Document':
+        if data.get('version') != DOCUMENT_FORMAT_VERSION:
+            raise ValueError(f'unsupported document format version: {data.get("version")!r}')
+        return cls(_block_from_data(block) for block in data['blocks'])
+
+    def to_json(self) -> str:
+        import json
+        return json.dumps(self.to_data(), ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text: str) -> 'Document':
+        import json
+        return cls.from_data(json.loads(text))
+
+def parse_markdown(md_text: str, base_dir: str = None) -> Document:
+    return Document(parse_blocks(md_text.split('\n'), base_dir))
+
+def parse_stream(infile, base_dir: str = None) -> Document:
+    # Parse Markdown from a text file object
+    return Document(parse_blocks(_iter_source_lines(infile), base_dir))
+
+class Converter:
+    # Conversion settings fixed once for many in-process conversions (a web service,
+    # a worker loop): the preamble (picked by engine like Document.render, given in
+    # full, or left out with body_only), the Unicode symbol map, inline memos and
+    # limits. Lookup tables are built here, not per call. A Converter keeps no
+    # per-conversion state and its memos are locked, so one instance can serve any
+    # number of threads. It does not use the process-wide settings: neither
+    # set_conversion_limits, set_inline_memo_size nor the shared inline memos.
+
+    def __init__(self, engine: str = None, preamble: str = None, body_only: bool = False,
+                 unicode_map: dict = None, memo_bytes: int = INLINE_MEMO_BYTES,
+                 limits: ConversionLimits = None, base_dir: str = None):
+        # unicode_map replaces UNICODE_MAP (extend it with {**UNICODE_MAP, ...});
+        # memo_bytes caps each of the two inline memos, 0 turns them off
+        self.engine = engine
+        self.preamble = preamble if preamble is not None else latex_preamble(engine)
+        self.body_only = body_only
+        self.limits = limits
+        self.base_dir = base_dir
+        self.escape = escape_latex if unicode_map is None else _make_escape(unicode_map)
+        self.inline_memo = InlineMemo(memo_bytes)
+        self.cell_memo = InlineMemo(memo_bytes)
+
+    def __repr__(self):
+        return (f'Converter(engine={self.engine!r}, body_only={self.body_only!r}, '
+                f'limits={self.limits!r}, base_dir={self.base_dir!r})')
+
+    def _nodes(self, lines, base_dir: str = None, facts: DocumentFacts = None, limits: ConversionLimits = None):
+        if limits is not None:
+            if limits.started is None:
+                limits = limits.start()
+            lines = _limit_lines(lines, limits)
+        blocks = _limit_blocks(_iter_blocks(lines, base_dir if base_dir is not None else self.base_dir), limits)
+        if facts is not None:
+            blocks = facts.observe(blocks)
+        inline, cells = self.inline_memo.nodes, self.cell_memo.nodes
+        return (_block_node(block, inline, cells) for block in blocks)
+
+    def iter_latex(self, lines, base_dir: str = None, facts: DocumentFacts = None,
+                   limits: ConversionLimits = None):
+        # LaTeX text chunks for an iterable of Markdown lines (without newlines);
+        # base_dir and limits default to the converter's
+        limits = limits if limits is not None else self.limits
+        body = _render_nodes(self._nodes(lines, base_dir, facts, limits), escape=self.escape)
+        return _iter_document(body, self.preamble, self.body_only)
+
+    def convert(self, md_text: str, base_dir: str = None, facts: DocumentFacts = None,
+                limits: ConversionLimits = None) -> str:
+        limits = limits if limits is not None else self.limits
+        if limits is not None:
+            limits = limits.for_text(md_text)
+        return ''.join(self.iter_latex(md_text.split('\n'), base_dir, facts, limits))
+
+    def convert_stream(self, infile, outfile, base_dir: str = None, facts: DocumentFacts = None,
+                       limits: ConversionLimits = None):
+        # Read Markdown from a text file object and write LaTeX to another as blocks complete
+        outfile.writelines(self.iter_latex(_iter_source_lines(infile), base_dir, facts, limits))
+
+    def convert_many(self, texts, threads: int = None) -> list:
+        # LaTeX for each Markdown text, in order. threads > 1 converts in a thread
+        # pool of that size: useful on free-threaded Python, while with the GIL it
+        # mostly overlaps CSV reads. The first failed conversion's error is raised.
+        texts = list(texts)
+        if not threads or threads <= 1 or len(texts) < 2:
+            return [self.convert(text) for text in texts]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(min(threads, len(texts))) as pool:
+            return list(pool.map(self.convert, texts))
+
+    def parse(self, md_text: str, base_dir: str = None) -> Document:
+        # Document tree through the converter's memos; render it with render()
+        return Document(self._nodes(md_text.split('\n'), base_dir))
+
+    def render(self, document: Document) -> str:
+        # A Document with the converter's preamble and Unicode map
+        return ''.join(_iter_document(_render_nodes(iter(document.blocks), escape=self.escape),
+                                      self.preamble, self.body_only))
+
+    def memo_stats(self) -> dict:
+        # {'inline': stats, 'cells': stats} for this converter's memos, as InlineMemo.stats()
+        return {'inline': self.inline_memo.stats(), 'cells': self.cell_memo.stats()}
+
+def _common_engine_paths(system: str) -> dict:
+    # Known install locations, searched when an engine is not on PATH
+    common_paths_map = {
+        'Windows': {
+            'pdflatex': [
+                rf'C:\\Users\\{os.environ.get("USERNAME", "user")}\\AppData\\Local\\Programs\\MiKTeX\\miktex\\bin\\x64\\pdflatex.exe',
+                r'C:\\Program Files\\MiKTeX\\miktex\\bin\\x64\\pdflatex.exe',
+                r'C:\\texlive\\2024\\bin\\win32\\pdflatex.exe',
+                r'C:\\texlive\\2024\\bin\\windows\\pdflatex.exe',
+            ],
+            'xelatex': [
+                rf'C:\\Users\\{os.environ.get("USERNAME", "user")}\\AppData\\Local\\Programs\\MiKTeX\\miktex\\bin\\x64\\xelatex.exe',
+                r'C:\\Program Files\\MiKTeX\\miktex\\bin\\x64\\xelatex.exe',
+                r'C:\\texlive\\2024\\bin\\win32\\xelatex.exe',
+                r'C:\\texlive\\2024\\bin\\windows\\xelatex.exe',
+            ],
+            'lualatex': [
+                rf'C:\\Users\\{os.environ.get("USERNAME", "user")}\\AppData\\Local\\Programs\\MiKTeX\\miktex\\bin\\x64\\lualatex.exe',
+                r'C:\\Program Files\\MiKTeX\\miktex\\bin\\x64\\lualatex.exe',
+                r'C:\\texlive\\2024\\bin\\win32\\lualatex.exe',
+                r'C:\\texlive\\2024\\bin\\windows\\lualatex.exe',
+            ],
+        },
+        'Linux': {
+            'pdflatex': [
+                '/usr/bin/pdflatex', '/usr/local/bin/pdflatex',
+                '/usr/local/texlive/2024/bin/x86_64-linux/pdflatex',
+                '/opt/texlive/2024/bin/x86_64-linux/pdflatex',
+            ],
+            'xelatex': [
+                '/usr/bin/xelatex', '/usr/local/bin/xelatex',
+                '/usr/local/texlive/2024/bin/x86_64-linux/xelatex',
+                '/opt/texlive/2024/bin/x86_64-linux/xelatex',
+            ],
+            'lualatex': [
+                '/usr/bin/lualatex', '/usr/local/bin/lualatex',
+                '/usr/local/texlive/2024/bin/x86_64-linux/lualatex',
+                '/opt/texlive/2024/bin/x86_64-linux/lualatex',
+            ],
+        },
+        'Darwin': {  # macOS
+            'pdflatex': [
+                '/Library/TeX/texbin/pdflatex',
+                '/usr/local/texlive/2024/bin/universal-darwin/pdflatex',
+                '/usr/local/texlive/2024/bin/arm64-darwin/pdflatex',
+                '/usr/local/texlive/2023/bin/universal-darwin/pdflatex',
+                '/usr/local/texlive/2023/bin/arm64-darwin/pdflatex',
+                '/opt/local/bin/pdflatex',            # MacPorts
+                '/opt/homebrew/bin/pdflatex',         # Homebrew (Apple Silicon)
+                '/usr/local/bin/pdflatex',
+            ],
+            'xelatex': [
+                '/Library/TeX/texbin/xelatex',
+                '/usr/local/texlive/2024/bin/universal-darwin/xelatex',
+                '/usr/local/texlive/2024/bin/arm64-darwin/xelatex',
+                '/usr/local/texlive/2023/bin/universal-darwin/xelatex',
+                '/usr/local/texlive/2023/bin/arm64-darwin/xelatex',
+                '/opt/local/bin/xelatex',             # MacPorts
+                '/opt/homebrew/bin/xelatex',          # Homebrew (Apple Silicon)
+                '/usr/local/bin/xelatex',
+            ],
+            'lualatex': [
+                '/Library/TeX/texbin/lualatex',
+                '/usr/local/texlive/2024/bin/universal-darwin/lualatex',
+                '/usr/local/texlive/2024/bin/arm64-darwin/lualatex',
+                '/usr/local/texlive/2023/bin/universal-darwin/lualatex',
+                '/usr/local/texlive/2023/bin/arm64-darwin/lualatex',
+                '/opt/local/bin/lualatex',            # MacPorts
+                '/opt/homebrew/bin/lualatex',         # Homebrew (Apple Silicon)
+                '/usr/local/bin/lualatex',
+            ],
+        },
+    }
+    return common_paths_map.get(system, {})
+
+ENGINE_NAMES = ('pdflatex', 'xelatex', 'lualatex')
+
+def _system_name() -> str:
+    # platform.system() without importing platform for the common cases
+    names = {'win32': 'Windows', 'darwin': 'Darwin', 'linux': 'Linux'}
+    if sys.platform in names:
+        return names[sys.platform]
+    import platform
+    return platform.system()
+
+def _config_dir() -> str:
+    # Per-user config directory (MD2TEX_CONFIG_DIR overrides the platform default)
+    base = os.environ.get('MD2TEX_CONFIG_DIR')
+    if not base:
+        if os.name == 'nt':
+            root = os.environ.get('APPDATA') or os.path.expanduser('~')
+        else:
+            root = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+        base = os.path.join(root, 'md2tex')
+    os.makedirs(base, exist_ok=True)
+    return base
+
+def _mtime_ns(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _discover_engines() -> dict:
+    # Probe every engine on PATH, then in known install locations
+    import shutil
+
+    common_paths = _common_engine_paths(_system_name())
+    engines = {}
+    for eng in ENGINE_NAMES:
+        p = shutil.which(eng)
+        if p:
+            engines[eng] = {'path': p, 'source': 'path'}
+            continue
+        # Fallback search in common locations if not found via PATH
+        for path in common_paths.get(eng, []):
+            if os.path.exists(path):
+                engines[eng] = {'path': path, 'source': 'common'}
+                break
+    for entry in engines.values():
+        entry['mtime_ns'] = _mtime_ns(entry['path'])
+    search_path = os.environ.get('PATH', '')
+    return {
+        'version': 1,
+        'PATH': search_path,
+        # Installing or removing an engine changes the mtime of its PATH directory
+        'path_dirs': {d: _mtime_ns(d) for d in search_path.split(os.pathsep) if d},
+        'engines': engines,
+    }
+
+def _engine_cache_valid(data: dict) -> bool:
+    if data.get('version') != 1 or data.get('PATH') != os.environ.get('PATH', ''):
+        return False
+    if any(_mtime_ns(d) != m for d, m in data.get('path_dirs', {}).items()):
+        return False
+    return all(_mtime_ns(e['path']) == e['mtime_ns'] for e in data.get('engines', {}).values())
+
+def _save_engine_cache(data: dict):
+    import json
+
+    path = os.path.join(_config_dir(), 'engines.json')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+_ENGINE_CACHE = None
+
+def installed_engines(refresh: bool = False) -> dict:
+    # {engine: {'path', 'source', 'mtime_ns'[, 'version']}} from the per-user engine cache
+    # (<config dir>/engines.json), re-probed when PATH, a PATH directory or an engine binary
+    # changed since it was written. Loaded once per process.
+    global _ENGINE_CACHE
+    if _ENGINE_CACHE is None or refresh:
+        data = None
+        if not refresh:
+            import json
+            try:
+                with open(os.path.join(_config_dir(), 'engines.json'), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = None
+            if data is not None and not _engine_cache_valid(data):
+                data = None
+        if data is None:
+            data = _discover_engines()
+            _save_engine_cache(data)
+        _ENGINE_CACHE = data
+    return _ENGINE_CACHE['engines']
+
+def find_latex_engine(needs_unicode_engine: bool = False):
+    # Determine LaTeX engine (prefer xelatex/lualatex when Unicode in code blocks).
+    # Returns (engine_name, engine_path), or (None, None) when nothing is installed.
+    if needs_unicode_engine:
+        candidates = ['xelatex', 'lualatex', 'pdflatex']
+    else:
+        candidates = ['pdflatex', 'xelatex', 'lualatex']
+
+    engines = installed_engines()
+    # Engines on PATH win over known install locations
+    for source in ('path', 'common'):
+        for eng in candidates:
+            entry = engines.get(eng)
+            if entry and entry['source'] == source:
+                return eng, entry['path']
+    return None, None
+
+# Split output: one .tex per top-level (#) section in <stem>-sections/ next to the master
+SECTIONS_DIR_SUFFIX = '-sections'
+SECTION_NAME_MAX = 40
+SECTION_NAME_RE = re.compile(r'[^a-z0-9]+')
+
+def _section_slug(title: str) -> str:
+    # File name part for a section title: lowercase ASCII letters, digits and dashes
+    return SECTION_NAME_RE.sub('-', title.lower()).strip('-')[:SECTION_NAME_MAX].rstrip('-') or 'section'
+
+class SectionFiles:
+    # Section files for split output. Each top-level section is written to
+    # directory/<name>.tex and pulled into the master .tex with \include{prefix + name}.
+    # Names come from the heading text, so adding or removing a section leaves the
+    # other files alone, and a file is only rewritten when its content changed.
+    # With changed_only, the master also gets \includeonly for the rewritten
+    # sections: the engine typesets just those and takes the other sections'
+    # numbers and labels from their .aux files in the build directory.
+    __slots__ = ('directory', 'prefix', 'changed_only', 'names', 'changed', '_used')
+
+    def __init__(self, directory: str, prefix: str, changed_only: bool = False):
+        self.directory = directory
+        self.prefix = prefix  # path of directory as seen from the master .tex
+        self.changed_only = changed_only
+        self.names = []  # section names in document order, from the last conversion
+        self.changed = []  # the names among them whose file that conversion rewrote
+        self._used = set()
+
+    @classmethod
+    def for_document(cls, tex_dir: str, stem: str, changed_only: bool = False) -> 'SectionFiles':
+        # <stem>-sections/ in the .tex directory (spaces replaced, as \include paths may not contain them)
+        name = stem.replace(' ', '_') + SECTIONS_DIR_SUFFIX
+        return cls(os.path.join(tex_dir, name), name + '/', changed_only)
+
+    def reset(self):
+        self.names, self.changed, self._used = [], [], set()
+
+    def store(self, title: str, text: str) -> str:
+        # Write one section's LaTeX unless the file already holds it; returns the name
+        slug = _section_slug(title)
+        name, n = slug, 1
+        while name in self._used:
+            n += 1
+            name = f'{slug}-{n}'
+        self._used.add(name)
+        self.names.append(name)
+        data = text.encode('utf-8')
+        path = os.path.join(self.directory, name + '.tex')
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == len(data) and f.read() == data:
+                    return name
+        except OSError:
+            pass
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.changed.append(name)
+        return name
+
+    def paths(self) -> list:
+        # Files of the sections from the last conversion
+        return [os.path.join(self.directory, name + '.tex') for name in self.names]
+
+    def include_only(self):
+        # Names for \includeonly, or None for a full build (nothing or everything rewritten)
+        if self.changed_only and self.changed and len(self.changed) < len(self.names):
+            return list(self.changed)
+        return None
+
+    def prune(self) -> int:
+        # Remove section files the last conversion did not write; returns how many
+        if not os.path.isdir(self.directory):
+            return 0
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.tex') and name[:-4] not in self._used:
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+        return removed
+
+def _sections_dir(tex_file: str):
+    # The split output's section directory for a master .tex, or None
+    stem = os.path.splitext(os.path.basename(tex_file))[0]
+    path = os.path.join(os.path.dirname(os.path.abspath(tex_file)), stem.replace(' ', '_') + SECTIONS_DIR_SUFFIX)
+    return path if os.path.isdir(path) else None
+
+def _section_files(input_file: str, split: str = None):
+    # SectionFiles for the --split mode (None, 'all' or 'changed') of a Markdown file
+    if not split:
+        return None
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    return SectionFiles.for_document(os.path.dirname(os.path.abspath(input_file)), stem, split == 'changed')
+
+def _format_sections(sections: SectionFiles) -> str:
+    rewritten = len(sections.changed)
+    return f'{len(sections.names)} section files, {rewritten} rewritten'
+
+def _iter_sections(blocks):
+    # Group a block stream at top-level (#) headings into (title, blocks) pairs; the
+    # blocks before the first heading come first, with title None. Headings close
+    # every open list, so each group renders on its own.
+    title, section = None, []
+    for block in blocks:
+        kind, data = block
+        if kind == 'line' and data.startswith('# '):
+            if section:
+                yield title, section
+            title, section = _clean_heading_text(data[2:]), []
+        section.append(block)
+    if section:
+        yield title, section
+
+def _write_split(lines, outfile, sections: SectionFiles, cache: BlockCache = None, base_dir: str = None,
+                 code_files: CodeFiles = None, facts: DocumentFacts = None, profiler=None,
+                 limits: ConversionLimits = None):
+    # Split conversion: sections go to their files through sections.store, then the
+    # master (preamble, the text before the first section, \include lines) is written
+    # to outfile. The master comes last since \includeonly must precede \begin{document}.
+    sections.reset()
+    if limits is not None:
+        lines = _limit_lines(lines, limits)
+    blocks = _limit_blocks(_iter_blocks(lines, base_dir), limits)
+    if profiler is not None:
+        blocks = _profile_iter(blocks, 'parse', profiler)
+    if facts is not None:
+        blocks = facts.observe(blocks)
+    if code_files is not None:
+        blocks = _externalize_code(blocks, code_files)
+    body = []
+    for title, section in _iter_sections(blocks):
+        if cache is not None:
+            out_lines = _render_cached(section, cache)
+        elif profiler is not None:
+            out_lines = _render_nodes(_profile_nodes(section, profiler))
+        else:
+            out_lines = _render_blocks(section)
+        if title is None:
+            body.extend(out_lines)
+            continue
+        text = '\n'.join(out_lines) + '\n'
+        if profiler is not None:
+            previous = profiler.switch('write')
+            body.append('\\include{' + sections.prefix + sections.store(title, text) + '}')
+            profiler.switch(previous)
+            profiler.count('write', _utf8_len(text))
+        else:
+            body.append('\\include{' + sections.prefix + sections.store(title, text) + '}')
+    preamble = LATEX_PREAMBLE
+    only = sections.include_only()
+    if only:
+        preamble += '\\includeonly{' + ','.join(sections.prefix + name for name in only) + '}\n'
+    outfile.writelines(_iter_document(iter(body), preamble))
+
+# Bumped whenever the index layout or the rules for finding headings change
+SECTION_INDEX_VERSION = 2
+
+def _iter_line_offsets(path: str):
+    # (byte offset, line) for the lines of a UTF-8 file as _iter_file_lines splits them,
+    # less the empty line after a final newline. No UTF-8 sequence contains '\r' or
+    # '\n' bytes, so the raw lines can be split before decoding.
+    offset = 0
+    with open(path, 'rb') as f:
+        for raw in f:
+            content = raw
+            if raw.endswith(b'\n'):
+                content = raw[:-2] if raw.endswith(b'\r\n') else raw[:-1]
+            if b'\r' in content:
+                # Lone carriage returns end lines too
+                pos = offset
+                for part in content.split(b'\r'):
+                    yield pos, part.decode('utf-8')
+                    pos += len(part) + 1
+            else:
+                yield offset, content.decode('utf-8')
+            offset += len(raw)
+
+def _heading_entry(offset: int, line: str):
+    # [offset, level, title] when line is a heading (as _block_node reads it), else None
+    if line.startswith(HEADING_PREFIXES):
+        for prefix, _ in HEADING_COMMANDS:
+            if line.startswith(prefix):
+                return [offset, len(prefix) - 1, _clean_heading_text(line[len(prefix):])]
+    return None
+
+def _scan_headings(path: str):
+    # Headings of a Markdown file, for SectionIndex. Code fences, display math and
+    # tables are tracked exactly like _iter_blocks does, so only lines it would read
+    # as headings are listed.
+    headings = []
+    fence = None
+    in_table = False
+    candidate = None  # (offset, line) of a line with '|' that may be a table header
+    for offset, line in _iter_line_offsets(path):
+        if fence is not None:
+            stripped = line.strip()
+            if (fence == '$$' and stripped.startswith('$$')) or (fence == '[' and stripped == ']') \
+                    or (fence == '```' and (line.startswith('```') or line.startswith('~~~'))):
+                fence = None
+            continue
+        if in_table:
+            if '|' in line and line.strip():
+                continue
+            in_table = False
+        if candidate is not None:
+            if TABLE_SEP_RE.match(line):
+                candidate = None
+                in_table = True
+                continue
+            entry = _heading_entry(*candidate)
+            if entry is not None:
+                headings.append(entry)
+            candidate = None
+        stripped = line.strip()
+        if stripped.startswith('$$'):
+            fence = '$$'
+        elif stripped == '[':
+            fence = '['
+        elif line.startswith('```') or line.startswith('~~~'):
+            fence = '```'
+        elif stripped in HRULE_LINES or (stripped.startswith('<!--') and CSV_DIRECTIVE_RE.match(line)):
+            pass
+        elif '|' in line:
+            candidate = (offset, line)
+        else:
+            entry = _heading_entry(offset, line)
+            if entry is not None:
+                headings.append(entry)
+    if candidate is not None:
+        entry = _heading_entry(*candidate)
+        if entry is not None:
+            headings.append(entry)
+    return headings
+
+class SectionIndex:
+    # Where the sections of a Markdown file are: the byte offset, level and title of
+    # every heading. Built in one pass over the raw file without converting it, and
+    # cached as JSON under the cache directory until the file's size or mtime
+    # changes (see load). A section runs from its heading to the next
+    # heading of the same or a higher level, like Document.section. Headings are
+    # never inside a fence or a table and close every open list, so a section
+    # converts on its own to the same LaTeX it has within the whole document.
+    __slots__ = ('path', 'size', 'mtime_ns', 'headings')
+
+    def __init__(self, path: str, size: int, mtime_ns: int, headings=()):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.headings = list(headings)  # [offset, level, title] in document order
+
+    @classmethod
+    def build(cls, path: str) -> 'SectionIndex':
+        path = os.path.abspath(path)
+        # Stamp first: a file changed while it is scanned fails is_current() later
+        st = os.stat(path)
+        return cls(path, st.st_size, st.st_mtime_ns, _scan_headings(path))
+
+    @classmethod
+    def load(cls, path: str, refresh: bool = False) -> 'SectionIndex':
+        # The cached index of path, built and saved when missing or stale
+        import json
+
+        path = os.path.abspath(path)
+        cache_file = cls.cache_file(path)
+        if not refresh:
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    index = cls.from_data(json.load(f))
+                if index.path == path and index.is_current():
+                    return index
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        index = cls.build(path)
+        index.save(cache_file)
+        return index
+
+    @staticmethod
+    def cache_file(path: str) -> str:
+        import hashlib
+        digest = hashlib.sha256(os.path.abspath(path).encode('utf-8', 'surrogatepass')).hexdigest()
+        return os.path.join(_cache_dir('sections'), digest[:32] + '.json')
+
+    def save(self, cache_file: str):
+        import json
+
+        tmp_path = f'{cache_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_data(), f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, cache_file)
+        except OSError:
+            pass
+
+    def is_current(self) -> bool:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+    def section_range(self, title: str):
+        # (start, end) byte offsets of the first section with this title; SectionNotFound if none
+        headings = self.headings
+        for i, (offset, level, name) in enumerate(headings):
+            if name == title:
+                for next_offset, next_level, _ in headings[i + 1:]:
+                    if next_level <= level:
+                        return offset, next_offset
+                return offset, self.size
+        raise SectionNotFound(title)
+
+    def iter_section_lines(self, title: str):
+        # Markdown lines of a section, read from the file; SectionNotFound if there is none
+        start, end = self.section_range(title)
+        return _iter_file_lines(self.path, start, end)
+
+    def to_data(self) -> dict:
+        return {'version': SECTION_INDEX_VERSION, 'path': self.path, 'size': self.size, 'mtime_ns': self.mtime_ns,
+                'headings': self.headings}
+
+    @classmethod
+    def from_data(cls, data: dict) -> 'SectionIndex':
+        if data.get('version') != SECTION_INDEX_VERSION:
+            raise ValueError(f'unsupported section index version: {data.get("version")!r}')
+        return cls(data['path'], data['size'], data['mtime_ns'], data['headings'])
+
+def convert_file(input_file: str, output_file: str = None, engine: str = 'pdflatex', cache: BlockCache = None,
+                 jobs: int = 1, code_files_min: int = None, facts: DocumentFacts = None,
+                 sections: SectionFiles = None, limits: ConversionLimits = None, section: str = None):
+    # Convert one Markdown file to .tex next to it in a single pass over the input.
+    # Returns (output_file, needs_unicode_engine); the engine requirement and the
+    # other DocumentFacts (filled into facts when given) come from the same pass.
+    # With code_files_min, code blocks of that many characters or more go to
+    # <input stem>-code/ next to the .tex, and side files no longer used are removed.
+    # With sections, the output is split per top-level section (see SectionFiles);
+    # split documents render in this process, whatever jobs is. A conversion stopped
+    # by limits (see ConversionLimits) leaves no .tex behind. With section, only the
+    # section with that heading title is read and converted, found through the
+    # file's SectionIndex, to <input stem>-<section>.tex by default; SectionNotFound
+    # if there is none.
+    if section is not None:
+        if sections is not None:
+            raise ValueError('section and sections cannot be combined')
+        start, end = SectionIndex.load(input_file).section_range(section)
+        output_file = output_file or f'{os.path.splitext(input_file)[0]}-{_section_slug(section)}.tex'
+    else:
+        start, end = 0, None
+        output_file = output_file or os.path.splitext(input_file)[0] + '.tex'
+    limits = limits if limits is not None else _CONVERSION_LIMITS
+    if limits is not None:
+        limits.check_size(os.path.getsize(input_file) if end is None else end - start)
+        limits = limits.start()
+    facts = facts if facts is not None else DocumentFacts()
+    code_files = None
+    if code_files_min is not None:
+        stem = os.path.splitext(os.path.basename(input_file))[0]
+        code_files = CodeFiles.for_document(os.path.dirname(os.path.abspath(output_file)), stem, code_files_min)
+    profiler = _PROFILER
+    lines = _iter_file_lines(input_file, start, end)
+    if profiler is not None:
+        lines = _profile_iter(lines, 'read', profiler, measure=_utf8_len)
+    # Stream the conversion so memory stays bounded by the largest block
+    base_dir = os.path.dirname(os.path.abspath(input_file))
+    try:
+        with open(output_file, 'w', encoding='utf-8', buffering=READ_CHUNK_BYTES) as f:
+            if sections is not None:
+                _write_split(lines, f, sections, cache, base_dir, code_files, facts, profiler, limits)
+            else:
+                _write_latex(lines, f, profiler, engine=engine, system_name=_system_name(), cache=cache, jobs=jobs,
+                             base_dir=base_dir, code_files=code_files, facts=facts, limits=limits)
+    except ConversionLimitError:
+        os.remove(output_file)
+        raise
+    # A section's .tex shares the side file directory with the whole document's
+    if code_files is not None and section is None:
+        code_files.prune(output_file, *(sections.paths() if sections is not None else ()))
+    if sections is not None:
+        sections.prune()
+    return output_file, facts.needs_unicode_engine
+
+# Size bound of all build directories together; least recently used ones go first
+BUILD_DIR_BYTES = 256 * 1024 * 1024
+
+# Private build root made with mkdtemp (and removed at exit) when the one on tmpfs
+# can't be trusted
+_FALLBACK_BUILD_ROOT = None
+
+def _build_root() -> str:
+    # Parent of the per-document build directories: $MD2TEX_BUILD_DIR, else a private
+    # directory on tmpfs (/dev/shm) when there is one, else build/ in the cache directory
+    root = os.environ.get('MD2TEX_BUILD_DIR')
+    if not root:
+        if os.name == 'posix' and os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            return _shm_build_root()
+        return _cache_dir('build')
+    os.makedirs(root, mode=0o700, exist_ok=True)
+    return root
+
+def _shm_build_root() -> str:
+    # /dev/shm/md2tex-build-<uid>, unless that name is taken by something other than
+    # a directory of ours closed to other users (/dev/shm is shared, so anyone could
+    # have created it first); then a fresh mkdtemp directory for this process
+    global _FALLBACK_BUILD_ROOT
+    import stat
+
+    if _FALLBACK_BUILD_ROOT is not None:
+        return _FALLBACK_BUILD_ROOT
+    root = os.path.join('/dev/shm', f'md2tex-build-{os.getuid()}')
+    try:
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        st = os.lstat(root)
+    except OSError:
+        st = None
+    if st is not None and stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077:
+        return root
+    import atexit
+    import shutil
+    import tempfile
+
+    _FALLBACK_BUILD_ROOT = tempfile.mkdtemp(prefix='md2tex-build-')
+    atexit.register(shutil.rmtree, _FALLBACK_BUILD_ROOT, True)
+    return _FALLBACK_BUILD_ROOT
+
+def build_dir(tex_file: str) -> str:
+    # Out-of-tree directory where the engine writes .aux/.log/.pdf for this document.
+    # It is kept between compiles so cross-reference state survives.
+    import hashlib
+
+    tex_path = os.path.realpath(tex_file)
+    digest = hashlib.sha256(tex_path.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(tex_path))[0]
+    path = os.path.join(_build_root(), f'{stem}-{digest}')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dir_path, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(dir_path, name)).st_size
+            except OSError:
+                pass
+    return total
+
+# Build directory names (<stem>-<16 hex digits of the path hash>), the lock file a
+# compile holds in its build directory, and how long a directory counts as in use
+# after its last change where there are no file locks
+BUILD_DIR_NAME_RE = re.compile(r'.+-[0-9a-f]{16}')
+BUILD_LOCK_FILE = '.lock'
+BUILD_DIR_IDLE_SECONDS = 3600
+
+def _lock_build_dir(build: str, exclusive: bool = False):
+    # Lock the build directory's lock file, shared for a compile or exclusive (without
+    # waiting) for eviction. Returns the open descriptor, None when an exclusive lock
+    # is refused because a compile holds it, or -1 where flock is not available. A
+    # compile that waited on an eviction gets the directory recreated and relocked.
+    try:
+        import fcntl
+    except ImportError:
+        return -1
+    lock_file = os.path.join(build, BUILD_LOCK_FILE)
+    while True:
+        try:
+            fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return None if exclusive else -1
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+        except OSError:
+            os.close(fd)
+            return None
+        if exclusive:
+            return fd
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(lock_file)):
+                return fd
+        except OSError:
+            pass
+        os.close(fd)
+        os.makedirs(build, exist_ok=True)
+
+def _unlock_build_dir(fd):
+    if fd is not None and fd >= 0:
+        os.close(fd)
+
+def _evict_build_dirs(max_bytes: int, keep: str = None) -> int:
+    # Delete whole build directories, least recently used first, until they fit in
+    # max_bytes. Only md2tex's own <stem>-<hash> directories are considered, and one
+    # a compile is using (its lock is held) is skipped.
+    import shutil
+    import stat
+    import time
+
+    root = _build_root()
+    entries = []
+    total = 0
+    for name in os.listdir(root):
+        if not BUILD_DIR_NAME_RE.fullmatch(name):
+            continue
+        path = os.path.join(root, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        size = _dir_size(path)
+        entries.append((st.st_mtime, size, path))
+        total += size
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        lock = _lock_build_dir(path, exclusive=True)
+        if lock is None or (lock < 0 and time.time() - mtime < BUILD_DIR_IDLE_SECONDS):
+            continue
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            _unlock_build_dir(lock)
+        total -= size
+        removed += 1
+    return removed
+
+# Bytes added to each size-bounded store ('build', 'pdf') since it was last checked
+# against its bound; a store missing here has not been checked in this process yet
+_BYTES_SINCE_EVICTION = {}
+
+def _eviction_due(store: str, added: int, every: int) -> bool:
+    # True on the first call for store in the process, then once another `every`
+    # bytes have been added, so a store is not sized after each file it gains
+    since = _BYTES_SINCE_EVICTION.get(store)
+    if since is not None and since + added < every:
+        _BYTES_SINCE_EVICTION[store] = since + added
+        return False
+    _BYTES_SINCE_EVICTION[store] = 0
+    return True
+
+def _copy_atomic(src: str, dst: str):
+    # Copy to a temporary file next to dst, then rename it into place, so a reader
+    # never sees a partly written dst
+    import shutil
+
+    tmp_path = f'{dst}.{os.getpid()}.{_thread.get_ident()}.tmp'
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# Copy the finished PDF out of the build directory
+def _publish_pdf(built_pdf: str, pdf_file: str, build: str):
+    profiler = _PROFILER
+    if profiler is not None:
+        previous = profiler.switch('publish')
+        try:
+            _copy_out(built_pdf, pdf_file, build)
+        finally:
+            profiler.switch(previous)
+            profiler.count('publish')
+    else:
+        _copy_out(built_pdf, pdf_file, build)
+
+def _copy_out(built_pdf: str, pdf_file: str, build: str):
+    _copy_atomic(built_pdf, pdf_file)
+    os.utime(build)  # mark as recently used
+    if _eviction_due('build', os.path.getsize(pdf_file), BUILD_DIR_BYTES // 8):
+        _evict_build_dirs(BUILD_DIR_BYTES, keep=build)
+
+def clean_build_dirs(inputs=None) -> int:
+    # Remove the build directories of the given .md/.tex files (all of them when
+    # inputs is empty), plus aux files older versions left next to the sources.
+    # Returns the number of build directories removed.
+    import shutil
+
+    root = _build_root()
+    if not inputs:
+        targets = [os.path.join(root, name) for name in os.listdir(root) if BUILD_DIR_NAME_RE.fullmatch(name)]
+    else:
+        targets = []
+        for path in _expand_inputs(inputs):
+            tex_file = os.path.splitext(path)[0] + '.tex'
+            _remove_aux_files(tex_file)
+            targets.append(build_dir(tex_file))
+    removed = 0
+    for path in targets:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+# Aux files of this document next to the .tex (left there by versions before build directories)
+def _remove_aux_files(tex_path: str):
+    base, _ = os.path.splitext(tex_path)
+    dir_name = os.path.dirname(os.path.abspath(tex_path)) or '.'
+    aux_exts = [
+        '.aux', '.log', '.out', '.toc', '.synctex.gz',
+        '.fls', '.fdb_latexmk', '.nav', '.snm', '.vrb',
+        '.bbl', '.blg', '.lof', '.lot', '.lol',
+        '.idx', '.ilg', '.ind', '.glg', '.glo', '.gls',
+        '.ist', '.acn', '.acr', '.alg', '.bcf', '.run.xml',
+        '.xdy', '.thm', ENGINE_LOG_SUFFIX,
+    ]
+    # Remove aux files for the current jobname
+    for ext in aux_exts:
+        candidate = base + ext
+        try:
+            if os.path.exists(candidate):
+                os.remove(candidate)
+        except Exception:
+            # Silently ignore cleanup issues
+            pass
+    # Also remove stray texput.log if it exists in the same directory
+    try:
+        texput_log = os.path.join(dir_name, 'texput.log')
+        if os.path.exists(texput_log):
+            os.remove(texput_log)
+    except Exception:
+        pass
+
+# Base formats that `-ini` mode starts from when dumping the preamble
+BASE_FORMATS = {'pdflatex': 'pdflatex', 'xelatex': 'xelatex', 'lualatex': 'lualatex'}
+
+# Appended to the preamble before \dump: with the format loaded, the document's own
+# copy of the preamble is skipped up to its first \begin (which is \begin{document})
+FORMAT_DUMP_SUFFIX = '\\long\\def\\documentclass#1\\begin{\\begin}\n\\dump\n'
+
+# How long a failed format dump disables --fmt for the same preamble and engine
+FORMAT_RETRY_SECONDS = 3600
+
+_FORMAT_LOCK = _thread.allocate_lock()  # threading.Lock without importing threading
+
+def _uses_standard_preamble(tex_file: str) -> bool:
+    # A precompiled format is only valid for documents that start with the exact preamble,
+    # followed directly by \begin{document} (no \includeonly or other additions)
+    expected = LATEX_PREAMBLE + DOCUMENT_BEGIN
+    with open(tex_file, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read(len(expected)) == expected
+
+def preamble_format(engine_name: str, engine_path: str):
+    # Path (without .fmt) of the preamble dumped as a format for this engine, building
+    # it on first use. The name hashes the preamble, engine path and engine version,
+    # so any change produces a fresh format. Returns None if the engine cannot dump it;
+    # a failed dump is not retried for FORMAT_RETRY_SECONDS (packages installed since
+    # then do not change the name).
+    import hashlib
+    import subprocess
+    import time
+
+    base_format = BASE_FORMATS.get(engine_name)
+    if base_format is None:
+        return None
+    digest = hashlib.sha256(
+        f'{LATEX_PREAMBLE}\0{engine_name}\0{os.path.realpath(engine_path)}\0{engine_version(engine_path)}'.encode()
+    ).hexdigest()[:16]
+    fmt_dir = _cache_dir('fmt')
+    name = f'md2tex-{engine_name}-{digest}'
+    fmt_path = os.path.join(fmt_dir, name)
+    with _FORMAT_LOCK:
+        if os.path.exists(fmt_path + '.fmt'):
+            return fmt_path
+        try:
+            if time.time() - os.stat(fmt_path + '.failed').st_mtime < FORMAT_RETRY_SECONDS:
+                return None
+        except OSError:
+            pass
+        job = f'{name}-{os.getpid()}'
+        dump_tex = os.path.join(fmt_dir, job + '.tex')
+        with open(dump_tex, 'w', encoding='utf-8') as f:
+            f.write(LATEX_PREAMBLE + FORMAT_DUMP_SUFFIX)
+        try:
+            subprocess.run(
+                [engine_path, '-ini', *ENGINE_SAFE_ARGS, '-interaction=nonstopmode', f'-jobname={job}',
+                 f'&{base_format}', job + '.tex'],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=fmt_dir,
+                env=_engine_env(), timeout=_ENGINE_LIMITS['timeout'],
+            )
+        except (OSError, subprocess.SubprocessError):
+            pass
+        for ext in ('.tex', '.log'):
+            try:
+                os.remove(os.path.join(fmt_dir, job + ext))
+            except OSError:
+                pass
+        if os.path.exists(os.path.join(fmt_dir, job + '.fmt')):
+            os.replace(os.path.join(fmt_dir, job + '.fmt'), fmt_path + '.fmt')
+            try:
+                os.remove(fmt_path + '.failed')
+            except OSError:
+                pass
+            return fmt_path
+        # Remember the failure so every compile does not retry the dump
+        open(fmt_path + '.failed', 'w').close()
+        return None
+
+# Engine run limits: wall-clock timeout, CPU seconds and address-space bytes
+# (None disables a limit; CPU and memory limits only apply on POSIX), and the
+# most passes one compile may take
+ENGINE_TIMEOUT = 600
+ENGINE_MAX_PASSES = 3
+_ENGINE_LIMITS = {'timeout': ENGINE_TIMEOUT, 'cpu_seconds': None, 'memory_bytes': None,
+                  'max_passes': ENGINE_MAX_PASSES}
+
+def set_engine_limits(timeout: float = ENGINE_TIMEOUT, cpu_seconds: int = None, memory_bytes: int = None,
+                      max_passes: int = ENGINE_MAX_PASSES):
+    # Defaults for every later compile_pdf/CompileScheduler in this process
+    _ENGINE_LIMITS.update(timeout=timeout, cpu_seconds=cpu_seconds, memory_bytes=memory_bytes,
+                          max_passes=max_passes)
+
+# Engine output is streamed to <name>.engine.log in the document's build directory
+ENGINE_LOG_SUFFIX = '.engine.log'
+
+# Every engine run gets \write18 disabled and kpathsea's paranoid mode for files
+# the document opens (\input, \openin) or writes (\openout): no absolute paths,
+# no '..' and no dot files. The LaTeX may come from a server client, and the
+# documents md2tex writes only reference files next to the .tex.
+ENGINE_SAFE_ARGS = ('-no-shell-escape',)
+
+def _engine_env() -> dict:
+    return dict(os.environ, openin_any='p', openout_any='p')
+ENGINE_MAX_ERRORS = 20
+TEX_ERROR_LINE_RE = re.compile(rb'^l\.(\d+)')
+
+class TexLogScanner:
+    # Single pass over the engine's output: every chunk is appended to the log file
+    # and TeX errors ("! message" followed by "l.<line> ...") are collected as
+    # {'message', 'line'} dicts, at most ENGINE_MAX_ERRORS of them.
+
+    def __init__(self, log_file: str):
+        self.log_file = log_file
+        self.errors = []
+        self._log = open(log_file, 'wb')
+        self._carry = b''
+
+    def feed(self, data: bytes):
+        self._log.write(data)
+        lines = (self._carry + data).split(b'\n')
+        self._carry = lines.pop()
+        for line in lines:
+            self._scan(line)
+
+    def _scan(self, line: bytes):
+        if line.startswith(b'! '):
+            if len(self.errors) < ENGINE_MAX_ERRORS:
+                message = line[2:].rstrip(b'\r').decode('utf-8', 'replace')
+                self.errors.append({'message': message, 'line': None})
+        elif self.errors and self.errors[-1]['line'] is None:
+            match = TEX_ERROR_LINE_RE.match(line)
+            if match:
+                self.errors[-1]['line'] = int(match.group(1))
+
+    def close(self):
+        if self._carry:
+            self._scan(self._carry)
+            self._carry = b''
+        self._log.close()
+
+def _format_tex_errors(errors) -> str:
+    return '\n'.join(f'l.{e["line"]}: {e["message"]}' if e['line'] else e['message'] for e in errors)
+
+def _engine_limited(cmd, cpu_seconds: int = None, memory_bytes: int = None):
+    # cmd run under RLIMIT_CPU/RLIMIT_AS through `sh -c 'ulimit ...; exec'` on POSIX,
+    # so the limits are set in the child before the engine starts without a
+    # preexec_fn (which is not safe in a process with threads); cmd unchanged when
+    # there is nothing to apply
+    if not (cpu_seconds or memory_bytes) or os.name != 'posix':
+        return cmd
+    limits = []
+    if cpu_seconds:
+        limits.append(f'ulimit -t {int(cpu_seconds)}')
+    if memory_bytes:
+        limits.append(f'ulimit -v {-(-int(memory_bytes) // 1024)}')
+    return ['/bin/sh', '-c', ' && '.join(limits) + ' && exec "$@"', 'md2tex-engine', *cmd]
+
+def _kill_engine(proc):
+    # The engine runs in its own session on POSIX: kill the whole process group so
+    # helpers it spawned (mktexpk, ...) cannot keep the output pipe open
+    if os.name == 'posix':
+        import signal
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+    proc.kill()
+
+# Outputs that feed the next pass. Only the cross-reference lines of .aux count, so a
+# document without labels or citations stops after one pass; \@input follows the
+# .aux files of \include'd parts.
+RERUN_FILE_EXTS = ('.aux', '.out', '.toc')
+AUX_REFERENCE_PREFIXES = (b'\\newlabel', b'\\bibcite', b'\\@input')
+AUX_INPUT_RE = re.compile(rb'^\\@input\{([^}]*)\}')
+
+def _rerun_state(base: str) -> str:
+    # Digest of what the next pass would read from .aux/.out/.toc
+    import hashlib
+
+    digest = hashlib.sha256()
+    directory = os.path.dirname(base)
+    pending = [base + ext for ext in RERUN_FILE_EXTS]
+    seen = set()
+    while pending:
+        path = pending.pop(0)
+        if path in seen:
+            continue
+        seen.add(path)
+        digest.update(os.path.basename(path).encode('utf-8', 'surrogateescape') + b'\0')
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not path.endswith('.aux'):
+                        digest.update(line)
+                    elif line.startswith(AUX_REFERENCE_PREFIXES):
+                        digest.update(line)
+                        match = AUX_INPUT_RE.match(line)
+                        if match:
+                            pending.append(os.path.join(directory, os.fsdecode(match.group(1))))
+        except OSError:
+            pass  # a missing file reads the same as an empty one
+    return digest.hexdigest()
+
+async def _engine_pass(cmd, cwd: str, env, scanner: TexLogScanner, timeout: float):
+    # One engine run with its output streamed into scanner: (returncode, timed_out)
+    import asyncio
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        cwd=cwd,
+        env=env,
+        start_new_session=os.name == 'posix',
+    )
+
+    async def _stream():
+        while True:
+            data = await proc.stdout.read(1 << 16)
+            if not data:
+                break
+            scanner.feed(data)
+        return await proc.wait()
+
+    try:
+        await asyncio.wait_for(_stream(), timeout)
+    except asyncio.TimeoutError:
+        return proc.returncode, True
+    finally:
+        if proc.returncode is None:
+            _kill_engine(proc)
+            await proc.wait()
+    return proc.returncode, False
+
+async def compile_pdf_async(tex_file: str, engine_path: str, format_path: str = None, timeout: float = None,
+                            cpu_seconds: int = None, memory_bytes: int = None, max_passes: int = None,
+                            build: str = None) -> dict:
+    # Run the engine on the .tex as an asyncio subprocess, writing into the document's
+    # build directory (build_dir(tex_file) unless given), streaming its output to
+    # <name>.engine.log there and extracting errors on the way. Passes are repeated
+    # while the .aux/.out/.toc content is still changing, up to max_passes; aux state
+    # is kept between compiles, so an unchanged document usually needs one pass.
+    # The engine is killed on timeout (for all passes together) or cancellation.
+    # Limits left as None use set_engine_limits() defaults.
+    # Returns {'pdf', 'returncode', 'errors', 'log', 'timed_out', 'passes', 'converged'};
+    # the PDF is copied next to the .tex when the run wrote one.
+    import time
+
+    limits = _ENGINE_LIMITS
+    timeout = limits['timeout'] if timeout is None else timeout
+    cpu_seconds = limits['cpu_seconds'] if cpu_seconds is None else cpu_seconds
+    memory_bytes = limits['memory_bytes'] if memory_bytes is None else memory_bytes
+    max_passes = max(1, limits['max_passes'] if max_passes is None else max_passes)
+
+    build = build or build_dir(tex_file)
+    # Held while the build directory is in use, so eviction leaves it alone
+    lock = _lock_build_dir(build)
+    try:
+        sections_dir = _sections_dir(tex_file)
+        if sections_dir:
+            # \include writes each section's .aux under the same relative path in the build directory
+            os.makedirs(os.path.join(build, os.path.basename(sections_dir)), exist_ok=True)
+        cmd = [engine_path, *ENGINE_SAFE_ARGS, '-interaction=nonstopmode', f'-output-directory={build}',
+               os.path.basename(tex_file)]
+        env = _engine_env()
+        if format_path:
+            cmd.insert(1, f'-fmt={format_path}')
+            env['TEXFORMATS'] = os.path.dirname(format_path) + os.pathsep
+        cmd = _engine_limited(cmd, cpu_seconds, memory_bytes)
+        cwd = os.path.dirname(os.path.abspath(tex_file)) or '.'
+        base = os.path.join(build, os.path.splitext(os.path.basename(tex_file))[0])
+        built_pdf = base + '.pdf'
+        log_file = base + ENGINE_LOG_SUFFIX
+        profiler = _PROFILER
+        deadline = time.monotonic() + timeout if timeout else None
+        # Only a PDF this run wrote counts (not one left over from an earlier build or
+        # pass): the previous PDF is moved aside before each pass, so whatever is at
+        # built_pdf afterwards was written by that pass
+        stale_pdf = base + '.prev.pdf'
+        state = _rerun_state(base)
+        returncode, timed_out, converged, passes, produced = None, False, False, 0, False
+        while passes < max_passes and not converged:
+            passes += 1
+            try:
+                os.replace(built_pdf, stale_pdf)
+            except FileNotFoundError:
+                pass
+            remaining = max(0.0, deadline - time.monotonic()) if deadline else None
+            scanner = TexLogScanner(log_file)
+            if profiler is not None:
+                previous = profiler.switch('engine')
+                started = time.perf_counter()
+            try:
+                returncode, timed_out = await _engine_pass(cmd, cwd, env, scanner, remaining)
+            finally:
+                scanner.close()
+                if profiler is not None:
+                    profiler.engine_pass(os.path.basename(engine_path), tex_file, time.perf_counter() - started,
+                                         returncode, bool(format_path))
+                    profiler.count('engine')
+                    profiler.switch(previous)
+            if timed_out:
+                break
+            # A pass that wrote no PDF failed outright; another pass will not fix it, and
+            # the PDF of an earlier pass of this run is kept
+            if not os.path.exists(built_pdf):
+                if produced:
+                    os.replace(stale_pdf, built_pdf)
+                break
+            produced = True
+            new_state = _rerun_state(base)
+            converged = new_state == state
+            state = new_state
+        errors = scanner.errors
+        if timed_out:
+            errors.append({'message': f'Engine timed out after {timeout:g}s and was stopped', 'line': None})
+        pdf_file = None
+        if produced and not timed_out:
+            pdf_file = os.path.splitext(tex_file)[0] + '.pdf'
+            _publish_pdf(built_pdf, pdf_file, build)
+        return {'pdf': pdf_file, 'returncode': returncode, 'errors': errors, 'log': log_file,
+                'timed_out': timed_out, 'passes': passes, 'converged': converged}
+    finally:
+        _unlock_build_dir(lock)
+
+def compile_pdf(tex_file: str, engine_path: str, format_path: str = None, details: dict = None):
+    # Blocking compile_pdf_async with the default limits; usable from any thread.
+    # With a preamble format the engine skips loading the packages itself.
+    # Returns (pdf_file or None, extracted errors as text with the log path); a
+    # details dict is filled with compile_pdf_async's full result (passes, errors, ...).
+    import asyncio
+
+    result = asyncio.run(compile_pdf_async(tex_file, engine_path, format_path))
+    if details is not None:
+        details.update(result)
+    lines = [_format_tex_errors(result['errors'])] if result['errors'] else []
+    if result['pdf'] is None:
+        if not lines and result['returncode']:
+            lines.append(f'Engine exited with status {result["returncode"]}')
+        lines.append(f'Engine log: {result["log"]}')
+    return result['pdf'], '\n'.join(lines)
+
+def _format_passes(details: dict) -> str:
+    # '2 passes', or a warning when the cap was hit before the references settled
+    passes = details.get('passes', 0)
+    text = f'{passes} pass' if passes == 1 else f'{passes} passes'
+    if not details.get('converged', True):
+        text += ', references may be stale'
+    return text
+
+class CompileScheduler:
+    # Bounded asyncio scheduler for engine runs: at most `jobs` engines at once, each
+    # under the timeout and CPU/memory limits. A job submitted under a key (default:
+    # the .tex path) that already has one queued or running supersedes it: the older
+    # job is cancelled, its engine killed, and its caller gets a result with
+    # 'superseded' set instead of a PDF.
+
+    def __init__(self, jobs: int = None, timeout: float = None, cpu_seconds: int = None, memory_bytes: int = None,
+                 max_passes: int = None):
+        self.jobs = max(1, jobs or (os.cpu_count() or 1) // 2)
+        self.limits = {'timeout': timeout, 'cpu_seconds': cpu_seconds, 'memory_bytes': memory_bytes,
+                       'max_passes': max_passes}
+        self._slots = None
+        self._jobs = {}
+        self._superseded = set()
+
+    async def _run(self, tex_file: str, engine_path: str, format_path: str):
+        import asyncio
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.jobs)
+        async with self._slots:
+            return await compile_pdf_async(tex_file, engine_path, format_path, **self.limits)
+
+    async def compile(self, tex_file: str, engine_path: str, format_path: str = None, key: str = None) -> dict:
+        import asyncio
+
+        key = key or os.path.abspath(tex_file)
+        self.cancel(key)
+        task = asyncio.ensure_future(self._run(tex_file, engine_path, format_path))
+        self._jobs[key] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task not in self._superseded:
+                raise
+            return {'pdf': None, 'returncode': None, 'errors': [], 'log': None, 'timed_out': False,
+                    'passes': 0, 'converged': False, 'superseded': True}
+        finally:
+            self._superseded.discard(task)
+            if self._jobs.get(key) is task:
+                del self._jobs[key]
+
+    def cancel(self, key: str) -> bool:
+        # Cancel the job queued or running under key; True if there was one
+        task = self._jobs.pop(key, None)
+        if task is None or task.done():
+            return False
+        self._superseded.add(task)
+        task.cancel()
+        return True
+
+def compile_pdf_fast(tex_file: str, engine_name: str, engine_path: str, use_format: bool = False,
+                     details: dict = None):
+    # compile_pdf using the cached preamble format when asked for and applicable;
+    # falls back to a normal run if the format run fails
+    if use_format and _uses_standard_preamble(tex_file):
+        format_path = preamble_format(engine_name, engine_path)
+        if format_path:
+            pdf_file, output = compile_pdf(tex_file, engine_path, format_path, details)
+            if pdf_file:
+                return pdf_file, output
+    return compile_pdf(tex_file, engine_path, details=details)
+
+_ENGINE_VERSIONS = {}
+
+def engine_version(engine_path: str) -> str:
+    # First line of `<engine> --version`, memoized per process and kept in the
+    # engine cache so it is only re-run when the binary changes
+    version = _ENGINE_VERSIONS.get(engine_path)
+    if version is not None:
+        return version
+    entry = next((e for e in installed_engines().values() if e['path'] == engine_path), None)
+    if entry is not None and 'version' in entry:
+        version = entry['version']
+    else:
+        import subprocess
+        try:
+            result = subprocess.run([engine_path, '--version'], capture_output=True, text=True,
+                                    encoding='utf-8', errors='ignore', timeout=30)
+            version = (result.stdout.strip().splitlines() or [''])[0]
+        except (OSError, subprocess.SubprocessError):
+            version = ''
+        if entry is not None:
+            entry['version'] = version
+            _save_engine_cache(_ENGINE_CACHE)
+    _ENGINE_VERSIONS[engine_path] = version
+    return version
+
+def _evict_lru(root: str, max_bytes: int) -> int:
+    # Delete least recently modified files under root until it fits in max_bytes
+    entries = []
+    total = 0
+    for dir_path, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dir_path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+# Size bound of the content-addressed PDF store
+COMPILE_CACHE_BYTES = 1024 * 1024 * 1024
+
+def _compile_key(tex_file: str, engine_name: str, engine_path: str) -> str:
+    import hashlib
+    digest = hashlib.sha256()
+    with open(tex_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    # Split output: the section files are part of the document
+    sections_dir = _sections_dir(tex_file)
+    if sections_dir:
+        for name in sorted(os.listdir(sections_dir)):
+            if name.endswith('.tex'):
+                digest.update(b'\0' + name.encode('utf-8', 'surrogateescape') + b'\0')
+                with open(os.path.join(sections_dir, name), 'rb') as f:
+                    digest.update(f.read())
+    engine_id = f'\0{engine_name}\0{os.path.realpath(engine_path)}\0{engine_version(engine_path)}'
+    digest.update(engine_id.encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+def _same_file_content(a: str, b: str) -> bool:
+    import filecmp
+    try:
+        return filecmp.cmp(a, b, shallow=False)
+    except OSError:
+        return False
+
+def compile_pdf_cached(tex_file: str, engine_name: str, engine_path: str, use_format: bool = False,
+                       details: dict = None):
+    # compile_pdf behind a content-addressed PDF store keyed on the .tex bytes and the
+    # engine name, path and version. Returns (pdf_file or None, engine output, status)
+    # with status 'unchanged' (PDF already current), 'restored' (copied from the store)
+    # or 'compiled'. PDFs are copied in and out of the store atomically, and the store
+    # is checked against COMPILE_CACHE_BYTES once per eighth of it stored.
+    key = _compile_key(tex_file, engine_name, engine_path)
+    stored = os.path.join(_cache_dir('pdf', key[:2]), key + '.pdf')
+    pdf_file = os.path.splitext(tex_file)[0] + '.pdf'
+    if os.path.exists(stored):
+        os.utime(stored)  # mark as recently used
+        if os.path.exists(pdf_file) and _same_file_content(stored, pdf_file):
+            return pdf_file, '', 'unchanged'
+        _copy_atomic(stored, pdf_file)
+        return pdf_file, '', 'restored'
+
+    pdf_file, output = compile_pdf_fast(tex_file, engine_name, engine_path, use_format, details)
+    # compile_pdf only returns a PDF this run wrote, so a failed compile never stores
+    # the PDF of an earlier build under the new content key
+    if pdf_file:
+        _copy_atomic(pdf_file, stored)
+        if _eviction_due('pdf', os.path.getsize(stored), COMPILE_CACHE_BYTES // 8):
+            _evict_lru(_cache_dir('pdf'), COMPILE_CACHE_BYTES)
+    return pdf_file, output, 'compiled'
+
+# Resolve input markdown file with a default to README.md when no file is provided
+def _resolve_input_file(inputs) -> str:
+    # Default when no argument provided
+    if not inputs:
+        return 'README.md'
+
+    raw = (inputs[0] or '').strip()
+    # Treat common "no-op" or sentinel args as README.md
+    if raw in ('/', '\\', '.', './', '.\\'):
+        return 'README.md'
+    # If a directory is provided, use README.md inside it
+    if os.path.isdir(raw):
+        input_file = os.path.join(raw, 'README.md')
+    else:
+        input_file = raw
+
+    if os.path.basename(input_file).lower() == 'readme.md' and not os.path.exists(input_file):
+        # Try case-insensitive match in the same directory
+        dir_name = os.path.dirname(input_file)
+        for name in os.listdir(dir_name or '.'):
+            if name.lower() == 'readme.md':
+                input_file = os.path.join(dir_name, name)
+                break
+    return input_file
+
+def _format_cache_stats(stats: dict) -> str:
+    return (f'Block cache: {stats["hits"]} hits, {stats["misses"]} misses, {stats["evictions"]} evictions, '
+            f'{stats["entries"]} entries ({stats["bytes"] / 1024:.0f} KiB)')
+
+def _format_memo_stats(stats: dict) -> str:
+    text, cells = stats['inline'], stats['cells']
+    return (f'Inline memo: text {text["hits"]} hits, {text["misses"]} misses; '
+            f'table cells {cells["hits"]} hits, {cells["misses"]} misses; '
+            f'{text["evictions"] + cells["evictions"]} evictions, '
+            f'{text["entries"] + cells["entries"]} entries ({(text["bytes"] + cells["bytes"]) / 1024:.0f} KiB)')
+
+def _open_block_cache(args):
+    if not args.cache:
+        return None
+    return BlockCache(max_bytes=int(args.cache_size * 1024 * 1024))
+
+def _convert_single(input_file: str, make_pdf: bool = True, cache: BlockCache = None, cache_stats: bool = False,
+                    compile_cache: bool = True, use_format: bool = False, jobs: int = 1, code_files_min: int = None,
+                    split: str = None, section: str = None):
+    if not os.path.exists(input_file):
+        # Friendly help when file not found; mention default behavior
+        print('✗ Input file not found. Provide a Markdown file or ensure README.md exists.')
+        print('Usage: python md2tex.py <markdown_file>')
+        print('Hint: Running with no argument (or with "/" or ".") defaults to README.md')
+        return 0
+
+    sections = _section_files(input_file, split)
+    try:
+        output_file, needs_unicode_engine = convert_file(input_file, cache=cache, jobs=jobs,
+                                                       code_files_min=code_files_min, sections=sections,
+                                                       section=section)
+    except ConversionLimitError as e:
+        print(f'✗ {input_file}: {e}')
+        return 1
+    except SectionNotFound:
+        print(f'✗ {input_file}: no section titled {section!r}')
+        titles = [title for _, level, title in SectionIndex.load(input_file).headings if level == 1]
+        if titles:
+            print(f'  Top-level sections: {", ".join(titles)}')
+        return 1
+    if sections is not None:
+        print(f'Converted {input_file} to {output_file} ({_format_sections(sections)})')
+    else:
+        print(f'Converted {input_file} to {output_file}')
+    if cache is not None:
+        cache.close()
+        if cache_stats:
+            print(_format_cache_stats(cache.stats()))
+    if cache_stats:
+        print(_format_memo_stats(inline_memo_stats()))
+    if not make_pdf:
+        return 0
+
+    engine_name, engine_path = find_latex_engine(needs_unicode_engine)
+    if engine_path:
+        print(f'Compiling PDF using: {engine_path}')
+        try:
+            details = {}
+            if compile_cache:
+                pdf_file, output, status = compile_pdf_cached(output_file, engine_name, engine_path, use_format,
+                                                              details)
+            else:
+                pdf_file, output = compile_pdf_fast(output_file, engine_name, engine_path, use_format, details)
+                status = 'compiled'
+            if status == 'unchanged':
+                print(f'✓ PDF up to date (.tex unchanged): {pdf_file}')
+            elif status == 'restored':
+                print(f'✓ PDF restored from compile cache: {pdf_file}')
+            elif pdf_file:
+                print(f'✓ PDF created: {pdf_file} ({_format_passes(details)})')
+            else:
+                print('✗ PDF compilation failed')
+                for line in output.splitlines():
+                    print(f'  {line}')
+        except Exception as e:
+            print(f'✗ Error running LaTeX engine: {e}')
+    else:
+        print('✗ No LaTeX engine found (pdflatex/xelatex/lualatex). Please install MiKTeX or TeX Live.')
+        print('  Download MiKTeX: https://miktex.org/download')
+    return 0
+
+def _expand_inputs(patterns) -> list:
+    # Files as given, directories searched recursively for *.md, globs expanded
+    import glob
+
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '**', '*.md'), recursive=True))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matches = [pattern]
+        files.extend(os.path.normpath(m) for m in matches)
+    return list(dict.fromkeys(files))
+
+def _input_signature(path: str) -> list:
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def _load_manifest(path: str) -> dict:
+    # {input path: entry} from a manifest journal: one JSON object per line, the
+    # input path under 'file', later lines winning. A line torn by a crash is
+    # ignored. Manifests written as one JSON document by older versions still load.
+    import json
+
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except OSError:
+        return {}
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict) and isinstance(data.get('files'), dict):
+        return data['files']
+    entries = {}
+    for line in text.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(record, dict) and 'file' in record:
+            entries[record.pop('file')] = record
+    return entries
+
+def _manifest_line(path: str, entry: dict) -> str:
+    import json
+
+    return json.dumps(dict(entry, file=path), sort_keys=True) + '\n'
+
+def _save_manifest(path: str, entries: dict):
+    # Rewrite the journal with one line per file (write-then-rename, so a crash never
+    # leaves a truncated manifest behind); results are appended to it as they complete
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.writelines(_manifest_line(name, entries[name]) for name in sorted(entries))
+    os.replace(tmp_path, path)
+
+def _init_batch_worker(memo_bytes: int, limits: ConversionLimits = None):
+    # Carry the parent's process-wide settings into a (possibly spawned) worker
+    global _CONVERSION_LIMITS
+    set_inline_memo_size(memo_bytes)
+    _CONVERSION_LIMITS = limits
+
+def _batch_convert(input_file: str, cache_bytes: int = None, code_files_min: int = None, split: str = None) -> dict:
+    import time
+
+    start = time.perf_counter()
+    cache = BlockCache(max_bytes=cache_bytes) if cache_bytes else None
+    try:
+        output_file, needs_unicode_engine = convert_file(input_file, cache=cache, code_files_min=code_files_min,
+                                                         sections=_section_files(input_file, split))
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}', 'convert_s': time.perf_counter() - start}
+    finally:
+        if cache is not None:
+            cache.close()
+    result = {
+        'tex': output_file,
+        'needs_unicode_engine': needs_unicode_engine,
+        'convert_s': time.perf_counter() - start,
+    }
+    if cache is not None:
+        result['cache'] = {'hits': cache.hits, 'misses': cache.misses, 'evictions': cache.evictions}
+    return result
+
+def _batch_compile(tex_file: str, engine_name: str, engine_path: str, compile_cache: bool = True,
+                   use_format: bool = False) -> dict:
+    import time
+
+    start = time.perf_counter()
+    status = 'compiled'
+    details = {}
+    try:
+        if compile_cache:
+            pdf_file, output, status = compile_pdf_cached(tex_file, engine_name, engine_path, use_format, details)
+        else:
+            pdf_file, output = compile_pdf_fast(tex_file, engine_name, engine_path, use_format, details)
+        error = None if pdf_file else 'PDF compilation failed: ' + output.split('\n', 1)[0]
+    except Exception as e:
+        pdf_file, error = None, f'Error running LaTeX engine: {e}'
+    return {'pdf': pdf_file, 'error': error, 'compile_s': time.perf_counter() - start, 'compile': status,
+            'passes': details.get('passes', 0), 'converged': details.get('converged', True)}
+
+def run_batch(inputs, jobs: int = None, latex_jobs: int = None, manifest_path: str = None, make_pdf: bool = True,
+              cache_bytes: int = None, cache_stats: bool = False, compile_cache: bool = True,
+              use_format: bool = False, code_files_min: int = None, split: str = None) -> int:
+    # Convert many files in a process pool; engine runs go through a separate,
+    # smaller thread pool so compiles never oversubscribe the cores.
+    # With a manifest, files already built from an unchanged input (with their PDF,
+    # when PDFs are wanted) are skipped.
+    import time
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+    started = time.perf_counter()
+    cpus = os.cpu_count() or 1
+    jobs = max(1, jobs or cpus)
+    latex_jobs = max(1, latex_jobs or cpus // 2)
+
+    files = _expand_inputs(inputs)
+    manifest = _load_manifest(manifest_path)
+    todo, skipped = [], set()
+    for path in files:
+        entry = manifest.get(path)
+        try:
+            signature = _input_signature(path)
+        except OSError:
+            signature = None
+        # An entry from a --no-pdf run (or one without an engine) has no PDF to reuse
+        if entry and entry.get('status') == 'ok' and entry.get('input') == signature \
+                and os.path.exists(entry.get('tex') or '') \
+                and (not make_pdf or os.path.exists(entry.get('pdf') or '')):
+            skipped.add(path)
+        else:
+            todo.append(path)
+    journal = None
+    if manifest_path:
+        # Compact once, then append one line per result instead of rewriting it each time
+        _save_manifest(manifest_path, manifest)
+        journal = open(manifest_path, 'a', encoding='utf-8')
+
+    engines = {}
+    results = {}
+    try:
+        # Workers keep their inline memos across the files they convert
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker,
+                                 initargs=(_INLINE_MEMO.max_bytes, _CONVERSION_LIMITS)) as convert_pool, \
+                ThreadPoolExecutor(max_workers=latex_jobs) as latex_pool:
+            pending = {convert_pool.submit(_batch_convert, path, cache_bytes, code_files_min, split): path
+                       for path in todo}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    entry = results.setdefault(path, {})
+                    entry.update(future.result())
+                    if 'tex' in entry and 'pdf' not in entry and not entry.get('error') and make_pdf:
+                        needs_unicode_engine = entry['needs_unicode_engine']
+                        if needs_unicode_engine not in engines:
+                            engines[needs_unicode_engine] = find_latex_engine(needs_unicode_engine)
+                        engine_name, engine_path = engines[needs_unicode_engine]
+                        if engine_path:
+                            entry['engine'] = engine_name
+                            future = latex_pool.submit(_batch_compile, entry['tex'], engine_name, engine_path,
+                                                       compile_cache, use_format)
+                            pending[future] = path
+                            continue
+                        entry['pdf'] = None
+                    entry['status'] = 'failed' if entry.get('error') else 'ok'
+                    try:
+                        entry['input'] = _input_signature(path)
+                    except OSError:
+                        entry['input'] = None
+                    manifest[path] = {k: v for k, v in entry.items() if k not in ('needs_unicode_engine', 'cache')}
+                    if journal is not None:
+                        journal.write(_manifest_line(path, manifest[path]))
+                        journal.flush()
+    finally:
+        if journal is not None:
+            journal.close()
+    if manifest_path:
+        _save_manifest(manifest_path, manifest)
+
+    # Summary
+    failed = 0
+    for path in files:
+        if path in skipped:
+            print(f'- {path} (unchanged, skipped)')
+            continue
+        entry = results[path]
+        timing = f'{entry.get("convert_s", 0):.2f}s convert'
+        if 'compile_s' in entry:
+            timing += f', {entry["compile_s"]:.2f}s compile'
+            if entry.get('compile') in ('unchanged', 'restored'):
+                timing += f' ({entry["compile"]})'
+            elif entry.get('passes'):
+                timing += f' ({_format_passes(entry)})'
+        if entry['status'] == 'ok':
+            print(f'✓ {path} ({timing})')
+        else:
+            failed += 1
+            print(f'✗ {path}: {entry["error"]} ({timing})')
+    if make_pdf and (None, None) in engines.values():
+        print('✗ No LaTeX engine found (pdflatex/xelatex/lualatex); only .tex files were written.')
+    if cache_bytes and cache_stats:
+        totals = {'hits': 0, 'misses': 0, 'evictions': 0}
+        for entry in results.values():
+            for name, count in entry.get('cache', {}).items():
+                totals[name] += count
+        stats = BlockCache(max_bytes=cache_bytes).stats()
+        stats.update(totals)
+        print(_format_cache_stats(stats))
+    print(f'{len(todo) - failed} succeeded, {failed} failed, {len(skipped)} skipped '
+          f'in {time.perf_counter() - started:.2f}s')
+    return 1 if failed else 0
+
+def _rebuild(input_file: str, engines: dict, cache: BlockCache, make_pdf: bool = True,
+             compile_cache: bool = True, use_format: bool = False, code_files_min: int = None,
+             split: str = None) -> str:
+    # One watch-mode iteration: convert through the block cache, replace the .tex
+    # only if it (or, split, one of its section files) changed, and compile only then.
+    # Returns a one-line status.
+    import time
+
+    started = time.perf_counter()
+    output_file = os.path.splitext(input_file)[0] + '.tex'
+    tmp_file = output_file + '.tmp'
+    sections = _section_files(input_file, split)
+    try:
+        _, needs_unicode_engine = convert_file(input_file, tmp_file, cache=cache, code_files_min=code_files_min,
+                                               sections=sections)
+    except Exception as e:
+        return f'✗ {input_file}: {type(e).__name__}: {e}'
+    pdf_file = os.path.splitext(input_file)[0] + '.pdf'
+    if (os.path.exists(output_file) and _same_file_content(tmp_file, output_file)
+            and not (sections is not None and sections.changed)):
+        os.remove(tmp_file)
+        if os.path.exists(pdf_file) or not make_pdf:
+            return f'- {input_file}: .tex unchanged ({time.perf_counter() - started:.2f}s)'
+    else:
+        os.replace(tmp_file, output_file)
+    if not make_pdf:
+        return f'✓ {output_file} ({time.perf_counter() - started:.2f}s)'
+
+    if needs_unicode_engine not in engines:
+        engines[needs_unicode_engine] = find_latex_engine(needs_unicode_engine)
+    engine_name, engine_path = engines[needs_unicode_engine]
+    if not engine_path:
+        return f'✓ {output_file} (no LaTeX engine found, PDF skipped)'
+    details = {}
+    try:
+        if compile_cache:
+            pdf_file, _, _ = compile_pdf_cached(output_file, engine_name, engine_path, use_format, details)
+        else:
+            pdf_file, _ = compile_pdf_fast(output_file, engine_name, engine_path, use_format, details)
+    except Exception as e:
+        return f'✗ {input_file}: Error running LaTeX engine: {e}'
+    if not pdf_file:
+        return f'✗ {input_file}: PDF compilation failed'
+    if details:
+        return f'✓ {pdf_file} ({time.perf_counter() - started:.2f}s, {_format_passes(details)})'
+    return f'✓ {pdf_file} ({time.perf_counter() - started:.2f}s)'
+
+def watch(inputs, interval: float = 0.5, debounce: float = 0.3, make_pdf: bool = True,
+          compile_cache: bool = True, use_format: bool = False, cache: BlockCache = None, code_files_min: int = None,
+          split: str = None):
+    # Poll the inputs' size/mtime and rebuild changed files once saves settle for
+    # `debounce` seconds. Engines, compiled patterns and the block cache stay warm
+    # across iterations; without a cache, an in-memory one serves the session (the
+    # on-disk cache is only used when one is passed in). Runs until interrupted.
+    import time
+
+    cache = cache or BlockCache(':memory:')
+    engines = {}
+    files = _expand_inputs(inputs)
+
+    def _signatures():
+        found = {}
+        for path in files:
+            try:
+                found[path] = _input_signature(path)
+            except OSError:
+                found[path] = None
+        return found
+
+    seen = {}
+    print(f'Watching {len(files)} file(s); press Ctrl+C to stop')
+    try:
+        while True:
+            current = _signatures()
+            changed = [p for p in files if current[p] is not None and current[p] != seen.get(p)]
+            if changed:
+                # Debounce: wait until a burst of saves has settled
+                while True:
+                    time.sleep(debounce)
+                    settled = _signatures()
+                    if settled == current:
+                        break
+                    current = settled
+                    changed = [p for p in files if current[p] is not None and current[p] != seen.get(p)]
+                for path in changed:
+                    print(_rebuild(path, engines, cache, make_pdf, compile_cache, use_format, code_files_min, split),
+                          flush=True)
+                seen = current
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cache.close()
+    return 0
+
+# Largest request line / HTTP body the server accepts
+SERVE_MAX_REQUEST_BYTES = 64 * 1024 * 1024
+# Size bound of the server's work directory (.tex/.pdf of compiled Markdown snippets)
+SERVE_WORK_BYTES = 256 * 1024 * 1024
+
+class ConversionServer:
+    # Long-running converter behind serve_stdio/serve_unix/serve_http. A request is a
+    # JSON object {"op": "convert" | "compile" | "engines" | "ping", ...}; the reply is
+    # a JSON object with "ok", the request's "id" echoed back, and either the result or
+    # "error". Conversions run one at a time on a dedicated thread, so compiled
+    # patterns, resolved engines and the block cache stay warm; engine runs go through
+    # a pool of latex_jobs threads. Concurrent compiles of the same .tex share one run.
+    # Clients are not trusted with the file system. Requests naming an "input" file
+    # are refused unless the server has a root directory, and must then give a
+    # relative path without '..' to a file inside it (the .tex and .pdf are written
+    # next to it). CSV directives may only read files inside root, resolved from the
+    # input's directory or, for inline Markdown, from root itself; without a root
+    # they are refused. The process-wide ConversionLimits apply as well.
+
+    def __init__(self, latex_jobs: int = None, cache_bytes: int = None, compile_cache: bool = True,
+                 use_format: bool = False, code_files_min: int = None, work_dir: str = None, root: str = None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.latex_jobs = max(1, latex_jobs or (os.cpu_count() or 1) // 2)
+        self.cache_bytes = cache_bytes
+        self.compile_cache = compile_cache
+        self.use_format = use_format
+        self.code_files_min = code_files_min
+        self.work_dir = work_dir or _cache_dir('serve')
+        self.root = os.path.realpath(root) if root else None
+        defaults = _CONVERSION_LIMITS or ConversionLimits()
+        self._limits = ConversionLimits(defaults.max_bytes, defaults.max_seconds, defaults.max_list_depth,
+                                        csv_root=self.root or '')
+        self._cache = None
+        self._convert_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='md2tex-convert')
+        self._latex_pool = ThreadPoolExecutor(max_workers=self.latex_jobs, thread_name_prefix='md2tex-latex')
+        self._engines = {}
+        self._compiles = {}
+
+    def _engine(self, needs_unicode_engine: bool, name: str = None):
+        if name is not None:
+            if name not in ENGINE_NAMES:
+                raise ValueError(f'unknown engine {name!r}; expected one of {", ".join(ENGINE_NAMES)}')
+            entry = installed_engines().get(name)
+            if entry is None:
+                raise ValueError(f'{name} is not installed')
+            return name, entry['path']
+        if needs_unicode_engine not in self._engines:
+            self._engines[needs_unicode_engine] = find_latex_engine(needs_unicode_engine)
+        return self._engines[needs_unicode_engine]
+
+    def _block_cache(self):
+        # Only touched from the convert thread (BlockCache is one-per-thread)
+        if self._cache is None and self.cache_bytes:
+            self._cache = BlockCache(max_bytes=self.cache_bytes)
+        return self._cache
+
+    def _convert_text(self, markdown: str):
+        # (latex, DocumentFacts)
+        cache = self._block_cache()
+        facts = DocumentFacts()
+        latex = md_to_latex(markdown, system_name=_system_name(), cache=cache, base_dir=self.root, facts=facts,
+                            limits=self._limits)
+        if cache is not None:
+            cache.flush()
+        return latex, facts
+
+    def _input_path(self, name) -> str:
+        # Absolute path of a request's "input" file, which must lie inside root
+        if self.root is None:
+            raise PermissionError('file inputs are disabled; start the server with --serve-root DIR')
+        if not isinstance(name, str) or not name or os.path.isabs(name) or '..' in re.split(r'[\\/]', name) \
+                or os.path.splitdrive(name)[0]:
+            raise PermissionError(f'input must be a relative path inside the server root: {name!r}')
+        path = os.path.join(self.root, name)
+        if not _inside_dir(path, self.root):
+            raise PermissionError(f'input resolves outside the server root: {name!r}')
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'no such input file: {name!r}')
+        return path
+
+    def _convert_input(self, name: str):
+        input_file = self._input_path(name)
+        cache = self._block_cache()
+        result = convert_file(input_file, cache=cache, code_files_min=self.code_files_min, limits=self._limits)
+        if cache is not None:
+            cache.flush()
+        return result
+
+    def _write_snippet(self, latex: str) -> str:
+        # .tex for a converted snippet in the work dir, named by its content so that
+        # repeated previews hit the compile cache and never race on one file
+        import hashlib
+
+        name = hashlib.sha256(latex.encode('utf-8', 'surrogatepass')).hexdigest()[:20]
+        tex_file = os.path.join(self.work_dir, name + '.tex')
+        if not os.path.exists(tex_file):
+            tmp_path = f'{tex_file}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(latex)
+            os.replace(tmp_path, tex_file)
+        return tex_file
+
+    def _compile(self, tex_file: str, engine_name: str, engine_path: str) -> dict:
+        details = {}
+        if self.compile_cache:
+            pdf_file, output, status = compile_pdf_cached(tex_file, engine_name, engine_path, self.use_format,
+                                                          details)
+        else:
+            pdf_file, output = compile_pdf_fast(tex_file, engine_name, engine_path, self.use_format, details)
+            status = 'compiled'
+        if not pdf_file:
+            raise RuntimeError('PDF compilation failed' + (f'\n{output[-4000:]}' if output else ''))
+        return {'tex': tex_file, 'pdf': pdf_file, 'engine': engine_name, 'compile': status,
+                'passes': details.get('passes', 0)}
+
+    async def _run(self, pool, func, *args):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+    async def _compile_shared(self, tex_file: str, engine_name: str, engine_path: str) -> dict:
+        import asyncio
+
+        key = os.path.abspath(tex_file)
+        task = self._compiles.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(self._latex_pool, self._compile, tex_file, engine_name, engine_path))
+            self._compiles[key] = task
+            task.add_done_callback(lambda _: self._compiles.pop(key, None))
+        return dict(await asyncio.shield(task))
+
+    async def _op_convert(self, request: dict) -> dict:
+        if 'input' in request:
+            output_file, _ = await self._run(self._convert_pool, self._convert_input, request['input'])
+            return {'tex': output_file}
+        latex, facts = await self._run(self._convert_pool, self._convert_text, request.get('markdown', ''))
+        return {'latex': latex, 'facts': facts.to_dict()}
+
+    async def _op_compile(self, request: dict) -> dict:
+        if 'input' in request:
+            tex_file, needs_unicode_engine = await self._run(self._convert_pool, self._convert_input, request['input'])
+        else:
+            latex, facts = await self._run(self._convert_pool, self._convert_text, request.get('markdown', ''))
+            needs_unicode_engine = facts.needs_unicode_engine
+            tex_file = self._write_snippet(latex)
+        engine_name, engine_path = self._engine(needs_unicode_engine, request.get('engine'))
+        if not engine_path:
+            raise RuntimeError('No LaTeX engine found (pdflatex/xelatex/lualatex)')
+        result = await self._compile_shared(tex_file, engine_name, engine_path)
+        if 'input' not in request:
+            _evict_lru(self.work_dir, SERVE_WORK_BYTES)
+        return result
+
+    async def _op_engines(self, request: dict) -> dict:
+        return {'engines': {name: entry['path'] for name, entry in installed_engines().items()}}
+
+    async def _op_ping(self, request: dict) -> dict:
+        return {'memo': inline_memo_stats()}
+
+    async def handle(self, request) -> dict:
+        # Reply for one decoded request; never raises
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'request must be a JSON object'}
+        reply = {'id': request['id']} if 'id' in request else {}
+        handler = getattr(self, f'_op_{request.get("op", "convert")}', None)
+        if handler is None:
+            reply.update(ok=False, error=f'unknown op {request.get("op")!r}')
+            return reply
+        try:
+            reply.update(await handler(request))
+            reply['ok'] = True
+        except Exception as e:
+            reply.update(ok=False, error=f'{type(e).__name__}: {e}')
+        return reply
+
+    async def handle_line(self, line: bytes) -> bytes:
+        import json
+
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            reply = {'ok': False, 'error': f'invalid JSON: {e}'}
+        else:
+            reply = await self.handle(request)
+        return json.dumps(reply, ensure_ascii=False).encode('utf-8') + b'\n'
+
+    def warm_up(self):
+        # Resolve engines and touch the converter once before the first request
+        installed_engines()
+        for needs_unicode_engine in (False, True):
+            self._engine(needs_unicode_engine)
+        md_to_latex('# md2tex\n\n- *warm* `up` $x$\n\n| a |\n|---|\n| b |')
+
+    def close(self):
+        # Flush the block cache on its own thread, then stop both pools
+        if self._cache is not None:
+            self._convert_pool.submit(self._cache.close).result()
+        self._convert_pool.shutdown()
+        self._latex_pool.shutdown()
+
+async def _serve_stream(server: ConversionServer, readline, write, drain=None):
+    # JSON lines in, JSON lines out, in completion order (match replies by "id")
+    import asyncio
+
+    tasks = set()
+
+    async def _answer(line):
+        data = await server.handle_line(line)
+        write(data)
+        if drain is not None:
+            await drain()
+
+    while True:
+        try:
+            line = await readline()
+        except ValueError:
+            write(b'{"ok": false, "error": "request too large"}\n')
+            break
+        if not line:
+            break
+        if not line.strip():
+            continue
+        task = asyncio.ensure_future(_answer(line))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def serve_stdio(server: ConversionServer):
+    # JSON lines on stdin, replies on stdout; stdin is read on a helper thread so
+    # pipes, files and terminals all work
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+
+    async def _readline():
+        return await loop.run_in_executor(None, stdin.readline)
+
+    def _write(data):
+        stdout.write(data)
+        stdout.flush()
+
+    await _serve_stream(server, _readline, _write)
+
+async def serve_unix(server: ConversionServer, path: str):
+    # JSON lines over a Unix socket only the current user can connect to
+    import asyncio
+
+    async def _client(reader, writer):
+        try:
+            await _serve_stream(server, reader.readline, writer.write, writer.drain)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    unix_server = await asyncio.start_unix_server(_client, path, limit=SERVE_MAX_REQUEST_BYTES)
+    os.chmod(path, 0o600)
+    print(f'Serving on unix:{path}', file=sys.stderr, flush=True)
+    try:
+        async with unix_server:
+            await unix_server.serve_forever()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+HTTP_ROUTES = {
+    ('POST', '/convert'): 'convert',
+    ('POST', '/compile'): 'compile',
+    ('GET', '/engines'): 'engines',
+    ('GET', '/health'): 'ping',
+}
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}
+
+async def _http_request(reader):
+    # (method, path, headers, body) for the next request on a keep-alive connection, or None at EOF
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > SERVE_MAX_REQUEST_BYTES:
+        raise ValueError('request too large')
+    body = await reader.readexactly(length) if length else b''
+    return method, path.split('?', 1)[0], headers, body
+
+async def serve_http(server: ConversionServer, host: str = '127.0.0.1', port: int = 8808):
+    # POST /convert and /compile with a JSON request body; GET /engines and /health.
+    # Replies are JSON with status 200 (ok), 400 (failed request) or 404.
+    import asyncio
+    import json
+
+    async def _client(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _http_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    request = ('POST', None, {'connection': 'close'}, b'')
+                if request is None:
+                    break
+                method, path, headers, body = request
+                op = HTTP_ROUTES.get((method, path))
+                if path is None:
+                    status, reply = 400, {'ok': False, 'error': 'malformed request'}
+                elif op is None:
+                    status, reply = 404, {'ok': False, 'error': f'no route for {method} {path}'}
+                else:
+                    try:
+                        payload = json.loads(body) if body else {}
+                    except ValueError as e:
+                        payload = None
+                        reply = {'ok': False, 'error': f'invalid JSON: {e}'}
+                    if isinstance(payload, dict):
+                        payload['op'] = op
+                    if payload is not None:
+                        reply = await server.handle(payload)
+                    status = 200 if reply['ok'] else 400
+                data = json.dumps(reply, ensure_ascii=False).encode('utf-8')
+                close = headers.get('connection', '').lower() == 'close'
+                head = [f'HTTP/1.1 {status} {HTTP_REASONS[status]}', 'Content-Type: application/json; charset=utf-8',
+                        f'Content-Length: {len(data)}']
+                if close:
+                    head.append('Connection: close')
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    http_server = await asyncio.start_server(_client, host, port, limit=SERVE_MAX_REQUEST_BYTES)
+    print(f'Serving on http://{host}:{port}', file=sys.stderr, flush=True)
+    async with http_server:
+        await http_server.serve_forever()
+
+def _parse_serve_address(address: str, public: bool = False):
+    # '-' -> ('stdio',), 'unix:PATH' -> ('unix', PATH), '[http://][HOST]:PORT' or 'PORT' -> ('http', host, port).
+    # HTTP hosts other than loopback raise PermissionError unless public is set.
+    if address == '-':
+        return ('stdio',)
+    if address.startswith('unix:'):
+        return ('unix', address[len('unix:'):])
+    if address.startswith('http://'):
+        address = address[len('http://'):].rstrip('/')
+    host, _, port = address.rpartition(':')
+    host = host.strip('[]') or '127.0.0.1'
+    port = int(port)
+    if not public and not _is_loopback(host):
+        raise PermissionError(host)
+    return ('http', host, port)
+
+def _is_loopback(host: str) -> bool:
+    import ipaddress
+
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(address: str = '-', latex_jobs: int = None, cache_bytes: int = None, compile_cache: bool = True,
+          use_format: bool = False, code_files_min: int = None, root: str = None, public: bool = False) -> int:
+    # Run a ConversionServer on stdin/stdout ('-'), a Unix socket ('unix:PATH') or
+    # localhost HTTP ('HOST:PORT'). Runs until stdin closes or the process is interrupted.
+    # root is the only directory clients may name input files (and CSV tables) in.
+    # HTTP binds to loopback hosts only unless public is set.
+    import asyncio
+
+    try:
+        target = _parse_serve_address(address, public)
+    except PermissionError as e:
+        print(f'✗ Refusing to serve HTTP on non-loopback host {e}; pass --serve-public to allow it', file=sys.stderr)
+        return 2
+    except ValueError:
+        print(f'✗ Cannot parse server address {address!r}; use -, unix:PATH or [HOST:]PORT', file=sys.stderr)
+        return 2
+    if target[0] == 'unix' and not hasattr(asyncio, 'start_unix_server'):
+        print('✗ Unix sockets are not available on this platform; use - or [HOST:]PORT', file=sys.stderr)
+        return 2
+    if root is not None and not os.path.isdir(root):
+        print(f'✗ Server root is not a directory: {root}', file=sys.stderr)
+        return 2
+    server = ConversionServer(latex_jobs, cache_bytes, compile_cache, use_format, code_files_min, root=root)
+    server.warm_up()
+    if target[0] == 'stdio':
+        main_task = serve_stdio(server)
+    elif target[0] == 'unix':
+        main_task = serve_unix(server, target[1])
+    else:
+        main_task = serve_http(server, target[1], target[2])
+    try:
+        asyncio.run(main_task)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+def _build_arg_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='md2tex.py',
+        description='Convert Markdown to LaTeX and compile it to PDF.',
+    )
+    parser.add_argument('inputs', nargs='*',
+                        help='Markdown file (default: README.md). Several files, directories or globs '
+                             'switch to batch mode.')
+    parser.add_argument('--batch', action='store_true',
+                        help='batch mode even for a single input; directories are searched for *.md')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='conversion worker processes in batch mode (default: CPU count); with a single '
+                             'input, render the document in this many processes (default: 1)')
+    parser.add_argument('--latex-jobs', type=int, default=None,
+                        help='concurrent LaTeX engine runs in batch mode (default: half the CPU count)')
+    parser.add_argument('--manifest', default=None,
+                        help='manifest (JSON lines) recording per-file results; rerunning skips files that '
+                             'already succeeded, have not changed and have their PDF unless --no-pdf')
+    parser.add_argument('--no-pdf', action='store_true', help='only write .tex files')
+    parser.add_argument('--refresh-engines', action='store_true',
+                        help='re-detect LaTeX engines instead of using the cached discovery')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and rebuild the input(s) whenever they are saved')
+    parser.add_argument('--poll', type=float, default=0.5, help='watch mode polling interval in seconds')
+    parser.add_argument('--debounce', type=float, default=0.3,
+                        help='watch mode: seconds a file must stay unchanged before rebuilding')
+    parser.add_argument('--fmt', action='store_true',
+                        help='compile with the preamble precompiled into a cached format file (one per engine)')
+    parser.add_argument('--no-compile-cache', action='store_true',
+                        help='always run the LaTeX engine, even when the .tex is unchanged')
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse rendered LaTeX for unchanged blocks from the per-user block cache')
+    parser.add_argument('--cache-size', type=float, default=64,
+                        help='block cache size limit in MiB (default: 64)')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print block cache and inline memo hit/miss statistics')
+    parser.add_argument('--memo-size', type=float, default=INLINE_MEMO_BYTES / (1024 * 1024), metavar='MIB',
+                        help='size of each in-memory inline/table-cell memo in MiB '
+                             f'(default: {INLINE_MEMO_BYTES // (1024 * 1024)}; 0 disables it)')
+    parser.add_argument('--code-files', nargs='?', type=int, const=CODE_FILES_MIN_CHARS, default=None,
+                        metavar='CHARS',
+                        help='write code blocks of at least CHARS characters (default: '
+                             f'{CODE_FILES_MIN_CHARS}) to side files under <name>-code/ and \\input them')
+    parser.add_argument('--split', nargs='?', choices=('all', 'changed'), const='all', default=None,
+                        help='write each top-level section to <name>-sections/ and \\include it; with "changed", '
+                             'compile only the sections whose Markdown changed (\\includeonly)')
+    parser.add_argument('--section', default=None, metavar='TITLE',
+                        help='convert only the section with this heading title (to <name>-<section>.tex), '
+                             'located through a cached index of the file\'s headings')
+    parser.add_argument('--max-input-mb', type=float, default=None, metavar='MIB',
+                        help='refuse Markdown inputs larger than this')
+    parser.add_argument('--convert-timeout', type=float, default=None, metavar='SECONDS',
+                        help='stop converting a document after this many seconds')
+    parser.add_argument('--max-list-depth', type=int, default=None, metavar='LEVELS',
+                        help='refuse documents with lists nested deeper than this')
+    parser.add_argument('--engine-timeout', type=float, default=ENGINE_TIMEOUT, metavar='SECONDS',
+                        help=f'stop a LaTeX run after this many seconds (default: {ENGINE_TIMEOUT}; 0 for no limit)')
+    parser.add_argument('--engine-cpu', type=int, default=None, metavar='SECONDS',
+                        help='CPU time limit per LaTeX run (POSIX only)')
+    parser.add_argument('--engine-memory', type=float, default=None, metavar='MIB',
+                        help='address-space limit per LaTeX run in MiB (POSIX only)')
+    parser.add_argument('--max-passes', type=int, default=ENGINE_MAX_PASSES, metavar='N',
+                        help='LaTeX passes are repeated while .aux/.out/.toc still change, at most N times '
+                             f'(default: {ENGINE_MAX_PASSES}; 1 for a single pass)')
+    parser.add_argument('--clean', action='store_true',
+                        help='remove the build directories of the inputs (all of them when no input is given) '
+                             'and exit')
+    parser.add_argument('--serve', nargs='?', const='-', default=None, metavar='ADDRESS',
+                        help='run as a conversion server taking JSON requests on stdin (default), a Unix socket '
+                             '(unix:PATH) or localhost HTTP ([HOST:]PORT)')
+    parser.add_argument('--serve-root', default=None, metavar='DIR',
+                        help='server mode: let requests name input files (and CSV tables) inside DIR; '
+                             'without it only inline Markdown is accepted')
+    parser.add_argument('--serve-public', action='store_true',
+                        help='server mode: allow HTTP on a non-loopback host (clients are not authenticated)')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, metavar='FILE',
+                        help='record time, calls and bytes per stage and block type and per LaTeX pass as JSON '
+                             'lines, appended to FILE (default: stderr); single-file runs only')
+    return parser
+
+def _write_profile(profiler: Profiler, target: str, **context):
+    if target == '-':
+        profiler.write_jsonl(sys.stderr, **context)
+    else:
+        with open(target, 'a', encoding='utf-8') as f:
+            profiler.write_jsonl(f, **context)
+
+def main(argv=None) -> int:
+    import glob
+
+    args = _build_arg_parser().parse_args(argv)
+    if args.refresh_engines:
+        installed_engines(refresh=True)
+    set_engine_limits(args.engine_timeout or None, args.engine_cpu,
+                      int(args.engine_memory * 1024 * 1024) if args.engine_memory else None, args.max_passes)
+    set_inline_memo_size(int(args.memo_size * 1024 * 1024))
+    set_conversion_limits(int(args.max_input_mb * 1024 * 1024) if args.max_input_mb else None,
+                          args.convert_timeout or None, args.max_list_depth)
+    if args.clean:
+        removed = clean_build_dirs(args.inputs)
+        print(f'Removed {removed} build director{"y" if removed == 1 else "ies"} from {_build_root()}')
+        return 0
+    batch = args.batch or len(args.inputs) > 1 or any(glob.has_magic(p) for p in args.inputs)
+    if args.section is not None and (batch or args.watch or args.split or args.serve is not None):
+        print('✗ --section applies to single-file runs without --watch, --split or --serve', file=sys.stderr)
+        return 2
+    if args.serve is not None:
+        cache_bytes = int(args.cache_size * 1024 * 1024) if args.cache else None
+        return serve(args.serve, args.latex_jobs, cache_bytes, not args.no_compile_cache, args.fmt, args.code_files,
+                     args.serve_root, args.serve_public)
+    if args.profile and (batch or args.watch):
+        print('--profile applies to single-file runs; ignoring it', file=sys.stderr)
+        args.profile = None
+    if args.watch:
+        inputs = args.inputs if batch else [_resolve_input_file(args.inputs)]
+        cache = _open_block_cache(args)
+        return watch(inputs, args.poll, args.debounce, not args.no_pdf, not args.no_compile_cache, args.fmt, cache,
+                     args.code_files, args.split)
+    if batch:
+        cache_bytes = int(args.cache_size * 1024 * 1024) if args.cache else None
+        return run_batch(args.inputs or ['.'], args.jobs, args.latex_jobs, args.manifest, not args.no_pdf,
+                         cache_bytes, args.cache_stats, not args.no_compile_cache, args.fmt, args.code_files,
+                         args.split)
+    input_file = _resolve_input_file(args.inputs)
+    profiler = enable_profiling() if args.profile else None
+    status = _convert_single(input_file, not args.no_pdf, _open_block_cache(args), args.cache_stats,
+                             not args.no_compile_cache, args.fmt, args.jobs or 1, args.code_files, args.split,
+                             args.section)
+    if profiler is not None:
+        disable_profiling()
+        _write_profile(profiler, args.profile, input=input_file)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())